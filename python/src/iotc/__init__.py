@@ -1,7 +1,7 @@
 # Copyright (c) Microsoft. All rights reserved.
 # Licensed under the MIT license.
 
-__version__ = "0.3.9"
+__version__ = "0.4.0"
 __name__    = "iotc"
 
 import sys
@@ -12,135 +12,127 @@ class IOTConnectType:
 
 gIsMicroPython = ('implementation' in dir(sys)) and ('name' in dir(sys.implementation)) and (sys.implementation.name == 'micropython')
 
-try:
-  import urllib
-except ImportError:
-  print("ERROR: missing dependency `micropython-urllib`")
-  print("Try micropython -m upip install micropython-urequests ",
-        "micropython-time micropython-urllib.parse",
-        "micropython-json micropython-hashlib",
-        "micropython-hmac micropython-base64",
-        "micropython-threading micropython-ssl",
-        "micropython-umqtt.simple micropython-socket micropython-urequests"
-        )
-  sys.exit()
+class IOTDependencyError(ImportError):
+  def __init__(self, package):
+    ImportError.__init__(self, "missing dependency `" + package + "`")
+    self.package = package
+
+def _importModule(names, package):
+  for name in names:
+    try:
+      module = __import__(name)
+    except ImportError:
+      continue
+    for part in name.split('.')[1:]:
+      module = getattr(module, part)
+    return module
+  raise IOTDependencyError(package)
+
+class _LazyModule(object):
+  # stands in for a transport / crypto module until its first use.
+  # the module global is then replaced with the real module
+  def __init__(self, name, names, package):
+    self._name = name
+    self._names = names
+    self._package = package
+
+  def _load(self):
+    module = _importModule(self._names, self._package)
+    globals()[self._name] = module
+    return module
+
+  def __getattr__(self, attr):
+    return getattr(self._load(), attr)
+
+import time
+
+json = _LazyModule("json", ("json", "ujson"), "micropython-json")
+hashlib = _LazyModule("hashlib", ("hashlib",), "micropython-hashlib")
+hmac = _LazyModule("hmac", ("hmac",), "micropython-hmac")
+base64 = _LazyModule("base64", ("base64",), "micropython-base64")
+ssl = _LazyModule("ssl", ("ssl", "ussl"), "micropython-ssl")
+_urllib = _LazyModule("_urllib", ("urllib.parse", "urllib"), "micropython-urllib.parse")
+_urlparse = _LazyModule("_urlparse", ("urllib.parse", "urlparse"), "micropython-urllib.parse")
 
 http = None
+urequests = None
 if gIsMicroPython == False:
-  try:
-    import httplib as http
-  except ImportError:
-    import http.client as http
+  http = _LazyModule("http", ("http.client", "httplib"), "http.client")
 else:
-  try:
-    import urequests
-  except ImportError:
-    print("ERROR: missing dependency micropython-urequests")
-    sys.exit()
+  urequests = _LazyModule("urequests", ("urequests",), "micropython-urequests")
 
-try:
-  import time
-except ImportError:
-  print("ERROR: missing dependency `micropython-time`")
-  sys.exit()
-
-if gIsMicroPython:
-  try:
-    import usocket
-  except ImportError:
-    print("ERROR: missing dependency `micropython-usocket`")
-    sys.exit()
-
-try:
-  import json
-except ImportError:
-  print("ERROR: missing dependency `micropython-json`")
-  sys.exit()
+# paho on CPython, umqtt.simple on MicroPython
+mqtt = None
+MQTT_SUCCESS = 0 # paho MQTT_ERR_SUCCESS
+if gIsMicroPython == False:
+  mqtt = _LazyModule("mqtt", ("paho.mqtt.client",), "paho-mqtt")
 
 try:
-  import hashlib
+  import threading
 except ImportError:
-  print("ERROR: missing dependency `micropython-hashlib`")
-  sys.exit()
+  threading = None
 
 try:
-  import hmac
+  import heapq
 except ImportError:
-  print("ERROR: missing dependency `micropython-hmac`")
-  sys.exit()
+  heapq = None
 
 try:
-  import base64
+  from bisect import bisect_left
 except ImportError:
-  print("ERROR: missing dependency `micropython-base64`")
-  sys.exit()
+  bisect_left = None
 
 try:
-  import ssl
+  from collections import deque
 except ImportError:
-  print("ERROR: missing dependency `micropython-ssl`")
-  sys.exit()
+  deque = None
 
 try:
-  from threading import Timer
+  from collections import OrderedDict
 except ImportError:
-  try:
-    from threading import Thread
-  except ImportError:
-    print("ERROR: missing dependency `micropython-threading`")
-    sys.exit()
+  OrderedDict = None
 
-try:
-  import binascii
-except ImportError:
-  import ubinascii
+def preloadDependencies():
+  # import everything up front, i.e. to fail early on a missing dependency
+  modules = [json, hashlib, hmac, base64, ssl, _urllib, _urlparse]
+  if gIsMicroPython == False:
+    modules += [http, mqtt]
+  else:
+    modules += [urequests]
+    _importModule(("umqtt.simple",), "micropython-umqtt.simple")
+  for module in modules:
+    if isinstance(module, _LazyModule):
+      module._load()
+  return 0
 
-mqtt = None
-try:
-  import paho.mqtt.client as mqtt
-  MQTT_SUCCESS = mqtt.MQTT_ERR_SUCCESS
-except ImportError:
-  try:
-    from umqtt.simple import MQTTClient
-  except ImportError:
-    if gIsMicroPython == True:
-      print("ERROR: missing dependency `micropython-umqtt.simple`")
-    else:
-      print("ERROR: missing dependency `paho-mqtt`")
+def _requireMQTT():
+  # loads paho now, raises IOTDependencyError when it isn't installed. None on MicroPython
+  if isinstance(mqtt, _LazyModule):
+    return mqtt._load()
+  return mqtt
 
 def _createMQTTClient(__self, username, passwd):
   if mqtt != None:
-    LOG_IOTC('Clean session enabled: {}'.format(__self._cleanSession),IOTLogLevel.IOTC_LOGGING_ALL)
+    LOG_IOTC("Clean session enabled: %s", IOTLogLevel.IOTC_LOGGING_ALL, __self._cleanSession, device=__self._deviceId)
     __self._mqtts = mqtt.Client(client_id=__self._deviceId, protocol=mqtt.MQTTv311,clean_session=__self._cleanSession)
     __self._mqtts.on_connect = __self._onConnect
     __self._mqtts.on_message = __self._onMessage
-    __self._mqtts.on_log = __self._onLog
+    if gLOG_LEVEL > IOTLogLevel.IOTC_LOGGING_DISABLED or __self._exitOnError: # paho formats every packet log for on_log
+      __self._mqtts.on_log = __self._onLog
     __self._mqtts.on_publish = __self._onPublish
     __self._mqtts.on_disconnect = __self._onDisconnect
 
     __self._mqtts.username_pw_set(username=username, password=passwd)
-    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-    ssl_context.load_default_certs()
-    ssl_context.verify_mode = ssl.CERT_REQUIRED
-    ssl_context.check_hostname = True
-
-    if __self._credType != IOTConnectType.IOTC_CONNECT_SYMM_KEY:
-      ssl_context.load_cert_chain(certfile=__self._certfile, keyfile=__self._keyfile)
-
-    __self._mqtts.tls_set_context(ssl_context)
-    __self._mqtts.connect_async(__self._hostname, port=8883, keepalive=120)
-    __self._mqtts.loop_start()
+    __self._mqtts.tls_set_context(_getSSLContext(__self._certfile, __self._keyfile, __self._caFile))
+    __self._startMQTTLoop()
   else:
-    __self._mqtts = MQTTClient(__self._deviceId, __self._hostname, port=8883, user=username, password=passwd, keepalive=0, ssl=True, ssl_params={})
+    MQTTClient = _importModule(("umqtt.simple",), "micropython-umqtt.simple").MQTTClient
+    host, port = _splitEndpoint(__self._hostname, 8883)
+    __self._mqtts = MQTTClient(__self._deviceId, host, port=port, user=username, password=passwd, keepalive=0, ssl=True, ssl_params={})
 
     __self._mqtts.set_callback(__self._mqttcb)
     __self._mqtts.connect()
 
-try:
-    from urlparse import urlparse
-except ImportError:
-    from urllib.parse import urlparse
-
 class HTTP_PROXY_OPTIONS:
   def __init__(self, host_address, port, username, password):
     self._host_address = host_address
@@ -215,52 +207,508 @@ class IOTMessageStatus:
   IOTC_MESSAGE_REJECTED  = 2
   IOTC_MESSAGE_ABANDONED = 4
 
+class IOTOverflowPolicy:
+  IOTC_OVERFLOW_BLOCK       = 1
+  IOTC_OVERFLOW_DROP_OLDEST = 2
+  IOTC_OVERFLOW_DROP_NEWEST = 4
+
+class IOTEncoding:
+  IOTC_ENCODING_JSON    = 1 # stdlib json
+  IOTC_ENCODING_ORJSON  = 2 # `orjson`
+  IOTC_ENCODING_MSGPACK = 4 # `msgpack`
+
 gLOG_LEVEL = IOTLogLevel.IOTC_LOGGING_DISABLED
 gQOS_LEVEL = IOTQosLevel.IOTC_QOS_AT_MOST_ONCE # default is set to QoS 0 "At most once" IoT hub also supports QoS 1 "At least once"
 
-def LOG_IOTC(msg, level=IOTLogLevel.IOTC_LOGGING_API_ONLY):
-  global gLOG_LEVEL
-  if gLOG_LEVEL > IOTLogLevel.IOTC_LOGGING_DISABLED:
-    if level <= gLOG_LEVEL:
-      print(time.time(), msg)
+class IOTLogRecord:
+  def __init__(self, timestamp, level, msg, args, fields):
+    self._timestamp = timestamp
+    self._level = level
+    self._msg = msg
+    self._args = args
+    self._fields = fields
+
+  def getTimestamp(self):
+    return self._timestamp
+
+  def getLevel(self):
+    return self._level
+
+  def getFields(self):
+    return self._fields
+
+  def getMessage(self):
+    if len(self._args) == 0:
+      return self._msg
+    try:
+      return self._msg % self._args
+    except Exception:
+      return self._msg + " " + " ".join([str(arg) for arg in self._args])
+
+  def __str__(self):
+    if len(self._fields) == 0:
+      return self.getMessage()
+    return self.getMessage() + " [" + " ".join([str(key) + "=" + str(self._fields[key]) for key in sorted(self._fields)]) + "]"
+
+def _printSink(record):
+  print(record.getTimestamp(), str(record))
+
+gLOG_SINK = _printSink
+
+def LOG_IOTC(msg, level=IOTLogLevel.IOTC_LOGGING_API_ONLY, *args, **fields):
+  # `msg % args` and the sink only run when `level` is enabled
+  if level > gLOG_LEVEL or gLOG_LEVEL == IOTLogLevel.IOTC_LOGGING_DISABLED:
+    return 0
+  gLOG_SINK(IOTLogRecord(time.time(), level, msg, args, fields))
   return 0
 
-def MAKE_CALLBACK(client, eventName, payload, tag, status, msgid = None):
-  LOG_IOTC("- iotc :: MAKE_CALLBACK :: " + eventName, IOTLogLevel.IOTC_LOGGING_ALL)
+class IOTQueueLogSink:
+  # hands records to a background thread which formats and writes them, so
+  # logging from the network thread never waits on I/O. drops the oldest when full
+  def __init__(self, sink = None, maxRecords = 10000):
+    self._sink = sink if sink != None else _printSink
+    self._maxRecords = maxRecords
+    self._records = deque()
+    self._accepted = 0
+    self._written = 0
+    self._dropped = 0
+    self._event = threading.Event()
+    self._lock = threading.Lock()
+    self._thread = None
+
+  def __call__(self, record):
+    with self._lock: # counters are shared with the writer thread, `flush` waits on them
+      if len(self._records) >= self._maxRecords:
+        try:
+          self._records.popleft()
+          self._dropped = self._dropped + 1
+          self._written = self._written + 1
+        except IndexError:
+          pass
+      self._records.append(record)
+      self._accepted = self._accepted + 1
+    if self._thread == None:
+      self._start()
+    self._event.set()
+
+  def _start(self):
+    with self._lock:
+      if self._thread != None:
+        return
+      import atexit
+      atexit.register(self.flush, 1)
+      self._thread = threading.Thread(target=self._run, name="iotc-log")
+      self._thread.daemon = True
+      self._thread.start()
+
+  def _run(self):
+    dropped = 0
+    while True:
+      self._event.wait()
+      self._event.clear()
+      while True:
+        try:
+          record = self._records.popleft()
+        except IndexError:
+          break
+        try:
+          self._sink(record)
+        except Exception:
+          pass
+        with self._lock:
+          self._written = self._written + 1
+
+      if self._dropped != dropped:
+        self._sink(IOTLogRecord(time.time(), IOTLogLevel.IOTC_LOGGING_API_ONLY, "WARNING: %d log records dropped", (self._dropped - dropped,), {}))
+        dropped = self._dropped
+
+  def flush(self, timeout = None):
+    # => True when everything accepted so far is written
+    deadline = None if timeout == None else time.time() + timeout
+    while self._written < self._accepted:
+      if deadline != None and time.time() >= deadline:
+        return False
+      time.sleep(0.005)
+    return True
+
+  def getDropped(self):
+    return self._dropped
+
+def MAKE_CALLBACK(client, eventName, payload, tag, status, msgid = None, onComplete = None):
+  # `onComplete(info)` runs after the handler, i.e. to send the handler's response.
+  # with a callback executor both run on the executor instead of the calling thread
+  LOG_IOTC("- iotc :: MAKE_CALLBACK :: %s", IOTLogLevel.IOTC_LOGGING_ALL, eventName)
   try:
     obj = client["_events"]
   except:
     obj = client._events
 
-  if obj != None and (eventName in obj) and obj[eventName] != None:
-    cb = IOTCallbackInfo(client, eventName, payload, tag, status, msgid)
-    obj[eventName](cb)
-    return cb
-  return 0
+  handler = None
+  if obj != None and (eventName in obj):
+    handler = obj[eventName]
+  if handler == None and onComplete == None:
+    return 0
+
+  cb = IOTCallbackInfo(client, eventName, payload, tag, status, msgid)
+  _dispatchCallback(client, handler, cb, onComplete)
+  return cb if handler != None else 0
+
+def _dispatchCallback(client, handler, info, onComplete = None):
+  executor = getattr(client, "_callbackExecutor", None)
+  if executor != None:
+    executor.submit(client, handler, info, onComplete)
+  else:
+    if handler != None:
+      handler(info)
+    if onComplete != None:
+      onComplete(info)
+
+class IOTCallbackExecutor:
+  # runs event handlers on worker threads so a slow handler doesn't stall the
+  # network thread. callbacks of one device run one at a time, in order;
+  # different devices are served in parallel (up to `maxWorkers`)
+  def __init__(self, maxWorkers = 4):
+    self._maxWorkers = max(1, maxWorkers)
+    self._queues = {} # client -> deque of pending callbacks. present while queued or running
+    self._ready = deque()
+    self._depth = 0
+    self._peakDepth = 0
+    self._completed = 0
+    self._cond = threading.Condition()
+    self._workers = 0
+    self._idle = 0
+    self._stopped = False
+
+  def submit(self, client, handler, info, onComplete = None):
+    with self._cond:
+      queue = self._queues.get(client)
+      if queue == None:
+        queue = deque()
+        self._queues[client] = queue
+        self._ready.append(client)
+      queue.append((time.time(), handler, info, onComplete))
+      self._depth = self._depth + 1
+      if self._depth > self._peakDepth:
+        self._peakDepth = self._depth
+      if self._idle > 0:
+        self._cond.notify()
+      elif self._workers < self._maxWorkers:
+        self._startWorker()
+    return 0
+
+  def _startWorker(self):
+    self._workers = self._workers + 1
+    thread = threading.Thread(target=self._run, name="iotc-callback-{}".format(self._workers))
+    thread.daemon = True
+    thread.start()
+
+  def _invoke(self, handler, info, onComplete):
+    try:
+      if handler != None:
+        handler(info)
+    except Exception as e:
+      LOG_IOTC("ERROR: (%s) callback has failed => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, info.getEventName(), e)
+    if onComplete != None:
+      onComplete(info)
+
+  def _run(self):
+    while True:
+      with self._cond:
+        while len(self._ready) == 0 and not self._stopped:
+          self._idle = self._idle + 1
+          self._cond.wait()
+          self._idle = self._idle - 1
+        if len(self._ready) == 0:
+          self._workers = self._workers - 1
+          return
+        client = self._ready.popleft()
+        queue = self._queues[client]
+        task = queue.popleft()
+        self._depth = self._depth - 1
+
+      try:
+        self._invoke(task[1], task[2], task[3])
+      except Exception as e:
+        LOG_IOTC("ERROR: (IOTCallbackExecutor) %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, e)
+
+      with self._cond:
+        self._completed = self._completed + 1
+        if len(queue) > 0: # back of the line, other devices get their turn
+          self._ready.append(client)
+        else:
+          del self._queues[client]
+          if len(self._queues) == 0:
+            self._cond.notify_all() # flush
+
+  def flush(self, timeout = None):
+    # => True when every submitted callback has completed
+    deadline = None if timeout == None else time.time() + timeout
+    with self._cond:
+      while len(self._queues) > 0:
+        remaining = None if deadline == None else deadline - time.time()
+        if remaining != None and remaining <= 0:
+          return False
+        self._cond.wait(remaining)
+    return True
+
+  def shutdown(self, wait = True, timeout = None):
+    if wait:
+      self.flush(timeout)
+    with self._cond:
+      self._stopped = True
+      self._cond.notify_all()
+    return 0
+
+  def getQueueDepth(self, client = None):
+    # callbacks waiting to start, for all devices or a single one
+    with self._cond:
+      if client == None:
+        return self._depth
+      queue = self._queues.get(client)
+      return 0 if queue == None else len(queue)
+
+  def getPeakQueueDepth(self):
+    return self._peakDepth
+
+  def getCompletedCount(self):
+    return self._completed
+
+  def getLag(self):
+    # seconds the oldest waiting callback has been queued
+    with self._cond:
+      oldest = None
+      for queue in self._queues.values():
+        if len(queue) > 0 and (oldest == None or queue[0][0] < oldest):
+          oldest = queue[0][0]
+    return 0 if oldest == None else time.time() - oldest
+
+  def _futureOf(self, client, ret):
+    # future of a handler's return value this executor can run, i.e. a coroutine
+    return None
+
+class _NoLock:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+  def notify_all(self):
+    pass
+
+def _createQueue():
+  # unbounded FIFO. MicroPython's deque is missing or needs a maxlen, a list serves there
+  try:
+    return deque()
+  except TypeError:
+    return []
+
+def _popLeft(queue):
+  return queue.popleft() if hasattr(queue, "popleft") else queue.pop(0)
+
+def _createLock():
+  try:
+    return threading.Lock()
+  except:
+    return _NoLock()
+
+class _Scheduler:
+  # single background thread for all the deferred work (batch linger etc.)
+  def __init__(self):
+    self._heap = []
+    self._counter = 0
+    self._cond = threading.Condition()
+    self._thread = None
+
+  def schedule(self, delay, fn, *args):
+    with self._cond:
+      self._counter = self._counter + 1
+      entry = [time.time() + delay, self._counter, fn, args]
+      heapq.heappush(self._heap, entry)
+      if self._thread == None:
+        self._thread = threading.Thread(target=self._run, name="iotc-scheduler")
+        self._thread.daemon = True
+        self._thread.start()
+      self._cond.notify()
+    return entry
+
+  def cancel(self, entry):
+    if entry != None:
+      entry[2] = None
+
+  def _run(self):
+    while True:
+      with self._cond:
+        while len(self._heap) == 0 or self._heap[0][0] > time.time():
+          self._cond.wait(None if len(self._heap) == 0 else self._heap[0][0] - time.time())
+        entry = heapq.heappop(self._heap)
+
+      if entry[2] != None:
+        try:
+          entry[2](*entry[3])
+        except Exception as e:
+          LOG_IOTC("ERROR: (scheduler) %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, e)
+
+gScheduler = None
+
+def _getScheduler():
+  global gScheduler
+  if gScheduler == None and threading != None and heapq != None:
+    try:
+      gScheduler = _Scheduler()
+    except:
+      return None
+  return gScheduler
 
 def _quote(a, b):
   global gIsMicroPython
-  features = dir(urllib)
   if gIsMicroPython == False and int(sys.version[0]) < 3:
-    return urllib.quote(a, safe=b)
+    return _urllib.quote(a, safe=b)
   else:
-    return urllib.parse.quote(a)
+    return _urllib.quote(a)
+
+gSessionSSLContext = None
+
+def _sessionSSLContext():
+  # => SSLContext subclass, None when the platform has no SSLContext (< 2.7.9)
+  global gSessionSSLContext
+  if gSessionSSLContext == None and hasattr(ssl, 'SSLContext'):
+    class _SessionSSLContext(ssl.SSLContext):
+      # resumes the last TLS session of the host on reconnect (Python 3.6+)
+      def wrap_socket(self, sock, *args, **kwargs):
+        host = kwargs.get("server_hostname")
+        sessions = getattr(self, "_sessions", None)
+        if host != None and sessions != None and host in sessions:
+          kwargs["session"] = sessions[host]
+        return ssl.SSLContext.wrap_socket(self, sock, *args, **kwargs)
+    gSessionSSLContext = _SessionSSLContext
+  return gSessionSSLContext
+
+gSSLContexts = {}
+gSSLContextsLock = _createLock()
+
+def _getSSLContext(certfile, keyfile, cafile = None):
+  # one context per (client cert, key, CA) for the whole process.
+  # the system CA bundle is parsed once instead of per connect
+  key = (certfile, keyfile, cafile)
+  with gSSLContextsLock:
+    if key in gSSLContexts:
+      return gSSLContexts[key]
+
+    context = _sessionSSLContext()(ssl.PROTOCOL_TLSv1_2)
+    context._sessions = {}
+    if cafile != None:
+      context.load_verify_locations(cafile=cafile)
+    else:
+      context.load_default_certs()
+    context.verify_mode = ssl.CERT_REQUIRED # hub and DPS are always verified
+    context.check_hostname = True
+
+    if certfile != None:
+      context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+
+    gSSLContexts[key] = context
+    return context
+
+def _splitEndpoint(endpoint, defaultPort):
+  # "host" or "host:port" => host, port
+  index = endpoint.rfind(':')
+  if index != -1 and endpoint[index + 1:].isdigit():
+    return endpoint[:index], int(endpoint[index + 1:])
+  return endpoint, defaultPort
+
+def _saveTLSSession(sock, host):
+  try:
+    session = sock.session
+    context = sock.context
+  except AttributeError: # not a TLS socket or no session support
+    return
+  if session != None and host != None and getattr(context, "_sessions", None) != None:
+    context._sessions[host] = session
 
 def _get_cert_path():
   file_path = __file__[:len(__file__) - len("__init__.py")]
   # check for .py(c) diff
 
   file_path = file_path[:len(file_path) - 1] if file_path[len(file_path) - 1:] == "_" else file_path
-  LOG_IOTC("- iotc :: _get_cert_path :: " + file_path, IOTLogLevel.IOTC_LOGGING_ALL)
+  LOG_IOTC("- iotc :: _get_cert_path :: %s", IOTLogLevel.IOTC_LOGGING_ALL, file_path)
   return file_path + "baltimore.pem"
 
+class _HTTPSConnectionPool:
+  # keep-alive DPS connections shared by all the devices, per endpoint + client cert
+  def __init__(self, maxSize, idleTimeout):
+    self._maxSize = maxSize
+    self._idleTimeout = idleTimeout
+    self._idle = {}
+    self._lock = _createLock()
+
+  def setOptions(self, maxSize, idleTimeout):
+    self._maxSize = maxSize
+    self._idleTimeout = idleTimeout
+    self.clear()
+
+  def _evict(self, key, now):
+    connections = self._idle.get(key, [])
+    while len(connections) > 0 and connections[0][1] + self._idleTimeout <= now:
+      connections.pop(0)[0].close()
+
+  def acquire(self, key, factory):
+    with self._lock:
+      self._evict(key, time.time())
+      connections = self._idle.get(key)
+      if connections: # most recently used first
+        return connections.pop()[0], True
+    return factory(), False
+
+  def release(self, key, conn):
+    with self._lock:
+      now = time.time()
+      self._evict(key, now)
+      connections = self._idle.setdefault(key, [])
+      if len(connections) < self._maxSize:
+        connections.append((conn, now))
+        return
+    conn.close()
+
+  def clear(self):
+    with self._lock:
+      idle = self._idle
+      self._idle = {}
+    for connections in idle.values():
+      for conn, _ in connections:
+        conn.close()
+
+gHTTPSPool = _HTTPSConnectionPool(8, 60)
+
+def _decodeBody(content, encoding):
+  if encoding == None or len(content) == 0:
+    return content
+  encoding = encoding.strip().lower()
+  if encoding not in ("gzip", "deflate"):
+    return content
+
+  import zlib
+  if encoding == "gzip":
+    return zlib.decompress(content, 16 + zlib.MAX_WBITS)
+  try:
+    return zlib.decompress(content)
+  except zlib.error: # raw deflate stream
+    return zlib.decompress(content, -zlib.MAX_WBITS)
+
 def _doRequest(device, target_url, method, body, headers):
-  conn = http.HTTPSConnection(device._dpsEndPoint, '443', cert_file=device._certfile, key_file=device._keyfile)
+  key = (device._dpsEndPoint, device._certfile, device._keyfile, device._caFile)
+  def connect():
+    host, port = _splitEndpoint(device._dpsEndPoint, 443)
+    if _sessionSSLContext() == None: # Python < 2.7.9
+      return http.HTTPSConnection(host, port, cert_file=device._certfile, key_file=device._keyfile)
+    context = _getSSLContext(device._certfile, device._keyfile, device._caFile)
+    return http.HTTPSConnection(host, port, context=context)
 
   req_headers = {"Content-Type": headers["content-type"],
                    "User-Agent": headers["user-agent"],
                    "Accept": headers["Accept"],
-                   "Accept-Encoding": "gzip, deflate"}
+                   "Accept-Encoding": "gzip, deflate",
+                   "Connection": "keep-alive"}
 
   if "authorization" in headers:
     req_headers["authorization"] = headers["authorization"]
@@ -268,13 +716,28 @@ def _doRequest(device, target_url, method, body, headers):
   if body != None:
     req_headers["Content-Length"] = str(len(body))
 
-  conn.request(method, target_url, body, req_headers)
-
-  response = conn.getresponse()
-  return response.read()
+  while True:
+    conn, reused = gHTTPSPool.acquire(key, connect)
+    try:
+      conn.request(method, target_url, body, req_headers)
+      response = conn.getresponse()
+      content = response.read()
+      if not reused:
+        _saveTLSSession(conn.sock, conn.host)
+    except (http.HTTPException, IOError, OSError):
+      conn.close()
+      if reused: # server has closed the idle connection, try with a fresh one
+        continue
+      raise
+
+    if response.will_close:
+      conn.close()
+    else:
+      gHTTPSPool.release(key, conn)
+    return _decodeBody(content, response.getheader("content-encoding")), response.status, response.getheader("retry-after")
 
-def _request(device, target_url, method, body, headers):
-  content = None
+def _requestDetails(device, target_url, method, body, headers):
+  # => content, http status, retry-after header
   if http != None:
     return _doRequest(device, target_url, method, body, headers)
   else:
@@ -283,7 +746,1230 @@ def _request(device, target_url, method, body, headers):
       sys.exit()
 
     response = urequests.request(method, target_url, data=body, headers=headers)
-    return response.text
+    retryAfter = None
+    if 'headers' in dir(response):
+      for name in response.headers:
+        if name.lower() == "retry-after":
+          retryAfter = response.headers[name]
+    return response.text, response.status_code, retryAfter
+
+def _request(device, target_url, method, body, headers):
+  return _requestDetails(device, target_url, method, body, headers)[0]
+
+def _parseRetryAfter(value):
+  try:
+    return max(0, float(value))
+  except:
+    return None # HTTP-date form is not used by DPS
+
+class _ProvisioningBackoff:
+  # exponential backoff with jitter for DPS polling, bounded by a total deadline
+  INITIAL = 0.25
+  MAXIMUM = 4
+
+  def __init__(self, timeout):
+    self._deadline = time.time() + timeout
+    self._delay = _ProvisioningBackoff.INITIAL
+
+  def next(self, retryAfter = None):
+    # => seconds to wait, None past the deadline. a `Retry-After` only ever makes the wait longer
+    delay = self._delay
+    self._delay = min(self._delay * 2, _ProvisioningBackoff.MAXIMUM)
+    try:
+      import random
+      delay = delay * (0.8 + 0.4 * random.random())
+    except ImportError:
+      pass
+
+    retryAfter = _parseRetryAfter(retryAfter)
+    if retryAfter != None:
+      delay = max(delay, retryAfter)
+
+    remaining = self._deadline - time.time()
+    if remaining <= 0:
+      return None
+    return min(delay, remaining)
+
+IOTC_MAX_MESSAGE_SIZE = 262144 # IoT Hub device-to-cloud message limit
+
+class IOTEncoder:
+  # serializes dict / list telemetry. subclass it for a custom format, the
+  # content type / encoding are sent as the `$.ct` / `$.ce` system properties
+  def __init__(self, contentType, contentEncoding = None):
+    self.contentType = contentType
+    self.contentEncoding = contentEncoding
+    self.isJSON = contentType == "application/json"
+    self.topicProperties = "$.ct=" + _topicValue(contentType)
+    if contentEncoding != None:
+      self.topicProperties = self.topicProperties + "&$.ce=" + _topicValue(contentEncoding)
+
+  def encode(self, value):
+    raise NotImplementedError()
+
+def _topicValue(value):
+  # enough of percent encoding for content types
+  for char, escaped in (("%", "%25"), ("/", "%2F"), ("+", "%2B"), ("&", "%26"), ("=", "%3D"), (" ", "%20"), (";", "%3B")):
+    value = value.replace(char, escaped)
+  return value
+
+class _JSONEncoder(IOTEncoder):
+  def __init__(self):
+    IOTEncoder.__init__(self, "application/json", "utf-8")
+
+  def encode(self, value):
+    return json.dumps(value)
+
+class _ORJSONEncoder(IOTEncoder):
+  def __init__(self):
+    IOTEncoder.__init__(self, "application/json", "utf-8")
+    self._orjson = _importModule(("orjson",), "orjson")
+
+  def encode(self, value):
+    return self._orjson.dumps(value)
+
+class _MsgPackEncoder(IOTEncoder):
+  def __init__(self):
+    IOTEncoder.__init__(self, "application/x-msgpack")
+    self._msgpack = _importModule(("msgpack",), "msgpack")
+
+  def encode(self, value):
+    return self._msgpack.packb(value, use_bin_type=True)
+
+def _createEncoder(encoding):
+  if encoding == IOTEncoding.IOTC_ENCODING_JSON:
+    return _JSONEncoder()
+  if encoding == IOTEncoding.IOTC_ENCODING_ORJSON:
+    return _ORJSONEncoder()
+  if encoding == IOTEncoding.IOTC_ENCODING_MSGPACK:
+    return _MsgPackEncoder()
+  return None
+
+gJSONEncoder = _JSONEncoder()
+
+def _payloadBuffer(data):
+  # paho takes bytes / bytearray but not memoryview. a view of a whole bytes
+  # object is unwrapped, other views are copied once
+  try:
+    source = data.obj
+    if isinstance(source, (bytes, bytearray)) and data.contiguous and data.nbytes == len(source):
+      return source
+  except AttributeError:
+    pass
+  return bytes(data)
+
+def _isBinary(data):
+  return isinstance(data, bytearray) or (bytes is not str and isinstance(data, bytes))
+
+def _byteLength(data):
+  try:
+    return len(data.encode('utf-8'))
+  except:
+    return len(data)
+
+class _BatchedPayloads(list):
+  pass
+
+class _TelemetryBatch:
+  def __init__(self, maxMessages, maxBytes, lingerMs):
+    self._maxMessages = maxMessages
+    self._maxBytes = maxBytes
+    self._linger = lingerMs / 1000.0
+    self._topic = None
+    self._payloads = []
+    self._size = 2 # [ ]
+    self._deadline = None
+    self._timer = None
+    self._lock = _createLock()
+
+  def _take(self, ready):
+    if len(self._payloads) > 0:
+      ready.append((self._topic, self._payloads))
+    if self._timer != None:
+      gScheduler.cancel(self._timer)
+    self._topic = None
+    self._payloads = []
+    self._size = 2
+    self._deadline = None
+    self._timer = None
+
+  def add(self, device, topic, data):
+    size = _byteLength(data)
+    ready = []
+    with self._lock:
+      if len(self._payloads) > 0 and (topic != self._topic or self._size + size + 1 > self._maxBytes):
+        self._take(ready)
+
+      if size + 2 > self._maxBytes: # too large to batch, send as is
+        ready.append((topic, data))
+      else:
+        if len(self._payloads) == 0:
+          self._topic = topic
+          self._deadline = time.time() + self._linger
+          if _getScheduler() != None:
+            self._timer = gScheduler.schedule(self._linger, self.flushIfDue, device)
+        self._payloads.append(data)
+        self._size = self._size + size + (1 if len(self._payloads) > 1 else 0)
+        if len(self._payloads) >= self._maxMessages:
+          self._take(ready)
+
+    return self._send(device, ready)
+
+  def flush(self, device):
+    ready = []
+    with self._lock:
+      self._take(ready)
+    return self._send(device, ready)
+
+  def flushIfDue(self, device):
+    if self._deadline != None and self._deadline <= time.time():
+      return self.flush(device)
+    return 0
+
+  def _send(self, device, ready):
+    ret = 0
+    for topic, payloads in ready: # a list is a batch
+      ret = ret | device._sendTelemetryMessage(topic, payloads)
+    return ret
+
+def _composePatch(combined, patch):
+  # `combined` becomes one merge patch equal to applying it and then `patch`.
+  # unlike `_mergePatch`, a `None` is kept so the removal reaches the hub
+  for key, value in patch.items():
+    if isinstance(value, dict) and isinstance(combined.get(key), dict):
+      _composePatch(combined[key], value)
+    else:
+      combined[key] = _copyValue(value)
+
+class _ReportedCoalescer:
+  # merges reported property patches written within `windowMs` into one PATCH.
+  # MessageSent fires for each original payload
+  def __init__(self, windowMs):
+    self._window = windowMs / 1000.0
+    self._patch = None
+    self._payloads = []
+    self._deadline = None
+    self._timer = None
+    self._lock = _createLock()
+
+  def _take(self):
+    taken = None
+    if self._patch != None:
+      taken = (self._patch, self._payloads)
+    if self._timer != None:
+      gScheduler.cancel(self._timer)
+    self._patch = None
+    self._payloads = []
+    self._deadline = None
+    self._timer = None
+    return taken
+
+  def add(self, device, data, patch):
+    with self._lock:
+      if self._patch == None:
+        self._patch = {}
+        self._deadline = time.time() + self._window
+        if _getScheduler() != None:
+          self._timer = gScheduler.schedule(self._window, self.flushIfDue, device)
+      _composePatch(self._patch, patch) # last writer wins per property
+      self._payloads.append(data)
+    return 0
+
+  def flush(self, device):
+    with self._lock:
+      taken = self._take()
+    if taken == None:
+      return 0
+    patch, payloads = taken
+    return device._sendReported(device._encodeReported(patch)[0], patch, None, _BatchedPayloads(payloads))
+
+  def flushIfDue(self, device):
+    if self._deadline != None and self._deadline <= time.time():
+      return self.flush(device)
+    return 0
+
+class _Histogram:
+  # fixed buckets, `counts[i]` is the number of samples <= `bounds[i]`, the last one is +Inf
+  __slots__ = ("bounds", "counts", "count", "sum")
+
+  def __init__(self, bounds):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    if bisect_left != None:
+      index = bisect_left(self.bounds, value)
+    else:
+      index = 0
+      for bound in self.bounds:
+        if value <= bound:
+          break
+        index = index + 1
+    self.counts[index] = self.counts[index] + 1
+    self.count = self.count + 1
+    self.sum = self.sum + value
+
+  def merge(self, other):
+    # same buckets; used for the fleet totals
+    for index, count in enumerate(other["counts"]):
+      self.counts[index] = self.counts[index] + count
+    self.count = self.count + other["count"]
+    self.sum = self.sum + other["sum"]
+
+  def snapshot(self):
+    return {"bounds": list(self.bounds), "counts": list(self.counts), "count": self.count, "sum": self.sum}
+
+# seconds
+gLATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+gPROVISIONING_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+
+class _DeviceMetrics:
+  # plain counters updated on the paths that already run, no per sample storage.
+  # writers are the caller's thread and the network thread, each counter has mostly one of them
+  COUNTERS = ("messagesSent", "messagesAcked", "messagesFailed", "bytesOut", "messagesReceived", "bytesIn",
+    "connects", "reconnects", "disconnects", "provisioned", "provisioningFailed", "commandsHandled", "commandsTimedOut")
+
+  def __init__(self):
+    for name in _DeviceMetrics.COUNTERS:
+      setattr(self, name, 0)
+    self.publishLatency = _Histogram(gLATENCY_BUCKETS)
+    self.provisioningTime = _Histogram(gPROVISIONING_BUCKETS)
+
+  def published(self, data):
+    self.messagesSent = self.messagesSent + 1
+    if data != None: # bytes on the wire, not characters
+      self.bytesOut = self.bytesOut + _byteLength(data)
+
+  def received(self, payload):
+    self.messagesReceived = self.messagesReceived + 1
+    if payload != None:
+      self.bytesIn = self.bytesIn + len(payload)
+
+  def snapshot(self):
+    stats = dict((name, getattr(self, name)) for name in _DeviceMetrics.COUNTERS)
+    stats["publishLatency"] = self.publishLatency.snapshot()
+    stats["provisioningTime"] = self.provisioningTime.snapshot()
+    return stats
+
+def _mergeStats(statsList):
+  # => totals of `getStats()` results (counters are added, histograms merged)
+  total = _DeviceMetrics()
+  totals = total.snapshot()
+  for stats in statsList:
+    for name, value in stats.items():
+      if isinstance(value, dict):
+        histogram = getattr(total, name)
+        histogram.merge(value)
+        totals[name] = histogram.snapshot()
+      else:
+        totals[name] = totals.get(name, 0) + value
+  return totals
+
+gPROMETHEUS_METRICS = {
+  "messagesSent": ("counter", "MQTT messages published"),
+  "messagesAcked": ("counter", "published messages acknowledged by the hub"),
+  "messagesFailed": ("counter", "messages failed to publish or not acknowledged in time"),
+  "bytesOut": ("counter", "published payload bytes"),
+  "messagesReceived": ("counter", "MQTT messages received"),
+  "bytesIn": ("counter", "received payload bytes"),
+  "inFlight": ("gauge", "messages waiting for acknowledgement"),
+  "connected": ("gauge", "connected devices"),
+  "devices": ("gauge", "devices"),
+  "connects": ("counter", "successful MQTT connects"),
+  "reconnects": ("counter", "successful MQTT connects after the first one"),
+  "disconnects": ("counter", "MQTT disconnects"),
+  "provisioned": ("counter", "successful DPS provisionings"),
+  "provisioningFailed": ("counter", "failed DPS provisionings"),
+  "commandsHandled": ("counter", "direct methods answered"),
+  "commandsTimedOut": ("counter", "direct methods answered with 504 after their deadline"),
+  "publishLatency": ("histogram", "publish to PUBACK latency in seconds"),
+  "provisioningTime": ("histogram", "DPS provisioning time in seconds")
+}
+
+def _metricName(name):
+  snake = ""
+  for char in name:
+    snake += "_" + char.lower() if char.isupper() else char
+  return "iotc_" + snake
+
+def _formatLabels(labels, extra = None):
+  pairs = []
+  if labels != None:
+    for key in sorted(labels):
+      value = str(labels[key]).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+      pairs.append('{}="{}"'.format(key, value))
+  if extra != None:
+    pairs.append(extra)
+  return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+def formatPrometheus(stats, labels = None):
+  # => Prometheus text exposition (0.0.4) of a `getStats()` result. `stats` may be
+  # a list of (labels, stats) pairs, i.e. one entry per device
+  series = [(labels, stats)] if isinstance(stats, dict) else stats
+  lines = []
+  for name in sorted(gPROMETHEUS_METRICS):
+    samples = [(labels, stats[name]) for labels, stats in series if name in stats]
+    if len(samples) == 0:
+      continue
+    kind, text = gPROMETHEUS_METRICS[name]
+    metric = _metricName(name)
+    if kind == "counter":
+      metric = metric + "_total"
+    lines.append("# HELP {} {}".format(metric, text))
+    lines.append("# TYPE {} {}".format(metric, kind))
+    for labels, value in samples:
+      if kind != "histogram":
+        lines.append("{}{} {}".format(metric, _formatLabels(labels), value))
+        continue
+      cumulative = 0
+      for index, count in enumerate(value["counts"]):
+        cumulative = cumulative + count
+        bound = repr(float(value["bounds"][index])) if index < len(value["bounds"]) else "+Inf"
+        lines.append("{}_bucket{} {}".format(metric, _formatLabels(labels, 'le="{}"'.format(bound)), cumulative))
+      lines.append("{}_sum{} {}".format(metric, _formatLabels(labels), repr(float(value["sum"]))))
+      lines.append("{}_count{} {}".format(metric, _formatLabels(labels), value["count"]))
+  return "\n".join(lines) + "\n"
+
+class _InFlightMessage:
+  __slots__ = ("msgid", "payload", "sent", "tag")
+
+  def __init__(self, msgid, payload, sent, tag):
+    self.msgid = msgid
+    self.payload = payload # None for internal publishes (no events)
+    self.sent = sent
+    self.tag = tag
+
+class _InsertionOrderedDict:
+  # the parts of OrderedDict `_InFlightTracker` uses, for ports without it (MicroPython)
+  def __init__(self):
+    self._values = {}
+    self._keys = []
+
+  def __len__(self):
+    return len(self._values)
+
+  def __iter__(self):
+    return iter(self._keys)
+
+  def __getitem__(self, key):
+    return self._values[key]
+
+  def __setitem__(self, key, value):
+    if not key in self._values:
+      self._keys.append(key)
+    self._values[key] = value
+
+  def pop(self, key, *default):
+    if key in self._values:
+      self._keys.remove(key)
+      return self._values.pop(key)
+    if len(default) > 0:
+      return default[0]
+    raise KeyError(key)
+
+class _InFlightTracker:
+  # unacknowledged publishes by msgid, in send order. acks and expiry are O(1)
+  EARLY_ACK_WINDOW = 5 # `on_publish` may fire before `publish()` returns the msgid
+
+  def __init__(self, maxMessages, timeout):
+    self.maxMessages = maxMessages
+    self.timeout = timeout
+    self._records = OrderedDict() if OrderedDict != None else _InsertionOrderedDict()
+    self._early = {}
+    self._messages = 0 # records with a payload, internal publishes don't count
+    self._lock = _createLock()
+
+  def __len__(self):
+    return self._messages
+
+  def isFull(self):
+    return self._messages >= self.maxMessages
+
+  def _removed(self, record):
+    if record != None and record.payload != None:
+      self._messages = self._messages - 1
+    return record
+
+  def add(self, msgid, payload, tag = None):
+    # => (record if it was acked already, record replaced by a msgid wrap-around)
+    now = time.time()
+    record = _InFlightMessage(msgid, payload, now, tag)
+    with self._lock:
+      acked = self._early.pop(msgid, None)
+      if acked != None and now - acked < _InFlightTracker.EARLY_ACK_WINDOW:
+        return record, None
+      replaced = self._removed(self._records.pop(msgid, None))
+      self._records[msgid] = record
+      if payload != None:
+        self._messages = self._messages + 1
+    return None, replaced
+
+  def ack(self, msgid):
+    with self._lock:
+      record = self._removed(self._records.pop(msgid, None))
+      if record == None:
+        self._early[msgid] = time.time()
+    return record
+
+  def expire(self, now = None):
+    # => records past their ack timeout, oldest first
+    if now == None:
+      now = time.time()
+    expired = []
+    with self._lock:
+      sentBefore = now - self.timeout
+      while len(self._records) > 0:
+        msgid = next(iter(self._records))
+        if self._records[msgid].sent > sentBefore:
+          break
+        expired.append(self._removed(self._records.pop(msgid)))
+
+      if len(self._early) > 0: # acks of already expired messages
+        for msgid in [msgid for msgid in self._early if now - self._early[msgid] >= _InFlightTracker.EARLY_ACK_WINDOW]:
+          del self._early[msgid]
+    return expired
+
+  def nextDeadline(self):
+    with self._lock:
+      if len(self._records) == 0:
+        return None
+      return self._records[next(iter(self._records))].sent + self.timeout
+
+class _MemoryQueueStore:
+  def __init__(self):
+    self._items = deque()
+
+  def __len__(self):
+    return len(self._items)
+
+  def push(self, item):
+    self._items.append(item)
+
+  def peek(self):
+    return self._items[0] if len(self._items) > 0 else None
+
+  def pop(self):
+    self._items.popleft()
+
+class _FileQueueStore:
+  # append-only segment log. record => [state:1][length:4][json [topic, data]]
+  # consumed records are flagged in place, the file is truncated / compacted
+  # once the consumed head grows. only the head offset and count live in memory.
+  COMPACT_SIZE = 4 * 1024 * 1024
+
+  def __init__(self, path):
+    import os
+    self._os = os
+    self._path = path
+    if not os.path.exists(path):
+      open(path, 'wb').close()
+    self._file = open(path, 'r+b')
+    self._head = 0
+    self._count = 0
+    self._end = 0
+    self._cached = None
+    self._scan()
+
+  def _readHeader(self, offset):
+    self._file.seek(offset)
+    header = self._file.read(5)
+    if len(header) < 5:
+      return None, None
+    return header[0:1], (ord(header[1:2]) << 24) | (ord(header[2:3]) << 16) | (ord(header[3:4]) << 8) | ord(header[4:5])
+
+  def _scan(self):
+    self._file.seek(0, 2)
+    size = self._file.tell()
+    offset = 0
+    self._head = None
+    while True:
+      state, length = self._readHeader(offset)
+      if state == None or offset + 5 + length > size:
+        break # partial write at the tail
+      if state == b'\x01':
+        if self._head == None:
+          self._head = offset
+        self._count = self._count + 1
+      offset = offset + 5 + length
+
+    self._end = offset
+    self._file.truncate(offset)
+    if self._head == None:
+      self._head = offset
+    if self._count > 0:
+      LOG_IOTC("- iotc :: outbound queue :: %d messages restored from %s", IOTLogLevel.IOTC_LOGGING_ALL, self._count, self._path)
+
+  def __len__(self):
+    return self._count
+
+  def push(self, item):
+    if _isBinary(item[1]): # [topic, base64, 1]
+      item = [item[0], base64.b64encode(bytes(item[1])).decode('ascii'), 1]
+    data = json.dumps(item).encode('utf-8')
+    length = len(data)
+    self._file.seek(self._end)
+    self._file.write(b'\x01' + bytes(bytearray([(length >> 24) & 255, (length >> 16) & 255, (length >> 8) & 255, length & 255])) + data)
+    self._file.flush()
+    self._end = self._end + 5 + length
+    self._count = self._count + 1
+
+  def peek(self):
+    if self._count == 0:
+      return None
+    if self._cached == None:
+      state, length = self._readHeader(self._head)
+      item = json.loads(self._file.read(length).decode('utf-8'))
+      if len(item) > 2:
+        item = [item[0], base64.b64decode(item[1])]
+      self._cached = (item, length)
+    return self._cached[0]
+
+  def pop(self):
+    if self._count == 0:
+      return
+    if self._cached == None:
+      self.peek()
+    self._file.seek(self._head)
+    self._file.write(b'\x00')
+    self._head = self._head + 5 + self._cached[1]
+    self._cached = None
+    self._count = self._count - 1
+
+    if self._count == 0:
+      self._file.truncate(0)
+      self._head = 0
+      self._end = 0
+    elif self._head > _FileQueueStore.COMPACT_SIZE and self._head > self._end / 2:
+      self._compact()
+    self._file.flush()
+
+  def _compact(self):
+    self._file.seek(self._head)
+    temp = self._path + ".tmp"
+    with open(temp, 'wb') as fh:
+      while True:
+        chunk = self._file.read(65536)
+        if not chunk:
+          break
+        fh.write(chunk)
+    self._file.close()
+    self._os.rename(temp, self._path)
+    self._file = open(self._path, 'r+b')
+    self._end = self._end - self._head
+    self._head = 0
+
+class _OutboundQueue:
+  TICK = 0.1
+
+  def __init__(self, store, maxMessages, policy, replayRate, blockTimeout):
+    self._store = store
+    self._maxMessages = maxMessages
+    self._policy = policy
+    self._replayRate = replayRate
+    self._blockTimeout = blockTimeout
+    self._cond = threading.Condition() if threading != None else _NoLock()
+    self._draining = False
+
+  def __len__(self):
+    return len(self._store)
+
+  def send(self, device, topic, data):
+    with self._cond:
+      if len(self._store) == 0 and device._isLinkUp():
+        if device._publishTelemetry(topic, data) == 0:
+          return 0
+      ret = self._put([topic, data])
+
+    self.resume(device)
+    return ret
+
+  def _put(self, item):
+    if len(self._store) >= self._maxMessages:
+      if self._policy == IOTOverflowPolicy.IOTC_OVERFLOW_DROP_NEWEST:
+        LOG_IOTC("WARNING: outbound queue is full. dropping the new message.")
+        return 1
+      elif self._policy == IOTOverflowPolicy.IOTC_OVERFLOW_DROP_OLDEST:
+        LOG_IOTC("WARNING: outbound queue is full. dropping the oldest message.")
+        self._store.pop()
+      else:
+        deadline = None if self._blockTimeout == None else time.time() + self._blockTimeout
+        while len(self._store) >= self._maxMessages:
+          if deadline != None and deadline <= time.time():
+            LOG_IOTC("WARNING: outbound queue is full. timed out waiting for space.")
+            return 1
+          self._cond.wait(None if deadline == None else deadline - time.time())
+    self._store.push(item)
+    return 0
+
+  def resume(self, device):
+    with self._cond:
+      if self._draining or len(self._store) == 0 or not device._isLinkUp() or _getScheduler() == None:
+        return
+      self._draining = True
+    gScheduler.schedule(0, self._drainTick, device)
+
+  def _drainTick(self, device):
+    self.drain(device)
+    with self._cond:
+      if len(self._store) == 0 or not device._isLinkUp():
+        self._draining = False
+        return
+    gScheduler.schedule(_OutboundQueue.TICK, self._drainTick, device)
+
+  def drain(self, device):
+    budget = max(1, int(self._replayRate * _OutboundQueue.TICK))
+    with self._cond:
+      while budget > 0 and len(self._store) > 0 and device._isLinkUp():
+        item = self._store.peek()
+        if device._publishTelemetry(item[0], item[1]) != 0:
+          break
+        self._store.pop()
+        budget = budget - 1
+      self._cond.notify_all()
+      return len(self._store)
+
+class _ProvisioningCache:
+  # DPS assignments (hub host names) keyed by endpoint / scope / device / model
+  def __init__(self, path):
+    self._path = path
+    self._entries = {}
+    self._lock = _createLock()
+    self._saveScheduled = False
+    if path != None:
+      self._load()
+
+  def _load(self):
+    try:
+      with open(self._path, "r") as fh:
+        self._entries = json.loads(fh.read())
+    except (IOError, OSError):
+      self._entries = {}
+    except Exception as e:
+      LOG_IOTC("WARNING: provisioning cache `%s` is not readable => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, self._path, e)
+      self._entries = {}
+
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry == None:
+        return None
+      if entry["expires"] <= time.time():
+        del self._entries[key]
+        return None
+      return entry["hostName"]
+
+  def put(self, key, hostName, ttl):
+    with self._lock:
+      self._entries[key] = { "hostName": hostName, "expires": int(time.time() + ttl) }
+    self._changed()
+
+  def remove(self, key):
+    with self._lock:
+      if not key in self._entries:
+        return
+      del self._entries[key]
+    self._changed()
+
+  def _changed(self):
+    if self._path == None:
+      return
+    if _getScheduler() == None:
+      return self.save()
+    with self._lock: # coalesce the writes from many devices
+      if self._saveScheduled:
+        return
+      self._saveScheduled = True
+    gScheduler.schedule(1, self.save)
+
+  def save(self):
+    import os
+    with self._lock:
+      self._saveScheduled = False
+      now = time.time()
+      entries = dict((key, entry) for key, entry in self._entries.items() if entry["expires"] > now)
+    temp = self._path + ".tmp"
+    try:
+      with open(temp, "w") as fh:
+        fh.write(json.dumps(entries))
+      if 'replace' in dir(os):
+        os.replace(temp, self._path)
+      else:
+        os.rename(temp, self._path)
+    except Exception as e:
+      LOG_IOTC("WARNING: unable to write the provisioning cache `%s` => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, self._path, e)
+
+gProvisioningCaches = {}
+
+def _getProvisioningCache(path):
+  if not path in gProvisioningCaches:
+    gProvisioningCaches[path] = _ProvisioningCache(path)
+  return gProvisioningCaches[path]
+
+gSignatureLock = _createLock()
+
+class SymmetricKey:
+  # base64 secret is decoded and the HMAC-SHA256 state is prepared once. signatures
+  # are memoized per message (uri + expiry) in a bounded LRU
+  def __init__(self, secret, cacheSize = 256):
+    self._cacheSize = cacheSize if OrderedDict != None else 0
+    self._signatures = None
+    self._raw = None
+    self._hmac = None
+    if secret != None:
+      self._raw = base64.b64decode(secret)
+
+  def _digest(self, message):
+    data = message.encode('utf8')
+    if self._hmac == None: # prepared on first use, derived keys are often never used for signing
+      self._hmac = hmac.new(self._raw, digestmod=_sha256())
+    try:
+      mac = self._hmac.copy()
+    except AttributeError: # micropython-hmac has no copy
+      return hmac.new(self._raw, msg=data, digestmod=_sha256()).digest()
+    mac.update(data)
+    return mac.digest()
+
+  def sign(self, message):
+    if self._cacheSize <= 0:
+      return base64.b64encode(self._digest(message))
+
+    with gSignatureLock:
+      if self._signatures == None:
+        self._signatures = OrderedDict()
+      signature = self._signatures.pop(message, None)
+      if signature == None:
+        signature = base64.b64encode(self._digest(message))
+        if len(self._signatures) >= self._cacheSize:
+          self._signatures.popitem(last=False)
+      self._signatures[message] = signature
+    return signature
+
+  def derive(self, registrationId):
+    key = SymmetricKey(None, self._cacheSize)
+    key._raw = self._digest(registrationId)
+    return key
+
+  def deriveMany(self, registrationIds):
+    keys = {}
+    for registrationId in registrationIds:
+      keys[registrationId] = self.derive(registrationId)
+    return keys
+
+  def __str__(self):
+    return base64.b64encode(self._raw).decode('utf8')
+
+def _sha256():
+  if gIsMicroPython == False:
+    return hashlib.sha256
+  return hashlib._sha256.sha256
+
+def _copyValue(value):
+  # JSON values only, cheaper than a dumps / loads round trip
+  if isinstance(value, dict):
+    return dict((key, _copyValue(item)) for key, item in value.items())
+  if isinstance(value, list):
+    return [_copyValue(item) for item in value]
+  return value
+
+def _mergePatch(target, patch):
+  # JSON merge patch (RFC 7386), `None` removes the key
+  for key, value in patch.items():
+    if value == None:
+      target.pop(key, None)
+    elif isinstance(value, dict) and isinstance(target.get(key), dict):
+      _mergePatch(target[key], value)
+    else:
+      target[key] = _copyValue(value)
+
+def _payloadText(payload):
+  if payload == None:
+    return None
+  try:
+    return payload.decode("utf-8")
+  except:
+    return str(payload)
+
+def _loadJSON(payload):
+  if isinstance(payload, bytes):
+    payload = payload.decode("utf-8")
+  return json.loads(payload)
+
+class IOTMessage(IOTCallbackInfo):
+  # inbound MQTT message. the payload stays bytes until getText / getJSON
+  def __init__(self, client, topic, payload, captures, query = None):
+    IOTCallbackInfo.__init__(self, client, "Message", payload, topic, 0, None)
+    self._captures = captures
+    self._query = query # parsed on first use
+    self._text = None
+
+  def getTopic(self):
+    return self._tag
+
+  def getText(self):
+    if self._text == None and self._payload != None:
+      self._text = _payloadText(self._payload)
+    return self._text
+
+  def getJSON(self):
+    return json.loads(self.getText())
+
+  def getCapture(self, name):
+    # `{name}` segments of the route, `#` for the rest of the topic and query
+    # string values, i.e. `$rid`, `$version`
+    value = self._captures.get(name)
+    if value == None and self._query != None:
+      if not isinstance(self._query, dict):
+        self._query = _parseQuery(self._query)
+      value = self._query.get(name)
+    return value
+
+  def getCaptures(self):
+    captures = dict(self._captures)
+    if self._query != None:
+      if not isinstance(self._query, dict):
+        self._query = _parseQuery(self._query)
+      captures.update(self._query)
+    return captures
+
+def _parseQuery(query):
+  values = {}
+  for pair in query.split('&'):
+    separator = pair.find('=')
+    if separator != -1:
+      values[pair[:separator]] = pair[separator + 1:]
+  return values
+
+class _RouteNode:
+  def __init__(self):
+    self.children = {}
+    self.capture = None # (name, node) for a `{name}` segment
+    self.rest = None # handler of a trailing `#`
+    self.handler = None
+
+class _TopicRouter:
+  # prefix trie over the `/` separated segments of the topic (before `?`).
+  # pattern segments are literals, `{name}` (one segment) or a trailing `#`.
+  # literal segments win over captures
+  def __init__(self, cacheSize = 64):
+    self._root = _RouteNode()
+    self._cache = {} # path -> (handler, captures) of recently matched topics
+    self._cacheSize = cacheSize
+
+  def add(self, pattern, handler):
+    self._cache = {}
+    node = self._root
+    for segment in pattern.split('/'):
+      if segment == '#':
+        node.rest = handler
+        return
+      if segment.startswith('{') and segment.endswith('}'):
+        if node.capture == None or node.capture[0] != segment[1:-1]:
+          node.capture = (segment[1:-1], _RouteNode())
+        node = node.capture[1]
+      else:
+        child = node.children.get(segment)
+        if child == None:
+          child = _RouteNode()
+          node.children[segment] = child
+        node = child
+    node.handler = handler
+
+  def match(self, path):
+    # path is the topic before `?` => handler, captures or None, None
+    # captures are shared between matches of the same path, do not modify
+    cached = self._cache.get(path)
+    if cached != None:
+      return cached
+    captures = {}
+    handler = self._match(path.split('/'), captures)
+    if handler == None:
+      return None, None
+    if len(self._cache) >= self._cacheSize:
+      self._cache = {}
+    self._cache[path] = (handler, captures)
+    return handler, captures
+
+  def _match(self, segments, captures):
+    # iterative walk, literal segment -> `{name}` -> `#`. skipped alternatives
+    # are kept on a stack, topics without any never allocate it
+    count = len(segments)
+    pending = None
+    bound = [] # (index, name) of the captures on the current path
+    node = self._root
+    index = 0
+    step = 0 # 0: literal, 1: capture, 2: rest
+    while True:
+      if step == 0:
+        if index == count:
+          if node.handler != None:
+            handler = node.handler
+            break
+          step = 2
+        else:
+          child = node.children.get(segments[index])
+          if child != None:
+            if node.capture != None or node.rest != None:
+              if pending == None:
+                pending = []
+              pending.append((node, index, len(bound), 1))
+            node = child
+            index = index + 1
+            continue
+          step = 1
+      if step == 1:
+        if node.capture != None:
+          if node.rest != None:
+            if pending == None:
+              pending = []
+            pending.append((node, index, len(bound), 2))
+          bound.append((index, node.capture[0]))
+          node = node.capture[1]
+          index = index + 1
+          step = 0
+          continue
+        step = 2
+      if node.rest != None:
+        captures['#'] = '/'.join(segments[index:])
+        handler = node.rest
+        break
+      if not pending:
+        return None
+      node, index, depth, step = pending.pop()
+      del bound[depth:]
+
+    for position, name in bound:
+      captures[name] = segments[position]
+    return handler
+
+def _routeFilter(pattern):
+  # MQTT subscription filter of a route pattern
+  return '/'.join('+' if segment.startswith('{') and segment.endswith('}') else segment for segment in pattern.split('/'))
+
+class _TwinCache:
+  # local copy of the device twin. desired state follows the hub's `$version`
+  # tagged patches, reported state is updated once the hub accepts our patch
+  def __init__(self):
+    self.desired = {}
+    self.desiredVersion = None
+    self.reported = {}
+    self.reportedVersion = None
+    self._pending = {} # rid -> reported patch waiting for the hub's response
+    self._lock = _createLock()
+
+  def _properties(self, section):
+    return dict((key, value) for key, value in section.items() if not key.startswith('$'))
+
+  def setDocument(self, twin):
+    with self._lock:
+      if isinstance(twin.get('desired'), dict):
+        self.desired = self._properties(twin['desired'])
+        self.desiredVersion = twin['desired'].get('$version')
+      if isinstance(twin.get('reported'), dict):
+        self.reported = self._properties(twin['reported'])
+        self.reportedVersion = twin['reported'].get('$version')
+
+  def patchDesired(self, patch):
+    # => False when the cache already has this version (redelivered / older patch)
+    version = patch.get('$version')
+    with self._lock:
+      if version != None and self.desiredVersion != None and version <= self.desiredVersion:
+        return False
+      _mergePatch(self.desired, self._properties(patch))
+      self.desiredVersion = version
+    return True
+
+  def reportedDelta(self, properties):
+    # => the properties that differ from the last acknowledged reported state
+    with self._lock:
+      return dict((key, value) for key, value in properties.items() if self.reported.get(key) != value)
+
+  def addPending(self, rid, patch):
+    with self._lock:
+      self._pending[rid] = _copyValue(patch)
+
+  def acknowledge(self, rid, version):
+    with self._lock:
+      patch = self._pending.pop(rid, None)
+      if patch != None:
+        _mergePatch(self.reported, patch)
+        if version != None:
+          self.reportedVersion = version
+
+  def reject(self, rid):
+    with self._lock:
+      self._pending.pop(rid, None)
+
+  def clearPending(self):
+    with self._lock:
+      self._pending = {}
+
+  def toDict(self):
+    with self._lock:
+      desired = _copyValue(self.desired)
+      desired['$version'] = self.desiredVersion
+      reported = _copyValue(self.reported)
+      reported['$version'] = self.reportedVersion
+    return { "desired": desired, "reported": reported }
+
+class IOTTwinRequest:
+  # twin GET / reported PATCH waiting for the hub's response (matched by `$rid`).
+  # completes with the response or with an error (timeout, publish failure, lost connection)
+  def __init__(self, device, rid, notify):
+    self._device = device
+    self._rid = rid
+    self._notify = notify # GET response fires SettingsUpdated (getDeviceSettings)
+    self._status = None
+    self._body = None
+    self._version = None
+    self._error = None
+    self._done = False
+    self._deadline = None
+    self._timer = None
+    self._callbacks = []
+    self._lock = _createLock() # `_done` and `_callbacks`, the network thread completes while callers add
+    self._event = threading.Event() if threading != None else None
+
+  def _complete(self, status, body, version, error):
+    self._status = status
+    self._body = body
+    self._version = version
+    self._error = error
+    with self._lock:
+      self._done = True
+      callbacks = self._callbacks
+      self._callbacks = []
+    if self._event != None:
+      self._event.set()
+    for callback in callbacks:
+      callback(self)
+
+  def done(self):
+    return self._done
+
+  def wait(self, timeout = None):
+    # => True when the request has completed
+    if self._event != None:
+      self._event.wait(timeout)
+      return self._done
+
+    deadline = None if timeout == None else time.time() + timeout
+    while not self._done and (deadline == None or time.time() < deadline):
+      self._device.doNext(0.01) # umqtt receives in doNext
+    return self._done
+
+  def addDoneCallback(self, callback):
+    # `callback(request)` runs on the network thread, or right away when done
+    with self._lock:
+      if not self._done:
+        self._callbacks.append(callback)
+        return
+    callback(self)
+
+  def getRequestId(self):
+    return self._rid
+
+  def getStatusCode(self):
+    return self._status
+
+  def getBody(self):
+    return self._body
+
+  def getVersion(self):
+    return self._version
+
+  def getError(self):
+    return self._error
+
+  def isSuccess(self):
+    return self._error == None and self._status != None and self._status >= 200 and self._status < 300
+
+class IOTCommandResponder:
+  # answers one direct method, now or later and from any thread. the first
+  # response wins; once the method's deadline passes a 504 is sent for it
+  def __init__(self, device, rid, methodName, deadline):
+    self._device = device
+    self._rid = rid
+    self._methodName = methodName
+    self._deadline = deadline
+    self._timer = None
+    self._started = False # holds a concurrent command slot
+    self._done = False
+    self._lock = _createLock()
+
+  def respond(self, responseCode = 200, responseMessage = None):
+    # => 0 sent, 1 already answered (or timed out) or failed to send
+    with self._lock:
+      if self._done:
+        return 1
+      self._done = True
+    if responseCode == None:
+      responseCode = 200
+    if responseMessage == None:
+      responseMessage = "{}"
+    elif not isinstance(responseMessage, str) and not isinstance(responseMessage, bytes):
+      responseMessage = json.dumps(responseMessage)
+    return self._device._finishCommand(self, responseCode, responseMessage)
+
+  def isDone(self):
+    return self._done
+
+  def getRequestId(self):
+    return self._rid
+
+  def getMethodName(self):
+    return self._methodName
+
+  def getDeadline(self):
+    return self._deadline
+
+class IOTCommandInfo(IOTCallbackInfo):
+  # `Command` callback info. the handler answers by returning (`setResponse`),
+  # by returning a future / coroutine or by calling `defer()` and answering later
+  def __init__(self, client, payload, methodName, responder):
+    IOTCallbackInfo.__init__(self, client, "Command", payload, methodName, 0, None)
+    self._responder = responder
+    self._deferred = False
+
+  def defer(self):
+    # => IOTCommandResponder. the response is no longer sent when the handler returns
+    self._deferred = True
+    return self._responder
+
+  def getResponder(self):
+    return self._responder
+
+def _commandResult(info, result):
+  # value of a deferred handler => responseCode, responseMessage
+  if isinstance(result, tuple):
+    return result[0], result[1]
+  if result == None:
+    return info.getResponseCode(), info.getResponseMessage()
+  return 200, result
+
+class _DesiredAck:
+  # collects the handlers' responses to one desired patch and reports them
+  # back in a single PATCH once the last handler has completed
+  def __init__(self, device, settings, version):
+    self._device = device
+    self._settings = dict(settings)
+    self._version = version
+    self._reported = {}
+    self._lock = _createLock()
+
+  def complete(self, info):
+    attr = info.getTag()
+    value = dict(self._settings[attr])
+    value["statusCode"] = info.getResponseCode() if info.getResponseCode() != None else 200
+    value["status"] = info.getResponseMessage() if info.getResponseMessage() != None else "completed"
+    value["desiredVersion"] = self._version
+
+    with self._lock:
+      self._reported[attr] = value
+      if len(self._reported) < len(self._settings):
+        return
+
+    self._device._sendReported(self._device._encodeReported(self._reported)[0], self._reported, True)
 
 class Device:
   def __init__(self, scopeId, keyORCert, deviceId, credType):
@@ -295,12 +1981,14 @@ class Device:
     self._credType  = credType
     self._hostname = None
     self._auth_response_received = None
-    self._messages = {}
-    self._loopTry = 0
+    self._inFlight = _InFlightTracker(1000, 60)
+    self._inFlightTimer = None
+    self._metrics = _DeviceMetrics()
     self._protocol = IOTProtocol.IOTC_PROTOCOL_MQTT
     self._dpsEndPoint = "global.azure-devices-provisioning.net"
     self._modelData = None
     self._sslVerificiationIsEnabled = True
+    self._caFile = None
     self._dpsAPIVersion = "2018-11-01"
     self._keyfile = None
     self._certfile = None
@@ -308,8 +1996,45 @@ class Device:
     self._cleanSession = True
     self._exitOnError = False
     self._tokenExpires = 21600
+    self._networkLoop = None
+    self._batch = None
+    self._coalescer = None
+    self._encoder = gJSONEncoder
+    self._telemetryBase = None
+    self._queue = None
+    self._provisioningCache = None
+    self._provisioningCacheTTL = 86400
+    self._cachedConnectTimeout = 30
+    self._connectTimeout = 60
+    self._connectResult = None # CONNACK return code of the last connect, 3 when the hub wasn't reachable
+    self._probingCachedHost = False
+    self._provisioningTimeout = 60
+    self._tokenExpiresAt = None
+    self._tokenRenewal = True
+    self._tokenRenewalMargin = None
+    self._tokenRenewalJitter = None
+    self._tokenRenewAt = None
+    self._renewalEntry = None
+    self._renewingToken = False
+    self._symmetricKey = None
+    self._callbackExecutor = None
+    self._twin = _TwinCache()
+    self._requestId = 0
+    self._requestIdLock = _createLock()
+    self._twinRequests = {} # rid -> IOTTwinRequest
+    self._router = None
+    self._routes = [] # (pattern, callback, subscribe) added by the application
+    self._requestTimeout = 30
+    self._commands = {} # rid -> IOTCommandInfo, running or waiting for a slot
+    self._commandQueue = _createQueue()
+    self._commandsRunning = 0
+    self._maxCommands = None
+    self._commandTimeout = 30
+    self._commandTimeouts = {} # method name -> seconds
+    self._commandLock = _createLock()
     self._events = {
       "MessageSent": None,
+      "MessageTimeout": None,
       "ConnectionStatus": None,
       "Command": None,
       "SettingUpdated": None,
@@ -322,10 +2047,240 @@ class Device:
       self._keyfile = keyORCert["keyfile"]
       self._certfile = keyORCert["certfile"]
 
+  def enableBatching(self, maxMessages = 100, maxBytes = 65536, lingerMs = 100):
+    if maxMessages < 1 or maxBytes < 3 or lingerMs < 0:
+      LOG_IOTC("ERROR: (enableBatching) invalid argument.")
+      return 1
+
+    if maxBytes > IOTC_MAX_MESSAGE_SIZE:
+      LOG_IOTC("WARNING: (enableBatching) maxBytes is limited to %d", IOTLogLevel.IOTC_LOGGING_API_ONLY, IOTC_MAX_MESSAGE_SIZE, device=self._deviceId)
+      maxBytes = IOTC_MAX_MESSAGE_SIZE
+
+    self.disableBatching()
+    self._batch = _TelemetryBatch(maxMessages, maxBytes, lingerMs)
+    return 0
+
+  def disableBatching(self):
+    if self._batch != None:
+      batch = self._batch
+      self._batch = None
+      return batch.flush(self)
+    return 0
+
+  def flushBatch(self):
+    if self._batch != None:
+      return self._batch.flush(self)
+    return 0
+
+  def setEncoder(self, encoder):
+    # `IOTEncoding` value or an `IOTEncoder`, used for dict / list payloads
+    if not isinstance(encoder, IOTEncoder):
+      encoder = _createEncoder(encoder)
+      if encoder == None:
+        LOG_IOTC("ERROR: (setEncoder) invalid argument.")
+        return 1
+    self._encoder = encoder
+    return 0
+
+  def enablePropertyCoalescing(self, windowMs = 100):
+    if windowMs < 0:
+      LOG_IOTC("ERROR: (enablePropertyCoalescing) invalid argument.")
+      return 1
+
+    self.disablePropertyCoalescing()
+    self._coalescer = _ReportedCoalescer(windowMs)
+    return 0
+
+  def disablePropertyCoalescing(self):
+    if self._coalescer != None:
+      coalescer = self._coalescer
+      self._coalescer = None
+      return coalescer.flush(self)
+    return 0
+
+  def flushProperties(self):
+    if self._coalescer != None:
+      return self._coalescer.flush(self)
+    return 0
+
+  def enableOutboundQueue(self, maxMessages = 1000, overflowPolicy = IOTOverflowPolicy.IOTC_OVERFLOW_DROP_OLDEST, path = None, replayRate = 100, blockTimeout = None):
+    if maxMessages < 1 or replayRate <= 0 or deque == None:
+      LOG_IOTC("ERROR: (enableOutboundQueue) invalid argument.")
+      return 1
+
+    if overflowPolicy == IOTOverflowPolicy.IOTC_OVERFLOW_BLOCK and threading == None:
+      LOG_IOTC("ERROR: (enableOutboundQueue) IOTC_OVERFLOW_BLOCK requires threading support.")
+      return 1
+
+    if overflowPolicy not in (IOTOverflowPolicy.IOTC_OVERFLOW_BLOCK, IOTOverflowPolicy.IOTC_OVERFLOW_DROP_OLDEST, IOTOverflowPolicy.IOTC_OVERFLOW_DROP_NEWEST):
+      LOG_IOTC("ERROR: (enableOutboundQueue) invalid overflow policy.")
+      return 1
+
+    try:
+      store = _MemoryQueueStore() if path == None else _FileQueueStore(path)
+    except Exception as e:
+      LOG_IOTC("ERROR: (enableOutboundQueue) unable to open `%s` => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, path, e, device=self._deviceId)
+      return 1
+
+    self._queue = _OutboundQueue(store, maxMessages, overflowPolicy, replayRate, blockTimeout)
+    return 0
+
+  def getQueueLength(self):
+    if self._queue == None:
+      return 0
+    return len(self._queue)
+
+  def setConnectTimeout(self, totalSeconds):
+    # how long `connect` waits for the CONNACK
+    if totalSeconds <= 0:
+      LOG_IOTC("ERROR: (setConnectTimeout) invalid argument.")
+      return 1
+    self._connectTimeout = totalSeconds
+    return 0
+
+  def enableProvisioningCache(self, ttl = 86400, path = None, connectTimeout = 30):
+    if ttl <= 0 or connectTimeout <= 0:
+      LOG_IOTC("ERROR: (enableProvisioningCache) invalid argument.")
+      return 1
+    self._provisioningCache = _getProvisioningCache(path)
+    self._provisioningCacheTTL = ttl
+    self._cachedConnectTimeout = connectTimeout
+    return 0
+
+  def _provisioningCacheKey(self):
+    modelHash = ""
+    if self._modelData != None:
+      modelHash = hashlib.sha256(json.dumps(self._modelData, sort_keys=True).encode('utf-8')).hexdigest()
+    return "|".join([self._dpsEndPoint, self._scopeId, self._deviceId, modelHash])
+
+  def _cachedHostName(self):
+    if self._provisioningCache == None:
+      return None
+    hostName = self._provisioningCache.get(self._provisioningCacheKey())
+    if hostName != None:
+      LOG_IOTC("- iotc :: connect :: cached assignment %s", IOTLogLevel.IOTC_LOGGING_ALL, hostName, device=self._deviceId)
+    return hostName
+
+  def _cachedHostFailed(self, hostName):
+    # the assignment is dropped only when the hub refuses the device (CONNACK 4 / 5) or
+    # can't be reached (3). a missing CONNACK keeps it, DPS overwrites it on success
+    self._closeMQTTClient()
+    if self._connectResult in (3, 4, 5):
+      LOG_IOTC("WARNING: cached hub assignment `%s` has failed. Provisioning again.", IOTLogLevel.IOTC_LOGGING_API_ONLY, hostName, device=self._deviceId)
+      self._provisioningCache.remove(self._provisioningCacheKey())
+    else:
+      LOG_IOTC("WARNING: cached hub `%s` didn't answer in time. Provisioning again.", IOTLogLevel.IOTC_LOGGING_API_ONLY, hostName, device=self._deviceId)
+
+  def _connectCachedHost(self):
+    hostName = self._cachedHostName()
+    if hostName == None:
+      return 1
+
+    self._hostName = hostName
+    self._probingCachedHost = True
+    try:
+      ret = self._mqttConnect(None, hostName, self._cachedConnectTimeout)
+    except Exception as e: # DNS, socket.. fall back to DPS
+      LOG_IOTC("ERROR: (connect) cached hub `%s` is not reachable => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, hostName, e, device=self._deviceId)
+      self._connectResult = 3
+      ret = 1
+    finally:
+      self._probingCachedHost = False
+
+    if ret != 0:
+      self._cachedHostFailed(hostName)
+    return ret
+
+  def _assigned(self, hostName):
+    self._hostName = hostName
+    if self._provisioningCache != None:
+      self._provisioningCache.put(self._provisioningCacheKey(), hostName, self._provisioningCacheTTL)
+
+  def setDPSConnectionPool(self, maxSize, idleTimeout):
+    if maxSize < 0 or idleTimeout < 0:
+      LOG_IOTC("ERROR: (setDPSConnectionPool) invalid argument.")
+      return 1
+    gHTTPSPool.setOptions(maxSize, idleTimeout)
+    return 0
+
+  def setProvisioningTimeout(self, totalSeconds):
+    if totalSeconds <= 0:
+      LOG_IOTC("ERROR: (setProvisioningTimeout) invalid argument.")
+      return 1
+    self._provisioningTimeout = totalSeconds
+    return 0
+
   def setTokenExpiration(self, totalSeconds):
     self._tokenExpires = totalSeconds
     return 0
 
+  def setTokenRenewal(self, isEnabled, margin = None, jitter = None):
+    if (margin != None and margin < 0) or (jitter != None and jitter < 0):
+      LOG_IOTC("ERROR: (setTokenRenewal) invalid argument.")
+      return 1
+    self._tokenRenewal = isEnabled
+    self._tokenRenewalMargin = margin
+    self._tokenRenewalJitter = jitter
+    if not isEnabled:
+      self._cancelTokenRenewal()
+    return 0
+
+  def _tokenRenewalDelay(self):
+    import random
+    margin = self._tokenRenewalMargin
+    if margin == None:
+      margin = self._tokenExpires / 10.0
+    jitter = self._tokenRenewalJitter
+    if jitter == None:
+      jitter = self._tokenExpires / 10.0
+    # random spread so devices connected together don't renew together
+    return max(1, self._tokenExpiresAt - time.time() - margin - jitter * random.random())
+
+  def _scheduleTokenRenewal(self):
+    self._cancelTokenRenewal()
+    if not self._tokenRenewal or self._tokenExpiresAt == None:
+      return
+
+    delay = self._tokenRenewalDelay()
+    LOG_IOTC("- iotc :: token renewal in %ds", IOTLogLevel.IOTC_LOGGING_ALL, delay, device=self._deviceId)
+    self._tokenRenewAt = time.time() + delay
+    scheduler = _getScheduler()
+    if scheduler != None: # otherwise `doNext` renews
+      self._renewalEntry = scheduler.schedule(delay, self._startTokenRenewal)
+
+  def _cancelTokenRenewal(self):
+    self._tokenRenewAt = None
+    if self._renewalEntry != None:
+      _getScheduler().cancel(self._renewalEntry)
+      self._renewalEntry = None
+
+  def _startTokenRenewal(self):
+    # reconnect blocks until CONNACK, keep the scheduler thread free
+    thread = threading.Thread(target=self._renewToken, name="iotc-token-renewal")
+    thread.daemon = True
+    thread.start()
+
+  def _renewToken(self):
+    self._renewalEntry = None
+    self._tokenRenewAt = None
+    if not self.isConnected():
+      return 1
+
+    hostName = self._hostName
+    LOG_IOTC("- iotc :: renewing SAS token :: %s", IOTLogLevel.IOTC_LOGGING_ALL, hostName, device=self._deviceId)
+    self._renewingToken = True
+    try:
+      self._closeMQTTClient()
+      ret = self._mqttConnect(None, hostName, self._cachedConnectTimeout)
+    finally:
+      self._renewingToken = False
+
+    if ret != 0:
+      LOG_IOTC("WARNING: token renewal on `%s` has failed. Connecting again.", IOTLogLevel.IOTC_LOGGING_API_ONLY, hostName, device=self._deviceId)
+      self._closeMQTTClient()
+      ret = self.connect()
+    return ret
+
   def setExitOnError(self, isEnabled):
     self._exitOnError = isEnabled
     return 0
@@ -341,8 +2296,17 @@ class Device:
     self._sslVerificiationIsEnabled = isEnabled
     return 0
 
+  def setCACertificate(self, caFile):
+    # trust the CA certificates in `caFile` (PEM) instead of the system ones, i.e. a local emulator
+    if self._auth_response_received:
+      LOG_IOTC("ERROR: setCACertificate should be called before `connect`")
+      return 1
+    self._caFile = caFile
+    return 0
+
   def setModelData(self, data):
-    LOG_IOTC("- iotc :: setModelData :: " + json.dumps(data), IOTLogLevel.IOTC_LOGGING_ALL)
+    if gLOG_LEVEL >= IOTLogLevel.IOTC_LOGGING_ALL:
+      LOG_IOTC("- iotc :: setModelData :: %s", IOTLogLevel.IOTC_LOGGING_ALL, json.dumps(data), device=self._deviceId)
     if self._auth_response_received:
       LOG_IOTC("ERROR: setModelData should be called before `connect`")
       return 1
@@ -352,7 +2316,7 @@ class Device:
     return 0
 
   def setDPSEndpoint(self, endpoint):
-    LOG_IOTC("- iotc :: setDPSEndpoint :: " + endpoint, IOTLogLevel.IOTC_LOGGING_ALL)
+    LOG_IOTC("- iotc :: setDPSEndpoint :: %s", IOTLogLevel.IOTC_LOGGING_ALL, endpoint, device=self._deviceId)
 
     if self._auth_response_received:
       LOG_IOTC("ERROR: setDPSEndpoint should be called before `connect`")
@@ -361,6 +2325,16 @@ class Device:
     self._dpsEndPoint = endpoint
     return 0
 
+  def setLogSink(self, sink):
+    global gLOG_SINK
+    gLOG_SINK = sink if sink != None else _printSink
+    return 0
+
+  def setCallbackExecutor(self, executor):
+    # `None` runs event handlers on the network thread
+    self._callbackExecutor = executor
+    return 0
+
   def setLogLevel(self, logLevel):
     global gLOG_LEVEL
     if logLevel < IOTLogLevel.IOTC_LOGGING_DISABLED or logLevel > IOTLogLevel.IOTC_LOGGING_ALL:
@@ -378,184 +2352,547 @@ class Device:
     return 0
 
   def _computeDrivedSymmetricKey(self, secret, regId):
-    global gIsMicroPython
-    try:
-      secret = base64.b64decode(secret)
-    except:
-      LOG_IOTC("ERROR: broken base64 secret => `" + secret + "`")
-      sys.exit()
+    if isinstance(secret, SymmetricKey):
+      return secret.sign(regId)
+
+    if self._symmetricKey == None or self._symmetricKey[0] != secret:
+      try:
+        self._symmetricKey = (secret, SymmetricKey(secret))
+      except:
+        LOG_IOTC("ERROR: broken base64 secret => `%s`", IOTLogLevel.IOTC_LOGGING_API_ONLY, secret, device=self._deviceId)
+        sys.exit()
+    return self._symmetricKey[1].sign(regId)
+
+  def _provisionSteps(self):
+    # DPS register + assignment polling. yields ("request", method, uri, body, headers)
+    # and ("wait", seconds) steps to the caller, ends with ("done", hostName, err)
+    started = time.time()
+    backoff = _ProvisioningBackoff(self._provisioningTimeout)
+    uri, body, headers = self._dpsRegistrationRequest()
+    method = "PUT"
+
+    while True:
+      LOG_IOTC("- iotc :: _provision :: %s %s", IOTLogLevel.IOTC_LOGGING_ALL, method, uri, device=self._deviceId)
+      content, status, retryAfter = yield ("request", method, _urlparse.urlparse(uri).geturl(), body, headers)
+
+      if status == 429 or (status != None and status >= 500): # throttled or service busy
+        delay = backoff.next(retryAfter)
+        if delay == None:
+          break
+        LOG_IOTC("- iotc :: _provision :: status %s, retrying in %s", IOTLogLevel.IOTC_LOGGING_ALL, status, delay, device=self._deviceId)
+        yield ("wait", delay)
+        continue
+
+      data, err = self._parseDPSResponse(content)
+      if err != None:
+        yield self._provisionDone(started, None, err)
+        return
+
+      if data == None or 'errorCode' in data:
+        yield self._provisionDone(started, None, "DPS => " + str(data))
+        return
+
+      if data.get('status') == 'assigned':
+        yield self._provisionDone(started, data['registrationState']['assignedHub'], None)
+        return
+
+      if 'operationId' in data and data.get('status', 'assigning') == 'assigning':
+        uri = self._dpsOperationUri(data['operationId'])
+        method = "GET"
+        body = None
+        delay = backoff.next(retryAfter)
+        if delay == None:
+          break
+        yield ("wait", delay)
+        continue
+
+      yield self._provisionDone(started, None, "DPS L => " + str(data))
+      return
+
+    LOG_IOTC("ERROR: Unable to provision the device in %s seconds.", IOTLogLevel.IOTC_LOGGING_API_ONLY, self._provisioningTimeout, device=self._deviceId)
+    yield self._provisionDone(started, None, "Unable to provision the device.")
+
+  def _provisionDone(self, started, hostName, err):
+    if err == None:
+      self._metrics.provisioned = self._metrics.provisioned + 1
+      self._metrics.provisioningTime.observe(time.time() - started)
+    else:
+      self._metrics.provisioningFailed = self._metrics.provisioningFailed + 1
+    return ("done", hostName, err)
+
+  def _provision(self):
+    steps = self._provisionSteps()
+    step = next(steps)
+    while step[0] != "done":
+      if step[0] == "wait":
+        time.sleep(step[1])
+        step = next(steps)
+      else:
+        step = steps.send(_requestDetails(self, step[2], step[1], step[3], step[4]))
+    return step[1], step[2]
+
+  def _dpsRegistrationRequest(self):
+    expires = int(time.time() + self._tokenExpires)
+    authString = None
+
+    if self._credType == IOTConnectType.IOTC_CONNECT_SYMM_KEY:
+      sr = self._scopeId + "%2Fregistrations%2F" + self._deviceId
+      sigNoEncode = self._computeDrivedSymmetricKey(self._keyORCert, sr + "\n" + str(expires))
+      sigEncoded = _quote(sigNoEncode, '~()*!.\'')
+      authString = "SharedAccessSignature sr=" + sr + "&sig=" + sigEncoded + "&se=" + str(expires) + "&skn=registration"
 
-    if gIsMicroPython == False:
-      return base64.b64encode(hmac.new(secret, msg=regId.encode('utf8'), digestmod=hashlib.sha256).digest())
+    headers = {
+      "content-type": "application/json; charset=utf-8",
+      "user-agent": "iot-central-client/1.0",
+      "Accept": "*/*"
+    }
+
+    if authString != None:
+      headers["authorization"] = authString
+
+    if self._modelData != None:
+      body = "{\"registrationId\":\"%s\",\"data\":%s}" % (self._deviceId, json.dumps(self._modelData))
     else:
-      return base64.b64encode(hmac.new(secret, msg=regId.encode('utf8'), digestmod=hashlib._sha256.sha256).digest())
+      body = "{\"registrationId\":\"%s\"}" % (self._deviceId)
+
+    uri = "https://%s/%s/registrations/%s/register?api-version=%s" % (self._dpsEndPoint, self._scopeId, self._deviceId, self._dpsAPIVersion)
+    return uri, body, headers
 
-  def _loopAssign(self, operationId, headers):
-    uri = "https://%s/%s/registrations/%s/operations/%s?api-version=%s" % (self._dpsEndPoint, self._scopeId, self._deviceId, operationId, self._dpsAPIVersion)
-    LOG_IOTC("- iotc :: _loopAssign :: " + uri, IOTLogLevel.IOTC_LOGGING_ALL)
-    target = urlparse(uri)
+  def _dpsOperationUri(self, operationId):
+    return "https://%s/%s/registrations/%s/operations/%s?api-version=%s" % (self._dpsEndPoint, self._scopeId, self._deviceId, operationId, self._dpsAPIVersion)
 
-    content = _request(self, target.geturl(), "GET", None, headers)
+  def _parseDPSResponse(self, content):
     try:
-      data = json.loads(content.decode("utf-8"))
+      return json.loads(content.decode("utf-8")), None
     except:
       try:
-        data = json.loads(content)
+        return json.loads(content), None
       except Exception as e:
-        err = "ERROR: %s => %s", (str(e), content)
-        LOG_IOTC(err)
-        return self._mqttConnect(err, None)
-
-    if data != None and 'status' in data:
-      if data['status'] == 'assigning':
-        time.sleep(3)
-        if self._loopTry < 20:
-          self._loopTry = self._loopTry + 1
-          return self._loopAssign(operationId, headers)
-        else:
-          LOG_IOTC("ERROR: Unable to provision the device.") # todo error code
-          data = "Unable to provision the device."
-          return 1
-      elif data['status'] == "assigned":
-        state = data['registrationState']
-        self._hostName = state['assignedHub']
-        return self._mqttConnect(None, self._hostName)
-    else:
-      data = str(data)
-
-    return self._mqttConnect("DPS L => " + str(data), None)
+        return None, "ERROR: non JSON is received from %s => %s .. message : %s" % (self._dpsEndPoint, content, str(e))
 
   def _onConnect(self, client, userdata, _, rc):
-    LOG_IOTC("- iotc :: _onConnect :: rc = " + str(rc), IOTLogLevel.IOTC_LOGGING_ALL)
+    LOG_IOTC("- iotc :: _onConnect :: rc = %s", IOTLogLevel.IOTC_LOGGING_ALL, rc, device=self._deviceId)
+    self._connectResult = rc
     if rc == 0:
+      if self._metrics.connects > 0:
+        self._metrics.reconnects = self._metrics.reconnects + 1
+      self._metrics.connects = self._metrics.connects + 1
       self._mqttConnected = True
-      MAKE_CALLBACK(self, "ConnectionStatus", userdata, "", rc)
+      self._twin.clearPending() # responses of the previous connection won't arrive
+      self._expireTwinRequests("connection was reset")
+      if client != None and mqtt != None:
+        _saveTLSSession(client.socket(), _splitEndpoint(self._hostname, 8883)[0])
+      if not self._renewingToken: # the application never saw this connection go away
+        MAKE_CALLBACK(self, "ConnectionStatus", userdata, "", rc)
     self._auth_response_received = True
+    if rc == 0 and self._queue != None: # replay what was queued while offline
+      self._queue.resume(self)
 
-  def _echoDesired(self, msg, topic):
-    LOG_IOTC("- iotc :: _echoDesired :: " + topic, IOTLogLevel.IOTC_LOGGING_ALL)
-    obj = None
+  def _echoDesired(self, msg, topic, obj = None):
+    LOG_IOTC("- iotc :: _echoDesired", IOTLogLevel.IOTC_LOGGING_ALL, device=self._deviceId, topic=topic)
 
-    try:
-      obj = json.loads(msg)
-    except Exception as e:
-      LOG_IOTC("ERROR: JSON parse for SettingsUpdated message object has failed. => " + msg + " => " + str(e))
-      return
+    if obj == None:
+      try:
+        obj = _loadJSON(msg)
+      except Exception as e:
+        LOG_IOTC("ERROR: JSON parse for SettingsUpdated message object has failed. => %s => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, msg, e)
+        return
 
     version = None
     if 'desired' in obj:
+      self._twin.setDocument(obj)
       obj = obj['desired']
 
     if not '$version' in obj:
-      LOG_IOTC("ERROR: Unexpected payload for settings update => " + msg)
+      LOG_IOTC("ERROR: Unexpected payload for settings update => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, msg)
       return 1
 
     version = obj['$version']
+    if topic.startswith('$iothub/twin/PATCH/properties/desired/') and not self._twin.patchDesired(obj):
+      LOG_IOTC("- iotc :: desired version %s is already applied", IOTLogLevel.IOTC_LOGGING_ALL, version, device=self._deviceId)
+      return
 
+    settings = []
     for attr, value in obj.items():
-      if attr != '$version':
-        try:
-          eventValue = json.loads(json.dumps(value))
-          if version != None:
-            eventValue['$version'] = version
-        except:
-          continue
+      if attr != '$version' and isinstance(value, dict):
+        settings.append((attr, value))
+
+    ack = None
+    if not topic.startswith('$iothub/twin/res/200/?$rid=') and len(settings) > 0:
+      ack = _DesiredAck(self, settings, version)
+
+    for attr, value in settings:
+      eventValue = dict(value) # shallow, only `$version` is added
+      eventValue['$version'] = version
+      if ack == None:
+        MAKE_CALLBACK(self, "SettingsUpdated", json.dumps(eventValue), attr, 0)
+      else: # the ack is sent once every handler has completed, even a failing one
+        info = IOTCallbackInfo(self, "SettingsUpdated", json.dumps(eventValue), attr, 0, None)
+        _dispatchCallback(self, self._invokeSettingsUpdated, info, ack.complete)
+
+  def _invokeSettingsUpdated(self, info):
+    # => what the handler returned, an executor awaits a coroutine before the ack
+    handler = self._events.get("SettingsUpdated")
+    if handler == None:
+      return None
+    try:
+      return handler(info)
+    except Exception as e:
+      self._settingsUpdateFailed(info, e)
+      return None
 
-        ret = MAKE_CALLBACK(self, "SettingsUpdated", json.dumps(eventValue), attr, 0)
-
-        if not topic.startswith('$iothub/twin/res/200/?$rid=') and version != None:
-          ret_code = 200
-          ret_message = "completed"
-          if ret.getResponseCode() != None:
-            ret_code = ret.getResponseCode()
-          if ret.getResponseMessage() != None:
-            ret_message = ret.getResponseMessage()
-
-          value["statusCode"] = ret_code
-          value["status"] = ret_message
-          value["desiredVersion"] = version
-          wrapper = {}
-          wrapper[attr] = value
-          msg = json.dumps(wrapper)
-          topic = '$iothub/twin/PATCH/properties/reported/?$rid={}'.format(int(time.time()))
-          self._sendCommon(topic, msg, True)
+  def _settingsUpdateFailed(self, info, e):
+    LOG_IOTC("ERROR: (SettingsUpdated) %s has failed => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, info.getTag(), e, device=self._deviceId)
+    info.setResponse(500, str(e))
 
   def _onMessage(self, client, _, data):
-    topic = ""
-    msg = None
     if data == None:
       LOG_IOTC("WARNING: (_onMessage) data is None.")
       return
 
-    LOG_IOTC("- iotc :: _onMessage :: topic(" + str(data.topic) + ") payload(" + str(data.payload) + ")", IOTLogLevel.IOTC_LOGGING_ALL)
+    LOG_IOTC("- iotc :: _onMessage :: payload(%s)", IOTLogLevel.IOTC_LOGGING_ALL, data.payload, device=self._deviceId, topic=data.topic)
+    self._routeMessage(data.topic, data.payload)
 
-    if data.payload != None:
+  def _routeMessage(self, topic, payload):
+    self._metrics.received(payload)
+    if topic == None:
+      topic = ""
+    elif not isinstance(topic, str):
       try:
-        msg = data.payload.decode("utf-8")
+        topic = topic.decode("utf-8")
       except:
-        msg = str(data.payload)
+        topic = str(topic)
 
-    if data.topic != None:
-      try:
-        topic = data.topic.decode("utf-8")
-      except:
-        topic = str(data.topic)
-
-    if topic.startswith('$iothub/'): # twin
-      # DO NOT need to echo twin response since IOTC api takes care of the desired messages internally
-      # if topic.startswith('$iothub/twin/res/'): # twin response
-      #   self._handleTwin(topic, msg)
-      #
-      if topic.startswith('$iothub/twin/PATCH/properties/desired/') or topic.startswith('$iothub/twin/res/200/?$rid='): # twin desired property change
-        self._echoDesired(msg, topic)
-      elif topic.startswith('$iothub/methods'): # Direct method
-        index = topic.find("$rid=")
-        method_id = 1
-        method_name = "None"
-        if index == -1:
-          LOG_IOTC("ERROR: Command doesn't include topic id")
-        else:
-          method_id = topic[index + 5:]
-          topic_template = "$iothub/methods/POST/"
-          len_temp = len(topic_template)
-          method_name = topic[len_temp:topic.find("/", len_temp + 1)]
-
-        ret = MAKE_CALLBACK(self, "Command", msg, method_name, 0)
-        ret_code = 200
-        ret_message = "{}"
-        if ret.getResponseCode() != None:
-          ret_code = ret.getResponseCode()
-        if ret.getResponseMessage() != None:
-          ret_message = ret.getResponseMessage()
-
-        next_topic = '$iothub/methods/res/{}/?$rid={}'.format(ret_code, method_id)
-        LOG_IOTC("C2D: => " + next_topic + " with data " + ret_message  + " and name => " + method_name, IOTLogLevel.IOTC_LOGGING_ALL)
-        (result, msg_id) = self._mqtts.publish(next_topic, ret_message, qos=gQOS_LEVEL)
-        if result != MQTT_SUCCESS:
-          LOG_IOTC("ERROR: (send method callback) failed to send. MQTT client return value: " + str(result))
+    router = self._router if self._router != None else self._buildRouter()
+    index = topic.find('?')
+    if index == -1:
+      path = topic
+      query = None
+    else:
+      path = topic[:index]
+      query = topic[index + 1:]
+    handler, captures = router._cache.get(path) or router.match(path)
+    if handler == None:
+      LOG_IOTC("ERROR: unknown message: %s - %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, topic, payload, device=self._deviceId)
+      return
+    handler(topic, payload, captures, query)
+
+  def _buildRouter(self):
+    router = _TopicRouter()
+    router.add('$iothub/twin/PATCH/properties/desired/', self._onDesiredMessage)
+    router.add('$iothub/twin/res/{status}/', self._onTwinResponse)
+    router.add('$iothub/methods/POST/{method}/', self._onMethodMessage)
+    router.add('devices/{}/messages/devicebound/#'.format(self._deviceId), self._onC2DMessage)
+    for pattern, callback, subscribe in self._routes:
+      router.add(pattern, self._routeHandler(callback))
+    self._router = router
+    return router
+
+  def _routeHandler(self, callback):
+    def handle(topic, payload, captures, query):
+      message = IOTMessage(self, topic, payload, captures, query)
+      if self._callbackExecutor != None:
+        self._callbackExecutor.submit(self, callback, message)
       else:
-        if not topic.startswith('$iothub/twin/res/'): # not twin response
-          LOG_IOTC('ERROR: unknown twin! {} - {}'.format(topic, msg))
-    elif topic.startswith('devices/{}/messages/devicebound'.format(self._deviceId)): # C2D offline message
-      LOG_IOTC('C2D Offline message: {} - {}'.format(topic, msg))
-      data=json.loads(msg)
-      method_name=data['methodName']
-      ret = MAKE_CALLBACK(self, "EnqueuedCommand", msg, method_name, 0)
+        callback(message)
+    return handle
+
+  def addRoute(self, pattern, callback, subscribe = True):
+    # `callback(IOTMessage)` for topics matching `pattern`, i.e.
+    # "devices/{deviceId}/modules/{moduleId}/inputs/#". subscribes to it on each connect
+    self._routes.append((pattern, callback, subscribe))
+    if self._router != None:
+      self._router.add(pattern, self._routeHandler(callback))
+    if subscribe and self.isConnected():
+      self._mqtts.subscribe(_routeFilter(pattern))
+    return 0
+
+  # built-in routes get the raw topic parts, only application routes pay for an IOTMessage
+  def _onDesiredMessage(self, topic, payload, captures, query):
+    self._echoDesired(payload, topic)
+
+  def _onMethodMessage(self, topic, payload, captures, query):
+    method_id = _parseQuery(query).get('$rid') if query != None else None
+    if method_id == None:
+      LOG_IOTC("ERROR: Command doesn't include topic id")
+      method_id = 1
+    method_name = captures['method']
+    timeout = self._commandTimeouts.get(method_name, self._commandTimeout)
+    responder = IOTCommandResponder(self, method_id, method_name, time.time() + timeout)
+    info = IOTCommandInfo(self, _payloadText(payload), method_name, responder)
+
+    with self._commandLock:
+      self._commands[method_id] = info
+      start = self._maxCommands == None or self._commandsRunning < self._maxCommands
+      if start:
+        self._commandsRunning = self._commandsRunning + 1
+        responder._started = True
+      else:
+        self._commandQueue.append(info)
+    if start:
+      self._startCommand(info)
+    else:
+      LOG_IOTC("- iotc :: command %s is waiting for a slot", IOTLogLevel.IOTC_LOGGING_ALL, method_name, device=self._deviceId)
+    with responder._lock: # an executor thread may answer meanwhile, then there is no timer to arm
+      if not responder._done:
+        responder._timer = self._scheduleTimeout(max(0, responder._deadline - time.time()), self._expireCommand, method_id)
+
+  def _onC2DMessage(self, topic, payload, captures, query): # C2D offline message
+    msg = _payloadText(payload)
+    LOG_IOTC("C2D Offline message: %s - %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, topic, msg, device=self._deviceId)
+    try:
+      method_name = json.loads(msg)['methodName']
+    except Exception as e:
+      LOG_IOTC("ERROR: (C2D) unexpected payload => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, e, device=self._deviceId)
+      return
+    MAKE_CALLBACK(self, "EnqueuedCommand", msg, method_name, 0)
+
+  def _onTwinResponse(self, topic, msg, captures, query):
+    values = _parseQuery(query) if query != None else {}
+    rid = values.get('$rid')
+    if rid == None:
+      return
+    try:
+      status = int(captures['status'])
+      version = values.get('$version')
+      version = int(version) if version != None else None
+    except ValueError:
+      LOG_IOTC("ERROR: unexpected twin response %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, topic, device=self._deviceId)
+      return
+
+    body = None
+    if status == 200 and msg:
+      try:
+        body = _loadJSON(msg)
+      except Exception as e:
+        LOG_IOTC("ERROR: JSON parse for twin response has failed. => %s => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, msg, e)
+
+    with self._requestIdLock:
+      request = self._twinRequests.pop(rid, None)
+
+    if status in (200, 204):
+      self._twin.acknowledge(rid, version)
+    else:
+      LOG_IOTC("ERROR: twin request %s has failed with status %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, rid, status, device=self._deviceId)
+      self._twin.reject(rid)
+
+    if request == None: # timed out or not ours, its document may be stale
+      LOG_IOTC("- iotc :: no twin request %s", IOTLogLevel.IOTC_LOGGING_ALL, rid, device=self._deviceId)
+      return
+
+    if isinstance(body, dict):
+      if request._notify:
+        self._echoDesired(msg, topic, body)
+      elif 'desired' in body:
+        self._twin.setDocument(body)
+    self._finishTwinRequest(request, status, body, version, None)
+
+  def _startTwinRequest(self, topic, data, patch, notify, timeout):
+    rid = self._nextRequestId()
+    request = IOTTwinRequest(self, rid, notify)
+    with self._requestIdLock:
+      self._twinRequests[rid] = request
+    if patch != None:
+      self._twin.addPending(rid, patch)
+
+    timeout = timeout if timeout != None else self._requestTimeout
+    request._deadline = time.time() + timeout
+    request._timer = self._scheduleTimeout(timeout, self._expireTwinRequest, rid)
+
+    if self._publishTwinRequest(topic + rid, data) != 0:
+      self._expireTwinRequest(rid, "publish has failed")
+    return request
+
+  def _publishTwinRequest(self, topic, data):
+    return self._sendCommon(topic, data, True)
+
+  def _scheduleTimeout(self, delay, fn, *args):
+    # => timer handle, None without a scheduler (`doNext` expires then)
+    scheduler = _getScheduler()
+    if scheduler == None:
+      return None
+    return scheduler.schedule(delay, fn, *args)
+
+  def _cancelTimeout(self, timer):
+    gScheduler.cancel(timer)
+
+  def _finishTwinRequest(self, request, status, body, version, error):
+    if request._timer != None:
+      self._cancelTimeout(request._timer)
+      request._timer = None
+    request._complete(status, body, version, error)
+
+  def _expireTwinRequest(self, rid, error = "timeout"):
+    with self._requestIdLock:
+      request = self._twinRequests.pop(rid, None)
+    if request == None:
+      return
+    LOG_IOTC("ERROR: twin request %s has failed => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, rid, error, device=self._deviceId)
+    self._twin.reject(rid)
+    self._finishTwinRequest(request, None, None, None, error)
+
+  def _expireTwinRequests(self, error = None):
+    # all of them for `error`, otherwise the ones past their deadline (no scheduler)
+    now = time.time()
+    with self._requestIdLock:
+      rids = [rid for rid, request in self._twinRequests.items() if error != None or request._deadline <= now]
+    for rid in rids:
+      self._expireTwinRequest(rid, error if error != None else "timeout")
+
+  def setRequestTimeout(self, totalSeconds):
+    if totalSeconds <= 0:
+      LOG_IOTC("ERROR: (setRequestTimeout) invalid argument.")
+      return 1
+    self._requestTimeout = totalSeconds
+    return 0
+
+  def getTwin(self, timeout = None):
+    # => IOTTwinRequest, `getBody()` is the twin once it completes
+    LOG_IOTC("- iotc :: getTwin :: ", IOTLogLevel.IOTC_LOGGING_ALL, device=self._deviceId)
+    return self._startTwinRequest("$iothub/twin/GET/?$rid=", " ", None, False, timeout)
+
+  def patchReported(self, properties, timeout = None):
+    # => IOTTwinRequest, completes with the hub's response (204) to the reported properties PATCH
+    data, _ = self._encodeReported(properties)
+    LOG_IOTC("- iotc :: patchReported :: %s", IOTLogLevel.IOTC_LOGGING_ALL, data, device=self._deviceId)
+    return self._startTwinRequest("$iothub/twin/PATCH/properties/reported/?$rid=", data, properties, False, timeout)
+
+  def _startCommand(self, info):
+    LOG_IOTC("- iotc :: MAKE_CALLBACK :: Command", IOTLogLevel.IOTC_LOGGING_ALL)
+    _dispatchCallback(self, self._invokeCommand, info, self._completeCommand)
+
+  def _invokeCommand(self, info):
+    handler = self._events.get("Command")
+    if handler == None:
+      return
+    try:
+      ret = handler(info)
+    except Exception as e:
+      LOG_IOTC("ERROR: (Command) %s has failed => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, info.getTag(), e, device=self._deviceId)
+      info._responder.respond(500, json.dumps({"error": str(e)}))
+      return
+    if ret != None:
+      self._deferCommand(info, ret)
+
+  def _deferCommand(self, info, ret):
+    # only a future or a coroutine defers the response, i.e. `return 0` after `setResponse` doesn't
+    future = ret if hasattr(ret, "add_done_callback") else self._commandFuture(ret)
+    if future == None:
+      if hasattr(ret, "send") and hasattr(ret, "throw"): # a coroutine nothing can run
+        LOG_IOTC("ERROR: (Command) %s returned a coroutine, use AsyncDevice or AsyncCallbackExecutor", IOTLogLevel.IOTC_LOGGING_API_ONLY, info.getTag(), device=self._deviceId)
+      return
+    info._deferred = True
+    future.add_done_callback(lambda future: self._onCommandDone(info, future))
+
+  def _commandFuture(self, ret):
+    # future of a coroutine returned by the handler, None when it can't be run
+    if self._callbackExecutor != None:
+      return self._callbackExecutor._futureOf(self, ret)
+    return None
+
+  def _onCommandDone(self, info, future):
+    try:
+      code, message = _commandResult(info, future.result())
+    except BaseException as e: # includes a cancelled future
+      LOG_IOTC("ERROR: (Command) %s has failed => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, info.getTag(), repr(e), device=self._deviceId)
+      code, message = 500, json.dumps({"error": str(e) or e.__class__.__name__})
+    info._responder.respond(code, message)
+
+  def _completeCommand(self, info):
+    if not info._deferred:
+      info._responder.respond(info.getResponseCode(), info.getResponseMessage())
+
+  def _finishCommand(self, responder, ret_code, ret_message):
+    with responder._lock:
+      timer = responder._timer
+      responder._timer = None
+    if timer != None:
+      self._cancelTimeout(timer)
+
+    next_topic = '$iothub/methods/res/{}/?$rid={}'.format(ret_code, responder._rid)
+    LOG_IOTC("C2D: => %s with data %s and name => %s", IOTLogLevel.IOTC_LOGGING_ALL, next_topic, ret_message, responder._methodName, device=self._deviceId)
+    (result, msg_id) = self._mqtts.publish(next_topic, ret_message, qos=gQOS_LEVEL)
+    if result != MQTT_SUCCESS:
+      LOG_IOTC("ERROR: (send method callback) failed to send. MQTT client return value: %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, result, device=self._deviceId)
     else:
-      LOG_IOTC('ERROR: unknown message: {} - {}'.format(topic, msg))
+      self._metrics.published(ret_message)
+    self._metrics.commandsHandled = self._metrics.commandsHandled + 1
+
+    started = []
+    with self._commandLock:
+      self._commands.pop(responder._rid, None)
+      if responder._started:
+        self._commandsRunning = self._commandsRunning - 1
+      while len(self._commandQueue) > 0 and (self._maxCommands == None or self._commandsRunning < self._maxCommands):
+        info = _popLeft(self._commandQueue)
+        if info._responder._done: # timed out while waiting
+          continue
+        info._responder._started = True
+        self._commandsRunning = self._commandsRunning + 1
+        started.append(info)
+    for info in started:
+      self._startCommand(info)
+    return 0 if result == MQTT_SUCCESS else 1
+
+  def _expireCommand(self, rid):
+    with self._commandLock:
+      info = self._commands.get(rid)
+    if info == None:
+      return
+    info._responder._timer = None
+    if info._responder.respond(504, "{\"error\": \"timeout\"}") == 0:
+      LOG_IOTC("ERROR: command %s has timed out", IOTLogLevel.IOTC_LOGGING_API_ONLY, info.getTag(), device=self._deviceId)
+      self._metrics.commandsTimedOut = self._metrics.commandsTimedOut + 1
+
+  def _expireCommands(self):
+    now = time.time()
+    with self._commandLock:
+      rids = [rid for rid, info in self._commands.items() if info._responder._deadline <= now]
+    for rid in rids:
+      self._expireCommand(rid)
+
+  def setMaxConcurrentCommands(self, count):
+    # commands running at once, the rest wait for a slot. None for no limit
+    if count != None and count < 1:
+      LOG_IOTC("ERROR: (setMaxConcurrentCommands) invalid argument.")
+      return 1
+    self._maxCommands = count
+    return 0
+
+  def setCommandTimeout(self, totalSeconds, methodName = None):
+    # a 504 is sent for commands not answered in time. per method when `methodName` is set
+    if totalSeconds <= 0:
+      LOG_IOTC("ERROR: (setCommandTimeout) invalid argument.")
+      return 1
+    if methodName != None:
+      self._commandTimeouts[methodName] = totalSeconds
+    else:
+      self._commandTimeout = totalSeconds
+    return 0
+
+  def getCommandsInFlight(self):
+    # commands waiting for a response, running or queued
+    return len(self._commands)
 
   def _onLog(self, client, userdata, level, buf):
     global gLOG_LEVEL
     if gLOG_LEVEL > IOTLogLevel.IOTC_LOGGING_API_ONLY:
-      LOG_IOTC("mqtt-log : " + buf)
+      LOG_IOTC("mqtt-log : %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, buf, device=self._deviceId)
     elif level <= 8:
-      LOG_IOTC("mqtt-log : " + buf) # transport layer exception
+      LOG_IOTC("mqtt-log : %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, buf, device=self._deviceId) # transport layer exception
       if self._exitOnError:
         sys.exit()
 
+  def _isStaleClient(self, client):
+    # late events from a client replaced by a reconnect
+    return client != None and self._mqtts != None and client is not self._mqtts
+
   def _onDisconnect(self, client, userdata, rc):
-    LOG_IOTC("- iotc :: _onDisconnect :: rc = " + str(rc), IOTLogLevel.IOTC_LOGGING_ALL)
+    LOG_IOTC("- iotc :: _onDisconnect :: rc = %s", IOTLogLevel.IOTC_LOGGING_ALL, rc, device=self._deviceId)
+    if self._isStaleClient(client):
+      return
     self._auth_response_received = True
+    self._metrics.disconnects = self._metrics.disconnects + 1
 
     if rc == 5:
       LOG_IOTC("on(disconnect) : Not authorized")
@@ -564,66 +2901,182 @@ class Device:
     if rc == 1:
       self._mqttConnected = False
 
+    if self._probingCachedHost or self._renewingToken: # connect falls back to DPS / token renewal reconnects
+      return
+
     MAKE_CALLBACK(self, "ConnectionStatus", userdata, "", rc)
 
   def _onPublish(self, client, data, msgid):
-    LOG_IOTC("- iotc :: _onPublish :: " + str(data), IOTLogLevel.IOTC_LOGGING_ALL)
-    if data == None:
-      data = ""
+    LOG_IOTC("- iotc :: _onPublish :: %s", IOTLogLevel.IOTC_LOGGING_ALL, data, device=self._deviceId, msgid=msgid)
+    if msgid == None:
+      return
+    record = self._inFlight.ack(msgid)
+    if record != None:
+      self._messageAcked(time.time() - record.sent)
+      self._messageSent(record.payload, data, msgid, record.tag)
 
-    if msgid != None and (str(msgid) in self._messages) and self._messages[str(msgid)] != None:
-      MAKE_CALLBACK(self, "MessageSent", self._messages[str(msgid)], data, 0)
-      if (str(msgid) in self._messages):
-        del self._messages[str(msgid)]
+  def _messageEvent(self, eventName, payload, tag, status, msgid):
+    if payload == None:
+      return
+    if isinstance(payload, _BatchedPayloads): # one event per batched telemetry
+      for item in payload:
+        MAKE_CALLBACK(self, eventName, item, tag, status, msgid)
+    else:
+      MAKE_CALLBACK(self, eventName, payload, tag, status, msgid)
+
+  def _messageSent(self, payload, data, msgid, tag = None):
+    if tag == None:
+      tag = data if data != None else ""
+    self._messageEvent("MessageSent", payload, tag, 0, msgid)
+
+  def _messageAcked(self, latency):
+    self._metrics.messagesAcked = self._metrics.messagesAcked + 1
+    self._metrics.publishLatency.observe(latency)
+
+  def _messageFailed(self):
+    self._metrics.messagesFailed = self._metrics.messagesFailed + 1
+
+  def _trackMessage(self, msgid, payload, tag = None):
+    acked, replaced = self._inFlight.add(msgid, payload, tag)
+    if replaced != None: # msgid has wrapped around, the old one will never be matched
+      self._messageFailed()
+      self._messageEvent("MessageTimeout", replaced.payload, replaced.tag, IOTMessageStatus.IOTC_MESSAGE_ABANDONED, replaced.msgid)
+    if acked != None: # acknowledged while `publish` was writing it
+      self._messageAcked(0)
+      self._messageSent(acked.payload, None, msgid, tag)
+    else:
+      self._scheduleInFlightExpiry()
 
-  def _mqttcb(self, topic, msg):
-    # NOOP
-    pass
+  def _scheduleInFlightExpiry(self):
+    if self._inFlightTimer != None:
+      return
+    deadline = self._inFlight.nextDeadline()
+    scheduler = _getScheduler()
+    if deadline != None and scheduler != None: # otherwise `doNext` expires
+      self._inFlightTimer = scheduler.schedule(max(0, deadline - time.time()), self._expireInFlight)
+
+  def _expireInFlight(self):
+    self._inFlightTimer = None
+    for record in self._inFlight.expire():
+      LOG_IOTC("WARNING: message %s was not acknowledged in %s seconds", IOTLogLevel.IOTC_LOGGING_API_ONLY, record.msgid, self._inFlight.timeout, device=self._deviceId)
+      self._messageFailed()
+      self._messageEvent("MessageTimeout", record.payload, record.tag, IOTMessageStatus.IOTC_MESSAGE_ABANDONED, record.msgid)
+    self._scheduleInFlightExpiry()
+
+  def setMaxInFlight(self, maxMessages):
+    if maxMessages < 1:
+      LOG_IOTC("ERROR: (setMaxInFlight) invalid argument.")
+      return 1
+    self._inFlight.maxMessages = maxMessages
+    return 0
 
-  def _mqttConnect(self, err, hostname):
-    if err != None:
-      LOG_IOTC("ERROR : (_mqttConnect) " + str(err))
+  def setMessageTimeout(self, totalSeconds):
+    if totalSeconds <= 0:
+      LOG_IOTC("ERROR: (setMessageTimeout) invalid argument.")
       return 1
+    self._inFlight.timeout = totalSeconds
+    return 0
 
-    LOG_IOTC("- iotc :: _mqttConnect :: " + hostname, IOTLogLevel.IOTC_LOGGING_ALL)
+  def getInFlightCount(self):
+    return len(self._inFlight)
 
-    self._hostname = hostname
-    passwd = None
+  def getStats(self):
+    # => dict of counters, `inFlight` and the `publishLatency` / `provisioningTime`
+    # histograms (`bounds` in seconds, `counts` per bucket + the +Inf one)
+    stats = self._metrics.snapshot()
+    stats["inFlight"] = len(self._inFlight)
+    return stats
 
-    username = '{}/{}/api-version=2016-11-14'.format(self._hostname, self._deviceId)
-    if self._credType == IOTConnectType.IOTC_CONNECT_SYMM_KEY:
-      passwd = self._gen_sas_token(self._hostname, self._deviceId, self._keyORCert)
+  def _mqttcb(self, topic, msg):
+    self._routeMessage(topic, msg)
+
+  def _mqttConnect(self, err, hostname, timeout = None):
+    if err != None:
+      LOG_IOTC("ERROR : (_mqttConnect) %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, err, device=self._deviceId)
+      return 1
+
+    LOG_IOTC("- iotc :: _mqttConnect :: %s", IOTLogLevel.IOTC_LOGGING_ALL, hostname, device=self._deviceId)
 
+    username, passwd = self._mqttCredentials(hostname)
+    self._auth_response_received = None
+    self._connectResult = None
     _createMQTTClient(self, username, passwd)
 
     LOG_IOTC(" - iotc :: _mqttconnect :: created mqtt client. connecting..", IOTLogLevel.IOTC_LOGGING_ALL)
     if mqtt != None:
+      deadline = time.time() + (timeout if timeout != None else self._connectTimeout)
       while self._auth_response_received == None:
-        self.doNext()
-      LOG_IOTC(" - iotc :: _mqttconnect :: on_connect must be fired. Connected ? " + str(self.isConnected()), IOTLogLevel.IOTC_LOGGING_ALL)
+        if deadline <= time.time():
+          LOG_IOTC("ERROR : (_mqttConnect) no CONNACK from %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, hostname, device=self._deviceId)
+          self._closeMQTTClient()
+          return 1
+        time.sleep(0.01) # CONNACK is handled by the network loop
+      LOG_IOTC(" - iotc :: _mqttconnect :: on_connect must be fired. Connected ? %s", IOTLogLevel.IOTC_LOGGING_ALL, self.isConnected(), device=self._deviceId)
       if not self.isConnected():
+        self._closeMQTTClient() # don't leave a client retrying in the background
         return 1
     else:
       self._mqttConnected = True
       self._auth_response_received = True
 
-    self._mqtts.subscribe('devices/{}/messages/events/#'.format(self._deviceId))
-    self._mqtts.subscribe('devices/{}/messages/devicebound/#'.format(self._deviceId))
-    self._mqtts.subscribe('$iothub/twin/PATCH/properties/desired/#') # twin desired property changes
-    self._mqtts.subscribe('$iothub/twin/res/#') # twin properties response
-    self._mqtts.subscribe('$iothub/methods/#')
+    self._subscribe()
+
+    if self._renewingToken: # same twin, no need to fetch it and report every setting again
+      self._scheduleTokenRenewal()
+      return 0
 
     if self.getDeviceSettings() == 0:
+      self._scheduleTokenRenewal()
       MAKE_CALLBACK(self, "ConnectionStatus", None, None, 0)
     else:
       return 1
 
     return 0
 
+  def _mqttCredentials(self, hostname):
+    self._hostname = hostname
+    passwd = None
+
+    username = '{}/{}/api-version=2016-11-14'.format(self._hostname, self._deviceId)
+    if self._credType == IOTConnectType.IOTC_CONNECT_SYMM_KEY:
+      passwd = self._gen_sas_token(self._hostname, self._deviceId, self._keyORCert)
+    return username, passwd
+
+  def _closeMQTTClient(self):
+    self._mqttConnected = False
+    if self._mqtts != None and mqtt != None:
+      self._mqtts.disconnect()
+      self._stopMQTTLoop()
+
+  def _startMQTTLoop(self):
+    host, port = _splitEndpoint(self._hostname, 8883)
+    self._mqtts.connect_async(host, port=port, keepalive=120)
+    if self._networkLoop != None: # shared selector loop (see iotc.fleet)
+      self._networkLoop.attach(self._mqtts, self)
+    else:
+      self._mqtts.loop_start()
+
+  def _stopMQTTLoop(self):
+    if self._networkLoop != None:
+      self._networkLoop.detach(self._mqtts)
+    else:
+      self._mqtts.loop_stop()
+
+  def _subscribe(self):
+    self._mqtts.subscribe('devices/{}/messages/events/#'.format(self._deviceId))
+    self._mqtts.subscribe('devices/{}/messages/devicebound/#'.format(self._deviceId))
+    self._mqtts.subscribe('$iothub/twin/PATCH/properties/desired/#') # twin desired property changes
+    self._mqtts.subscribe('$iothub/twin/res/#') # twin properties response
+    self._mqtts.subscribe('$iothub/methods/#')
+    for pattern, callback, subscribe in self._routes:
+      if subscribe:
+        self._mqtts.subscribe(_routeFilter(pattern))
+
   def getDeviceSettings(self):
+    # the response fires SettingsUpdated for each desired property
     LOG_IOTC("- iotc :: getDeviceSettings :: ", IOTLogLevel.IOTC_LOGGING_ALL)
-    self.doNext()
-    return self._sendCommon("$iothub/twin/GET/?$rid=0", " ")
+    request = self._startTwinRequest("$iothub/twin/GET/?$rid=", " ", None, True, None)
+    return 1 if request.getError() != None else 0
 
   def getHostName(self):
     return self._hostName
@@ -635,53 +3088,19 @@ class Device:
       self._hostName = hostName
       return self._mqttConnect(None, self._hostName)
 
-    expires = int(time.time() + self._tokenExpires)
-    authString = None
-
-    if self._credType == IOTConnectType.IOTC_CONNECT_SYMM_KEY:
-      sr = self._scopeId + "%2Fregistrations%2F" + self._deviceId
-      sigNoEncode = self._computeDrivedSymmetricKey(self._keyORCert, sr + "\n" + str(expires))
-      sigEncoded = _quote(sigNoEncode, '~()*!.\'')
-      authString = "SharedAccessSignature sr=" + sr + "&sig=" + sigEncoded + "&se=" + str(expires) + "&skn=registration"
-
-    headers = {
-      "content-type": "application/json; charset=utf-8",
-      "user-agent": "iot-central-client/1.0",
-      "Accept": "*/*"
-    }
-
-    if authString != None:
-      headers["authorization"] = authString
-
-    if self._modelData != None:
-      body = "{\"registrationId\":\"%s\",\"data\":%s}" % (self._deviceId, json.dumps(self._modelData))
-    else:
-      body = "{\"registrationId\":\"%s\"}" % (self._deviceId)
-
-    uri = "https://%s/%s/registrations/%s/register?api-version=%s" % (self._dpsEndPoint, self._scopeId, self._deviceId, self._dpsAPIVersion)
-    target = urlparse(uri)
+    if self._connectCachedHost() == 0:
+      return 0
 
-    content = _request(self, target.geturl(), "PUT", body, headers)
-    data = None
-    try:
-      data = json.loads(content.decode("utf-8"))
-    except:
-      try:
-        data = json.loads(content)
-      except Exception as e:
-        err = "ERROR: non JSON is received from %s => %s .. message : %s", (self._dpsEndPoint, content, str(e))
-        LOG_IOTC(err)
-        return self._mqttConnect(err, None)
-
-    if 'errorCode' in data:
-      err = "DPS => " + str(data)
+    hostName, err = self._provision()
+    if err != None:
       return self._mqttConnect(err, None)
-    else:
-      time.sleep(1)
-      return self._loopAssign(data['operationId'], headers)
+
+    self._assigned(hostName)
+    return self._mqttConnect(None, self._hostName)
 
   def _gen_sas_token(self, hub_host, device_name, key):
     token_expiry = int(time.time() + self._tokenExpires)
+    self._tokenExpiresAt = token_expiry
     uri = hub_host + "%2Fdevices%2F" + device_name
     signed_hmac_sha256 = self._computeDrivedSymmetricKey(key, uri + "\n" + str(token_expiry))
     signature = _quote(signed_hmac_sha256, '~()*!.\'')
@@ -690,27 +3109,36 @@ class Device:
     token = 'SharedAccessSignature sr={}&sig={}&se={}'.format(uri, signature, token_expiry)
     return token
 
-  def _sendCommon(self, topic, data, noEvent = None):
+  def _sendCommon(self, topic, data, noEvent = None, payloads = None):
+    payload = None
+    if noEvent == None:
+      payload = data if payloads == None else payloads
+
     if mqtt != None:
+      if payload != None and self._inFlight.isFull():
+        LOG_IOTC("ERROR: (sendTelemetry) %d messages are waiting for acknowledgement.", IOTLogLevel.IOTC_LOGGING_API_ONLY, len(self._inFlight), device=self._deviceId)
+        self._messageFailed()
+        return 1
       (result, msg_id) = self._mqtts.publish(topic, data, qos=gQOS_LEVEL)
       if result != mqtt.MQTT_ERR_SUCCESS:
-        LOG_IOTC("ERROR: (sendTelemetry) failed to send. MQTT client return value: " + str(result) + "")
+        LOG_IOTC("ERROR: (sendTelemetry) failed to send. MQTT client return value: %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, result, device=self._deviceId)
+        self._messageFailed()
         return 1
-    else:
+      self._metrics.published(data)
+      self._trackMessage(msg_id, payload)
+    else: # umqtt publish returns after PUBACK
+      sent = time.time()
       self._mqtts.publish(topic, data, qos=gQOS_LEVEL)
-      msg_id = 0
-      self._messages[str(msg_id)] = None
-
-    if noEvent == None:
-      self._messages[str(msg_id)] = data
-      if mqtt == None:
-        self._onPublish(None, topic, msg_id)
+      self._metrics.published(data)
+      self._messageAcked(time.time() - sent)
+      self._messageSent(payload, topic, 0)
 
     return 0
 
-  def sendTelemetry(self, data, systemProperties = None):
-    LOG_IOTC("- iotc :: sendTelemetry :: " + data, IOTLogLevel.IOTC_LOGGING_ALL)
-    topic = 'devices/{}/messages/events/'.format(self._deviceId)
+  def _telemetryTopic(self, systemProperties, encoder = None):
+    if self._telemetryBase == None:
+      self._telemetryBase = 'devices/{}/messages/events/'.format(self._deviceId)
+    topic = self._telemetryBase
 
     if systemProperties != None:
       firstProp = True
@@ -721,29 +3149,130 @@ class Device:
           firstProp = False
         topic += prop + '=' + str(systemProperties[prop])
 
+    if encoder != None and (systemProperties == None or not "$.ct" in systemProperties):
+      topic += encoder.topicProperties if systemProperties == None or len(systemProperties) == 0 else "&" + encoder.topicProperties
+    return topic
+
+  def _encodeTelemetry(self, data, systemProperties):
+    # => topic, payload. dict / list go through the encoder, bytes are not copied
+    encoder = None
+    if isinstance(data, (dict, list)):
+      encoder = self._encoder
+      data = encoder.encode(data)
+    elif isinstance(data, memoryview):
+      data = _payloadBuffer(data)
+    return self._telemetryTopic(systemProperties, encoder), data
+
+  def _encodeReported(self, data):
+    # => payload, patch. reported properties are always JSON
+    if isinstance(data, dict):
+      encoder = self._encoder if self._encoder.isJSON else gJSONEncoder
+      return encoder.encode(data), data
+    if isinstance(data, memoryview):
+      data = _payloadBuffer(data)
+    return data, self._parseReported(data)
+
+  def sendTelemetry(self, data, systemProperties = None):
+    encoded = isinstance(data, (dict, list))
+    batchable = self._batch != None and (self._encoder.isJSON or not encoded)
+    topic, data = self._encodeTelemetry(data, systemProperties)
+    LOG_IOTC("- iotc :: sendTelemetry :: %s", IOTLogLevel.IOTC_LOGGING_ALL, data, device=self._deviceId, topic=topic)
+    if batchable and encoded and _isBinary(data): # UTF-8 JSON from the encoder (orjson)
+      data = data.decode('utf-8')
+    if batchable and not _isBinary(data): # a batch is a JSON array of text payloads
+      return self._batch.add(self, topic, data)
+    ret = 0
+    if self._batch != None: # what was batched before goes out first
+      ret = self._batch.flush(self)
+    return ret | self._sendTelemetryMessage(topic, data)
+
+  def _sendTelemetryMessage(self, topic, data):
+    if self._queue != None:
+      return self._queue.send(self, topic, data)
+    return self._publishTelemetry(topic, data)
+
+  def _publishTelemetry(self, topic, data):
+    if isinstance(data, list): # batch
+      LOG_IOTC("- iotc :: batch :: %d messages", IOTLogLevel.IOTC_LOGGING_ALL, len(data), device=self._deviceId, topic=topic)
+      return self._sendCommon(topic, "[" + ",".join(data) + "]", None, _BatchedPayloads(data))
     return self._sendCommon(topic, data)
 
+  def _isLinkUp(self):
+    if self._mqtts == None or not self._mqttConnected:
+      return False
+    try:
+      return self._mqtts.is_connected()
+    except AttributeError:
+      return True
+
   def sendState(self, data):
     return self.sendTelemetry(data)
 
   def sendEvent(self, data):
     return self.sendTelemetry(data)
 
-  def sendProperty(self, data):
-    LOG_IOTC("- iotc :: sendProperty :: " + data, IOTLogLevel.IOTC_LOGGING_ALL)
-    topic = '$iothub/twin/PATCH/properties/reported/?$rid={}'.format(int(time.time()))
+  def _nextRequestId(self):
+    with self._requestIdLock:
+      self._requestId = self._requestId + 1
+      return str(self._requestId)
 
-    return self._sendCommon(topic, data)
+  def _parseReported(self, data):
+    # => the reported properties patch in `data` or None
+    try:
+      patch = json.loads(data)
+    except Exception:
+      return None
+    return patch if isinstance(patch, dict) else None
+
+  def _reportedTopic(self, patch):
+    rid = self._nextRequestId()
+    if patch != None: # applied to the local twin when the hub accepts it
+      self._twin.addPending(rid, patch)
+    return rid, '$iothub/twin/PATCH/properties/reported/?$rid=' + rid
+
+  def _sendReported(self, data, patch, noEvent = None, payloads = None):
+    rid, topic = self._reportedTopic(patch)
+    ret = self._sendCommon(topic, data, noEvent, payloads)
+    if ret != 0:
+      self._twin.reject(rid)
+    return ret
+
+  def sendProperty(self, data):
+    LOG_IOTC("- iotc :: sendProperty :: %s", IOTLogLevel.IOTC_LOGGING_ALL, data, device=self._deviceId)
+    data, patch = self._encodeReported(data)
+    if self._coalescer != None and patch != None:
+      return self._coalescer.add(self, data, patch)
+    return self._sendReported(data, patch)
+
+  def reportProperties(self, properties):
+    # sends only the properties that differ from the hub's copy, nothing if none do
+    patch = self._twin.reportedDelta(properties)
+    if len(patch) == 0:
+      LOG_IOTC("- iotc :: reportProperties :: unchanged", IOTLogLevel.IOTC_LOGGING_ALL, device=self._deviceId)
+      return 0
+    data, _ = self._encodeReported(patch)
+    LOG_IOTC("- iotc :: reportProperties :: %s", IOTLogLevel.IOTC_LOGGING_ALL, data, device=self._deviceId)
+    if self._coalescer != None:
+      return self._coalescer.add(self, data, patch)
+    return self._sendReported(data, patch)
+
+  def getLocalTwin(self):
+    # local copy of the twin (desired and reported, with their `$version`)
+    return self._twin.toDict()
 
   def disconnect(self):
     if not self.isConnected():
       return
 
     LOG_IOTC("- iotc :: disconnect :: ", IOTLogLevel.IOTC_LOGGING_ALL)
+    self._cancelTokenRenewal()
+    self.flushBatch()
+    if self._coalescer != None: # `flushProperties` is a coroutine on AsyncDevice
+      self._coalescer.flush(self)
     self._mqttConnected = False
     if mqtt != None:
       self._mqtts.disconnect()
-      self._mqtts.loop_stop()
+      self._stopMQTTLoop()
     else:
       MAKE_CALLBACK(self, "ConnectionStatus", None, None, 0)
     return 0
@@ -758,6 +3287,20 @@ class Device:
   def doNext(self, idleTime=1):
     if not self.isConnected():
       return
+    if self._batch != None:
+      self._batch.flushIfDue(self)
+    if self._coalescer != None:
+      self._coalescer.flushIfDue(self)
+    if self._queue != None and _getScheduler() == None:
+      self._queue.drain(self)
+    if self._tokenRenewAt != None and self._renewalEntry == None and self._tokenRenewAt <= time.time():
+      self._renewToken()
+    if self._inFlightTimer == None and self._inFlight.nextDeadline() != None:
+      self._expireInFlight()
+    if len(self._twinRequests) > 0 and _getScheduler() == None:
+      self._expireTwinRequests()
+    if len(self._commands) > 0 and _getScheduler() == None:
+      self._expireCommands()
     if mqtt == None:
       try: # try non-blocking
         self._mqtts.check_msg()
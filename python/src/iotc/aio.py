@@ -0,0 +1,489 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+# asyncio flavor of `iotc.Device`. Requires Python 3.5+ and `paho-mqtt`.
+# MQTT socket I/O is driven by the event loop (no network thread per device),
+# DPS requests run on the loop's default executor.
+
+import asyncio
+import threading
+import time
+
+import iotc
+from iotc import Device, IOTCallbackExecutor, IOTLogLevel, LOG_IOTC, MAKE_CALLBACK, _requestDetails
+
+# the loop running the calling coroutine (`get_running_loop` is 3.7+)
+_runningLoop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)
+
+class AsyncCallbackExecutor(IOTCallbackExecutor):
+  # runs event handlers as tasks on the event loop. handlers may be coroutine
+  # functions; a device's callbacks run in order, devices interleave while awaiting
+  def __init__(self, loop = None):
+    IOTCallbackExecutor.__init__(self, 1)
+    self._loop = loop
+
+  def submit(self, client, handler, info, onComplete = None):
+    loop = self._loop if self._loop != None else client._loop
+    with self._cond:
+      queue = self._queues.get(client)
+      start = queue == None
+      if start:
+        queue = iotc.deque()
+        self._queues[client] = queue
+      queue.append((time.time(), handler, info, onComplete))
+      self._depth = self._depth + 1
+      if self._depth > self._peakDepth:
+        self._peakDepth = self._depth
+    if start:
+      loop.call_soon_threadsafe(loop.create_task, self._drain(client))
+    return 0
+
+  async def _drain(self, client):
+    while True:
+      with self._cond:
+        queue = self._queues[client]
+        if len(queue) == 0:
+          del self._queues[client]
+          return
+        task = queue.popleft()
+        self._depth = self._depth - 1
+
+      handler, info, onComplete = task[1], task[2], task[3]
+      try:
+        if handler != None:
+          ret = handler(info)
+          if asyncio.iscoroutine(ret):
+            await ret
+      except Exception as e:
+        LOG_IOTC("ERROR: (%s) callback has failed => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, info.getEventName(), e)
+      try:
+        if onComplete != None:
+          onComplete(info)
+      except Exception as e:
+        LOG_IOTC("ERROR: (AsyncCallbackExecutor) %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, e)
+      self._completed = self._completed + 1
+
+  def _futureOf(self, client, ret):
+    if asyncio.iscoroutine(ret):
+      return asyncio.run_coroutine_threadsafe(ret, self._loop if self._loop != None else client._loop)
+    return None
+
+  async def flush(self, timeout = None):
+    # => True when every submitted callback has completed
+    deadline = None if timeout == None else time.time() + timeout
+    while len(self._queues) > 0:
+      if deadline != None and time.time() >= deadline:
+        return False
+      await asyncio.sleep(0.005)
+    return True
+
+  async def shutdown(self, wait = True, timeout = None):
+    if wait:
+      await self.flush(timeout)
+    return 0
+
+class _LoopReportedCoalescer:
+  # `iotc._ReportedCoalescer` for AsyncDevice: the window is timed and flushed on
+  # the event loop, every write of a window awaits the ack of the combined PATCH
+  def __init__(self, windowMs):
+    self._window = windowMs / 1000.0
+    self._patch = None
+    self._payloads = []
+    self._future = None
+    self._timer = None
+
+  def _take(self):
+    taken = None
+    if self._patch != None:
+      taken = (self._patch, self._payloads, self._future)
+    if self._timer != None:
+      self._timer.cancel()
+    self._patch = None
+    self._payloads = []
+    self._future = None
+    self._timer = None
+    return taken
+
+  def add(self, device, data, patch):
+    # => future of the PATCH this write goes out with
+    if self._patch == None:
+      self._patch = {}
+      self._future = device._loop.create_future()
+      self._timer = device._loop.call_later(self._window, self.flush, device)
+    iotc._composePatch(self._patch, patch) # last writer wins per property
+    self._payloads.append(data)
+    return self._future
+
+  def flush(self, device):
+    # => future resolving with 0 once the PATCH is acknowledged, None when nothing is pending
+    taken = self._take()
+    if taken == None:
+      return None
+    patch, payloads, future = taken
+    rid, topic = device._reportedTopic(patch)
+    published = device._publishAsync(topic, device._encodeReported(patch)[0], None, iotc._BatchedPayloads(payloads))
+    device._loop.create_task(device._finishReported(rid, published, future))
+    return future
+
+class AsyncDevice(Device):
+  def __init__(self, scopeId, keyORCert, deviceId, credType):
+    Device.__init__(self, scopeId, keyORCert, deviceId, credType)
+    self._loop = None
+    self._loopThreadId = None
+    self._miscTask = None
+    self._connectFuture = None
+    self._publishFutures = {}
+    self._renewalHandle = None
+
+  async def _provision(self):
+    steps = self._provisionSteps()
+    step = next(steps)
+    while step[0] != "done":
+      if step[0] == "wait":
+        await asyncio.sleep(step[1])
+        step = next(steps)
+      else:
+        reply = await self._loop.run_in_executor(None, _requestDetails, self, step[2], step[1], step[3], step[4])
+        step = steps.send(reply)
+    return step[1], step[2]
+
+  async def connect(self, hostName = None):
+    LOG_IOTC("- iotc :: connect :: ", IOTLogLevel.IOTC_LOGGING_ALL)
+    self._loop = _runningLoop()
+    self._loopThreadId = threading.current_thread().ident
+
+    if iotc._requireMQTT() == None: # raises IOTDependencyError before any network I/O
+      LOG_IOTC("ERROR: AsyncDevice requires `paho-mqtt`")
+      return 1
+
+    if hostName != None:
+      self._hostName = hostName
+      return await self._mqttConnectAsync(hostName, self._connectTimeout)
+
+    hostName = self._cachedHostName()
+    if hostName != None:
+      self._hostName = hostName
+      self._probingCachedHost = True
+      try:
+        if await self._mqttConnectAsync(hostName, self._cachedConnectTimeout) == 0:
+          return 0
+      except Exception as e: # DNS, socket.. fall back to DPS
+        LOG_IOTC("ERROR : (connect) cached hub `%s` is not reachable => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, hostName, e, device=self._deviceId)
+        self._connectResult = 3
+      finally:
+        self._probingCachedHost = False
+      self._cachedHostFailed(hostName)
+
+    hostName, err = await self._provision()
+    if err != None:
+      LOG_IOTC("ERROR : (connect) %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, err, device=self._deviceId)
+      return 1
+
+    self._assigned(hostName)
+    return await self._mqttConnectAsync(hostName, self._connectTimeout)
+
+  async def _mqttConnectAsync(self, hostName, timeout):
+    LOG_IOTC("- iotc :: _mqttConnect :: %s", IOTLogLevel.IOTC_LOGGING_ALL, hostName, device=self._deviceId)
+    username, passwd = self._mqttCredentials(hostName)
+    self._connectFuture = self._loop.create_future()
+    self._connectResult = None
+    iotc._createMQTTClient(self, username, passwd)
+
+    try: # TCP + TLS handshake are blocking in paho
+      await self._loop.run_in_executor(None, self._mqtts.reconnect)
+    except Exception as e:
+      LOG_IOTC("ERROR : (connect) %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, e, device=self._deviceId)
+      self._connectResult = 3 # not reachable
+      return 1
+
+    try:
+      rc = await asyncio.wait_for(self._connectFuture, timeout)
+    except asyncio.TimeoutError:
+      LOG_IOTC("ERROR : (connect) CONNACK timeout")
+      self._closeMQTTClient() # don't leave the socket and its reader attached to the loop
+      return 1
+    finally:
+      self._connectFuture = None
+
+    if rc != 0 or not self.isConnected():
+      self._closeMQTTClient()
+      return 1
+
+    self._subscribe()
+    if self._renewingToken: # same twin, no need to fetch it and report every setting again
+      self._scheduleTokenRenewal()
+      return 0
+
+    if await self.getDeviceSettings() == None:
+      return 1
+
+    self._scheduleTokenRenewal()
+    MAKE_CALLBACK(self, "ConnectionStatus", None, None, 0)
+    return 0
+
+  def _scheduleTokenRenewal(self):
+    self._cancelTokenRenewal()
+    if not self._tokenRenewal or self._tokenExpiresAt == None:
+      return
+    self._renewalHandle = self._loop.call_later(self._tokenRenewalDelay(), self._startTokenRenewal)
+
+  def _cancelTokenRenewal(self):
+    if self._renewalHandle != None:
+      self._renewalHandle.cancel()
+      self._renewalHandle = None
+
+  def _startTokenRenewal(self):
+    self._renewalHandle = None
+    self._loop.create_task(self._renewToken())
+
+  async def _renewToken(self):
+    if not self.isConnected():
+      return 1
+
+    hostName = self._hostName
+    LOG_IOTC("- iotc :: renewing SAS token :: %s", IOTLogLevel.IOTC_LOGGING_ALL, hostName, device=self._deviceId)
+    self._renewingToken = True
+    try:
+      self._closeMQTTClient()
+      ret = await self._mqttConnectAsync(hostName, self._cachedConnectTimeout)
+    finally:
+      self._renewingToken = False
+
+    if ret != 0:
+      LOG_IOTC("WARNING: token renewal on `%s` has failed. Connecting again.", IOTLogLevel.IOTC_LOGGING_API_ONLY, hostName, device=self._deviceId)
+      self._closeMQTTClient()
+      ret = await self.connect()
+    return ret
+
+  def _callInLoop(self, fn, *args):
+    if threading.current_thread().ident == self._loopThreadId:
+      fn(*args)
+    else:
+      self._loop.call_soon_threadsafe(fn, *args)
+
+  def _startMQTTLoop(self):
+    self._mqtts.on_socket_open = self._onSocketOpen
+    self._mqtts.on_socket_close = self._onSocketClose
+    self._mqtts.on_socket_register_write = self._onSocketRegisterWrite
+    self._mqtts.on_socket_unregister_write = self._onSocketUnregisterWrite
+    host, port = iotc._splitEndpoint(self._hostname, 8883)
+    self._mqtts.connect_async(host, port=port, keepalive=120)
+
+  def _stopMQTTLoop(self):
+    # socket is detached from the loop by `on_socket_close`
+    pass
+
+  def _onSocketOpen(self, client, userdata, sock):
+    self._callInLoop(self._attachSocket, client, sock)
+
+  def _attachSocket(self, client, sock):
+    self._loop.add_reader(sock, client.loop_read)
+    if self._miscTask == None or self._miscTask[0] is not client:
+      self._miscTask = (client, self._loop.create_task(self._miscLoop(client)))
+
+  def _onSocketClose(self, client, userdata, sock):
+    self._callInLoop(self._loop.remove_reader, sock)
+
+  def _onSocketRegisterWrite(self, client, userdata, sock):
+    self._callInLoop(self._loop.add_writer, sock, client.loop_write)
+
+  def _onSocketUnregisterWrite(self, client, userdata, sock):
+    self._callInLoop(self._loop.remove_writer, sock)
+
+  async def _miscLoop(self, client):
+    while client.loop_misc() == iotc.MQTT_SUCCESS:
+      await asyncio.sleep(1)
+    if self._miscTask != None and self._miscTask[0] is client:
+      self._miscTask = None
+
+  def _onConnect(self, client, userdata, _, rc):
+    Device._onConnect(self, client, userdata, _, rc)
+    if self._connectFuture != None and not self._connectFuture.done():
+      self._connectFuture.set_result(rc)
+
+  def _onDisconnect(self, client, userdata, rc):
+    if self._isStaleClient(client):
+      return
+    Device._onDisconnect(self, client, userdata, rc)
+    if self._connectFuture != None and not self._connectFuture.done():
+      self._connectFuture.set_result(rc if rc != 0 else 1)
+
+  def _onPublish(self, client, data, msgid):
+    Device._onPublish(self, client, data, msgid)
+    future = self._publishFutures.pop(msgid, None)
+    if future != None and not future.done():
+      future.set_result(0)
+
+  def _scheduleInFlightExpiry(self):
+    if self._inFlightTimer != None or self._loop == None:
+      return
+    deadline = self._inFlight.nextDeadline()
+    if deadline != None:
+      self._inFlightTimer = self._loop.call_later(max(0, deadline - time.time()), self._expireInFlight)
+
+  def _scheduleTimeout(self, delay, fn, *args):
+    return self._loop.call_later(delay, fn, *args)
+
+  def _cancelTimeout(self, timer):
+    self._callInLoop(timer.cancel)
+
+  def _invokeSettingsUpdated(self, info):
+    ret = Device._invokeSettingsUpdated(self, info)
+    if asyncio.iscoroutine(ret):
+      return self._awaitSettingsUpdated(info, ret)
+    return ret
+
+  async def _awaitSettingsUpdated(self, info, coro):
+    # a coroutine handler that raises acknowledges its setting with 500 too
+    try:
+      await coro
+    except Exception as e:
+      self._settingsUpdateFailed(info, e)
+
+  def _commandFuture(self, ret):
+    # coroutine returned by a `Command` handler runs as a task on the loop
+    future = Device._commandFuture(self, ret)
+    if future == None and asyncio.iscoroutine(ret):
+      future = asyncio.run_coroutine_threadsafe(ret, self._loop)
+    return future
+
+  def _publishTwinRequest(self, topic, data):
+    msgid, published = self._publishAsync(topic, data, True)
+    if not published.done(): # the twin response completes the request, not the PUBACK
+      self._publishFutures.pop(msgid, None)
+      return 0
+    return published.result()
+
+  def _awaitRequest(self, request):
+    future = self._loop.create_future()
+    def resolve(request):
+      if not future.done():
+        future.set_result(request)
+    request.addDoneCallback(lambda request: self._callInLoop(resolve, request))
+    return future
+
+  def _publishAsync(self, topic, data, noEvent = None, payloads = None):
+    future = self._loop.create_future()
+    if noEvent == None and self._inFlight.isFull():
+      LOG_IOTC("ERROR: (_publishAsync) %d messages are waiting for acknowledgement.", IOTLogLevel.IOTC_LOGGING_API_ONLY, len(self._inFlight), device=self._deviceId)
+      self._messageFailed()
+      future.set_result(1)
+      return None, future
+    info = self._mqtts.publish(topic, data, qos=iotc.gQOS_LEVEL)
+    if info.rc != iotc.MQTT_SUCCESS:
+      LOG_IOTC("ERROR: (_publishAsync) failed to send. MQTT client return value: %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, info.rc, device=self._deviceId)
+      self._messageFailed()
+      future.set_result(1)
+      return info.mid, future
+    self._metrics.published(data)
+
+    # written inline `on_publish` has fired before we knew the msgid, the tracker matches it
+    self._trackMessage(info.mid, None if noEvent != None else data if payloads == None else payloads)
+    if info.is_published():
+      future.set_result(0)
+    else:
+      self._publishFutures[info.mid] = future
+    return info.mid, future
+
+  async def _waitForPublish(self, topic, data, noEvent = None):
+    return await self._awaitPublish(self._publishAsync(topic, data, noEvent))
+
+  async def _awaitPublish(self, published):
+    msgid, future = published
+    try:
+      return await asyncio.wait_for(future, self._requestTimeout)
+    except asyncio.TimeoutError:
+      LOG_IOTC("ERROR: publish %s was not acknowledged in time", IOTLogLevel.IOTC_LOGGING_API_ONLY, msgid, device=self._deviceId)
+      self._publishFutures.pop(msgid, None) # the tracker raises `MessageTimeout`
+      return 1
+
+  def enableBatching(self, maxMessages = 100, maxBytes = 65536, lingerMs = 100):
+    # every `sendTelemetry` is awaited on its own PUBACK
+    LOG_IOTC("ERROR: (enableBatching) is not supported by AsyncDevice.")
+    return 1
+
+  def enableOutboundQueue(self, maxMessages = 1000, overflowPolicy = None, path = None, replayRate = 100, blockTimeout = None):
+    # an offline `sendTelemetry` resolves with 1, the application decides what to keep
+    LOG_IOTC("ERROR: (enableOutboundQueue) is not supported by AsyncDevice.")
+    return 1
+
+  async def sendTelemetry(self, data, systemProperties = None):
+    topic, data = self._encodeTelemetry(data, systemProperties)
+    LOG_IOTC("- iotc :: sendTelemetry :: %s", IOTLogLevel.IOTC_LOGGING_ALL, data, device=self._deviceId, topic=topic)
+    return await self._waitForPublish(topic, data)
+
+  async def sendState(self, data):
+    return await self.sendTelemetry(data)
+
+  async def sendEvent(self, data):
+    return await self.sendTelemetry(data)
+
+  async def _sendReportedAsync(self, data, patch):
+    rid, topic = self._reportedTopic(patch)
+    ret = await self._waitForPublish(topic, data)
+    if ret != 0:
+      self._twin.reject(rid)
+    return ret
+
+  async def _finishReported(self, rid, published, future):
+    ret = await self._awaitPublish(published)
+    if ret != 0:
+      self._twin.reject(rid)
+    if not future.done():
+      future.set_result(ret)
+
+  def enablePropertyCoalescing(self, windowMs = 100):
+    if windowMs < 0:
+      LOG_IOTC("ERROR: (enablePropertyCoalescing) invalid argument.")
+      return 1
+
+    self.disablePropertyCoalescing()
+    self._coalescer = _LoopReportedCoalescer(windowMs)
+    return 0
+
+  def disablePropertyCoalescing(self):
+    # what is pending goes out now, its writers still await the PATCH ack
+    if self._coalescer != None:
+      coalescer = self._coalescer
+      self._coalescer = None
+      coalescer.flush(self)
+    return 0
+
+  async def flushProperties(self):
+    future = self._coalescer.flush(self) if self._coalescer != None else None
+    if future == None:
+      return 0
+    return await future
+
+  async def sendProperty(self, data):
+    LOG_IOTC("- iotc :: sendProperty :: %s", IOTLogLevel.IOTC_LOGGING_ALL, data, device=self._deviceId)
+    data, patch = self._encodeReported(data)
+    if self._coalescer != None and patch != None:
+      return await self._coalescer.add(self, data, patch)
+    return await self._sendReportedAsync(data, patch)
+
+  async def reportProperties(self, properties):
+    patch = self._twin.reportedDelta(properties)
+    if len(patch) == 0:
+      return 0
+    data, _ = self._encodeReported(patch)
+    if self._coalescer != None:
+      return await self._coalescer.add(self, data, patch)
+    return await self._sendReportedAsync(data, patch)
+
+  async def getTwin(self, timeout = None):
+    return await self._awaitRequest(Device.getTwin(self, timeout))
+
+  async def patchReported(self, properties, timeout = None):
+    return await self._awaitRequest(Device.patchReported(self, properties, timeout))
+
+  async def getDeviceSettings(self):
+    # => the twin or None, SettingsUpdated fires for each desired property
+    LOG_IOTC("- iotc :: getDeviceSettings :: ", IOTLogLevel.IOTC_LOGGING_ALL)
+    request = await self._awaitRequest(self._startTwinRequest("$iothub/twin/GET/?$rid=", " ", None, True, None))
+    if request.getStatusCode() != 200:
+      return None
+    return request.getBody()
+
+  async def doNext(self, idleTime=1):
+    await asyncio.sleep(idleTime)
@@ -0,0 +1,490 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+# Local DPS + IoT Hub emulator for end-to-end, throughput and latency tests
+# without a cloud application. Requires Python 3.5+.
+#
+#   cafile, certfile, keyfile = createCertificates(folder)
+#   emulator = IOTEmulator(certfile, keyfile)
+#   emulator.start()
+#   device.setDPSEndpoint(emulator.getDPSEndpoint())
+#   device.setCACertificate(cafile)
+#
+# DPS `register` / `operations` are served over HTTPS, the hub over MQTT/TLS
+# (telemetry, twin GET / reported PATCH, desired patches, direct methods and
+# C2D). Every device id and credential is accepted.
+
+import asyncio
+import concurrent.futures
+import json
+import os
+import ssl
+import struct
+import subprocess
+import threading
+import time
+
+import iotc
+from iotc import IOTDependencyError, IOTLogLevel, LOG_IOTC, _mergePatch
+
+def createCertificates(folder, hostName = "localhost"):
+  # => cafile, certfile, keyfile. a throwaway CA and a server certificate for
+  # `hostName` and 127.0.0.1, created with the `openssl` command line tool
+  cafile = os.path.join(folder, "emulator-ca.pem")
+  cakey = os.path.join(folder, "emulator-ca.key")
+  certfile = os.path.join(folder, "emulator-server.pem")
+  keyfile = os.path.join(folder, "emulator-server.key")
+  csr = os.path.join(folder, "emulator-server.csr")
+  extfile = os.path.join(folder, "emulator-server.cnf")
+  with open(extfile, "w") as ext:
+    ext.write("basicConstraints=CA:FALSE\nauthorityKeyIdentifier=keyid,issuer\n")
+    ext.write("subjectAltName=DNS:{},IP:127.0.0.1\n".format(hostName))
+
+  newKey = ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1", "-nodes"]
+  commands = [
+    ["openssl", "req", "-x509"] + newKey + ["-keyout", cakey, "-out", cafile, "-days", "3650",
+      "-subj", "/CN=iotc emulator CA", "-addext", "basicConstraints=critical,CA:TRUE",
+      "-addext", "keyUsage=critical,keyCertSign,cRLSign"],
+    ["openssl", "req"] + newKey + ["-keyout", keyfile, "-out", csr, "-subj", "/CN=" + hostName],
+    ["openssl", "x509", "-req", "-in", csr, "-CA", cafile, "-CAkey", cakey, "-CAcreateserial",
+      "-out", certfile, "-days", "3650", "-extfile", extfile]
+  ]
+  for command in commands:
+    try:
+      subprocess.check_output(command, stderr=subprocess.STDOUT)
+    except OSError:
+      raise IOTDependencyError("openssl")
+  return cafile, certfile, keyfile
+
+def _encodeLength(length):
+  encoded = bytearray()
+  while True:
+    byte = length % 128
+    length = length // 128
+    if length > 0:
+      byte = byte | 0x80
+    encoded.append(byte)
+    if length == 0:
+      return bytes(encoded)
+
+def _packet(header, body):
+  return bytes([header]) + _encodeLength(len(body)) + body
+
+def _string(value):
+  if not isinstance(value, bytes):
+    value = value.encode("utf-8")
+  return struct.pack("!H", len(value)) + value
+
+def _readString(body, index):
+  # => value, next index
+  length = struct.unpack("!H", body[index:index + 2])[0]
+  return body[index + 2:index + 2 + length].decode("utf-8"), index + 2 + length
+
+def _filterMatches(topicFilter, topic):
+  filterLevels = topicFilter.split('/')
+  topicLevels = topic.split('/')
+  for index, level in enumerate(filterLevels):
+    if level == '#':
+      return True
+    if index >= len(topicLevels) or (level != '+' and level != topicLevels[index]):
+      return False
+  return len(filterLevels) == len(topicLevels)
+
+def _queryValue(topic, name):
+  index = topic.find('?')
+  if index == -1:
+    return None
+  for pair in topic[index + 1:].split('&'):
+    if pair.startswith(name + '='):
+      return pair[len(name) + 1:]
+  return None
+
+class _Session:
+  # one device MQTT connection
+  def __init__(self, emulator, reader, writer):
+    self._emulator = emulator
+    self._reader = reader
+    self._writer = writer
+    self.deviceId = None
+    self.subscriptions = []
+
+  async def _readPacket(self):
+    header = await self._reader.readexactly(1)
+    multiplier = 1
+    length = 0
+    while True:
+      byte = (await self._reader.readexactly(1))[0]
+      length = length + (byte & 127) * multiplier
+      multiplier = multiplier * 128
+      if byte & 128 == 0:
+        break
+    return header[0], await self._reader.readexactly(length)
+
+  def write(self, data):
+    self._writer.write(data)
+
+  def publish(self, topic, payload):
+    # QoS 0, only when the device has subscribed to the topic like the hub does
+    if not any(_filterMatches(topicFilter, topic) for topicFilter in self.subscriptions):
+      return False
+    if not isinstance(payload, bytes):
+      payload = payload.encode("utf-8")
+    self._writer.write(_packet(0x30, _string(topic) + payload))
+    return True
+
+  async def serve(self):
+    try:
+      while True:
+        header, body = await self._readPacket()
+        packetType = header >> 4
+        if packetType == 1: # CONNECT
+          if not self._onConnect(body):
+            break
+        elif packetType == 3: # PUBLISH
+          self._onPublish(header, body)
+        elif packetType == 8: # SUBSCRIBE
+          self._onSubscribe(body)
+        elif packetType == 10: # UNSUBSCRIBE
+          self._onUnsubscribe(body)
+        elif packetType == 12: # PINGREQ
+          self.write(_packet(0xd0, b""))
+        elif packetType == 14: # DISCONNECT
+          break
+        await self._writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+      pass
+    finally:
+      self._emulator._sessionClosed(self)
+      self._writer.close()
+
+  def _onConnect(self, body):
+    _, index = _readString(body, 0) # protocol name
+    flags = body[index + 1]
+    index = index + 4 # level, flags, keep alive
+    clientId, index = _readString(body, index)
+    if flags & 0x04: # will topic + message
+      _, index = _readString(body, index)
+      _, index = _readString(body, index)
+    if len(clientId) == 0:
+      self.write(_packet(0x20, b"\x00\x02")) # identifier rejected
+      return False
+    self.deviceId = clientId
+    self._emulator._sessionOpened(self)
+    self.write(_packet(0x20, b"\x00\x00"))
+    return True
+
+  def _onPublish(self, header, body):
+    qos = (header >> 1) & 3
+    topic, index = _readString(body, 0)
+    if qos > 0:
+      self.write(_packet(0x40, body[index:index + 2])) # PUBACK
+      index = index + 2
+    self._emulator._onDeviceMessage(self, topic, body[index:])
+
+  def _onSubscribe(self, body):
+    granted = bytearray()
+    index = 2
+    while index < len(body):
+      topicFilter, index = _readString(body, index)
+      granted.append(min(body[index], 1))
+      index = index + 1
+      self.subscriptions.append(topicFilter)
+    self.write(_packet(0x90, body[:2] + bytes(granted)))
+
+  def _onUnsubscribe(self, body):
+    index = 2
+    while index < len(body):
+      topicFilter, index = _readString(body, index)
+      if topicFilter in self.subscriptions:
+        self.subscriptions.remove(topicFilter)
+    self.write(_packet(0xb0, body[:2]))
+
+class IOTEmulator:
+  def __init__(self, certfile, keyfile, host = "127.0.0.1", dpsPort = 0, mqttPort = 0, hostName = "localhost", assigningPolls = 1):
+    # `hostName` has to match the server certificate. `assigningPolls` is the
+    # number of `assigning` answers before a registration is `assigned`
+    self._certfile = certfile
+    self._keyfile = keyfile
+    self._host = host
+    self._dpsPort = dpsPort
+    self._mqttPort = mqttPort
+    self._hostName = hostName
+    self._assigningPolls = assigningPolls
+    self._loop = None
+    self._thread = None
+    self._servers = []
+    self._sessions = {} # device id -> _Session
+    self._twins = {} # device id -> twin document
+    self._registrations = {} # operation id -> [device id, polls]
+    self._methods = {} # rid -> (future, timer)
+    self._connections = set() # stream writers
+    self._nextId = 0
+    self._telemetryCallback = None
+    self._stats = {
+      "registrations": 0,
+      "connections": 0,
+      "telemetry": 0,
+      "telemetryBytes": 0,
+      "twinRequests": 0,
+      "commands": 0,
+      "desiredPatches": 0,
+      "c2d": 0
+    }
+
+  def start(self, timeout = 10):
+    if self._thread != None:
+      return 0
+    started = threading.Event()
+    errors = []
+    def run():
+      self._loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(self._loop)
+      try:
+        self._loop.run_until_complete(self._listen())
+      except Exception as e:
+        errors.append(e)
+        started.set()
+        return
+      started.set()
+      self._loop.run_forever()
+      self._loop.close()
+
+    self._thread = threading.Thread(target=run, name="iotc-emulator")
+    self._thread.daemon = True
+    self._thread.start()
+    started.wait(timeout)
+    if len(errors) > 0 or len(self._servers) == 0:
+      LOG_IOTC("ERROR: (IOTEmulator) failed to start => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, errors[0] if errors else "timeout")
+      self._thread = None
+      return 1
+    return 0
+
+  async def _listen(self):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(self._certfile, self._keyfile)
+    dps = await asyncio.start_server(self._serveDPS, self._host, self._dpsPort, ssl=context)
+    hub = await asyncio.start_server(self._serveHub, self._host, self._mqttPort, ssl=context)
+    self._dpsPort = dps.sockets[0].getsockname()[1]
+    self._mqttPort = hub.sockets[0].getsockname()[1]
+    self._servers = [dps, hub]
+
+  def stop(self):
+    if self._thread == None:
+      return 0
+    asyncio.run_coroutine_threadsafe(self._close(), self._loop).result(5)
+    self._loop.call_soon_threadsafe(self._loop.stop)
+    self._thread.join(5)
+    self._thread = None
+    self._servers = []
+    return 0
+
+  async def _close(self):
+    for server in self._servers:
+      server.close()
+    for writer in list(self._connections): # open DPS and hub connections see EOF
+      writer.transport.abort()
+    deadline = time.time() + 2
+    while len(self._connections) > 0 and time.time() < deadline:
+      await asyncio.sleep(0.01)
+
+  def getDPSEndpoint(self):
+    # => "host:port" for `Device.setDPSEndpoint`
+    return "{}:{}".format(self._hostName, self._dpsPort)
+
+  def getHubHostName(self):
+    return "{}:{}".format(self._hostName, self._mqttPort)
+
+  def getStats(self):
+    stats = dict(self._stats)
+    stats["connected"] = len(self._sessions)
+    return stats
+
+  def isConnected(self, deviceId):
+    return deviceId in self._sessions
+
+  def getTwin(self, deviceId):
+    return iotc._copyValue(self._twin(deviceId))
+
+  def setTelemetryCallback(self, callback):
+    # `callback(deviceId, topic, payload)` for every telemetry message, on the emulator thread
+    self._telemetryCallback = callback
+    return 0
+
+  def sendCommand(self, deviceId, methodName, payload = None, timeout = 30):
+    # => concurrent.futures.Future of (status, payload text). 404 when the
+    # device isn't connected, 504 when it doesn't answer within `timeout`
+    future = concurrent.futures.Future()
+    self._loop.call_soon_threadsafe(self._sendCommand, future, deviceId, methodName, payload, timeout)
+    return future
+
+  def updateDesired(self, deviceId, properties):
+    # => concurrent.futures.Future of the new desired `$version`
+    return asyncio.run_coroutine_threadsafe(self._run(self._updateDesired, deviceId, properties), self._loop)
+
+  def sendC2D(self, deviceId, payload, properties = None):
+    # => concurrent.futures.Future, True when the device was subscribed
+    return asyncio.run_coroutine_threadsafe(self._run(self._sendC2D, deviceId, payload, properties), self._loop)
+
+  async def _run(self, fn, *args):
+    return fn(*args)
+
+  def _newId(self):
+    self._nextId = self._nextId + 1
+    return "{:x}".format(self._nextId)
+
+  def _twin(self, deviceId):
+    twin = self._twins.get(deviceId)
+    if twin == None:
+      twin = {"desired": {"$version": 1}, "reported": {"$version": 1}}
+      self._twins[deviceId] = twin
+    return twin
+
+  # DPS
+
+  async def _serveDPS(self, reader, writer):
+    self._connections.add(writer)
+    try:
+      while True:
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        method, path = lines[0].split(" ")[:2]
+        headers = {}
+        for line in lines[1:]:
+          if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", "0"))
+        body = await reader.readexactly(length) if length > 0 else b""
+        if path.startswith("https://"): # absolute form, as the client sends it
+          path = path[path.find('/', 8):]
+        status, reply = self._onDPSRequest(method, path.split('?')[0], body)
+        content = json.dumps(reply).encode("utf-8")
+        writer.write(("HTTP/1.1 {} {}\r\nContent-Type: application/json; charset=utf-8\r\n"
+          "Content-Length: {}\r\nRetry-After: 0\r\n\r\n").format(status, "OK" if status < 300 else "Error", len(content)).encode("latin-1") + content)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ssl.SSLError, ValueError):
+      pass
+    self._connections.discard(writer)
+    writer.close()
+
+  def _onDPSRequest(self, method, path, body):
+    # /{scope}/registrations/{id}/register, /{scope}/registrations/{id}/operations/{operation}
+    parts = path.strip('/').split('/')
+    if method == "PUT" and len(parts) == 4 and parts[1] == "registrations" and parts[3] == "register":
+      self._stats["registrations"] = self._stats["registrations"] + 1
+      operationId = self._newId()
+      self._registrations[operationId] = [parts[2], 0]
+      return self._registrationStatus(operationId)
+    if method == "GET" and len(parts) == 5 and parts[1] == "registrations" and parts[3] == "operations" and parts[4] in self._registrations:
+      return self._registrationStatus(parts[4])
+    return 404, {"errorCode": 404000, "message": "unknown request " + method + " " + path}
+
+  def _registrationStatus(self, operationId):
+    registration = self._registrations[operationId]
+    if registration[1] < self._assigningPolls:
+      registration[1] = registration[1] + 1
+      return 202, {"operationId": operationId, "status": "assigning"}
+    del self._registrations[operationId]
+    return 200, {"operationId": operationId, "status": "assigned", "registrationState": {
+      "registrationId": registration[0], "deviceId": registration[0], "assignedHub": self.getHubHostName(), "status": "assigned"}}
+
+  # IoT Hub
+
+  async def _serveHub(self, reader, writer):
+    self._connections.add(writer)
+    try:
+      await _Session(self, reader, writer).serve()
+    finally:
+      self._connections.discard(writer)
+
+  def _sessionOpened(self, session):
+    previous = self._sessions.get(session.deviceId)
+    if previous != None and previous is not session: # the hub drops the older connection
+      previous._writer.close()
+    self._sessions[session.deviceId] = session
+    self._stats["connections"] = self._stats["connections"] + 1
+
+  def _sessionClosed(self, session):
+    if self._sessions.get(session.deviceId) is session:
+      del self._sessions[session.deviceId]
+
+  def _onDeviceMessage(self, session, topic, payload):
+    deviceId = session.deviceId
+    if topic.startswith("devices/" + deviceId + "/messages/events/"):
+      self._stats["telemetry"] = self._stats["telemetry"] + 1
+      self._stats["telemetryBytes"] = self._stats["telemetryBytes"] + len(payload)
+      if self._telemetryCallback != None:
+        try:
+          self._telemetryCallback(deviceId, topic, payload)
+        except Exception as e:
+          LOG_IOTC("ERROR: (IOTEmulator) telemetry callback has failed => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, e)
+    elif topic.startswith("$iothub/twin/GET/"):
+      self._stats["twinRequests"] = self._stats["twinRequests"] + 1
+      rid = _queryValue(topic, "$rid")
+      session.publish("$iothub/twin/res/200/?$rid={}".format(rid), json.dumps(self._twin(deviceId)))
+    elif topic.startswith("$iothub/twin/PATCH/properties/reported/"):
+      self._stats["twinRequests"] = self._stats["twinRequests"] + 1
+      rid = _queryValue(topic, "$rid")
+      try:
+        patch = json.loads(payload.decode("utf-8"))
+      except ValueError:
+        session.publish("$iothub/twin/res/400/?$rid={}".format(rid), b"")
+        return
+      reported = self._twin(deviceId)["reported"]
+      patch.pop("$version", None)
+      _mergePatch(reported, patch)
+      reported["$version"] = reported["$version"] + 1
+      session.publish("$iothub/twin/res/204/?$rid={}&$version={}".format(rid, reported["$version"]), b"")
+    elif topic.startswith("$iothub/methods/res/"):
+      rid = _queryValue(topic, "$rid")
+      pending = self._methods.pop(rid, None)
+      if pending != None:
+        pending[1].cancel()
+        try:
+          status = int(topic.split('/')[3])
+        except ValueError:
+          status = 500
+        if not pending[0].done():
+          pending[0].set_result((status, payload.decode("utf-8")))
+
+  def _sendCommand(self, future, deviceId, methodName, payload, timeout):
+    self._stats["commands"] = self._stats["commands"] + 1
+    session = self._sessions.get(deviceId)
+    rid = self._newId()
+    if payload == None:
+      payload = "{}"
+    elif not isinstance(payload, (str, bytes)):
+      payload = json.dumps(payload)
+    if session == None or not session.publish("$iothub/methods/POST/{}/?$rid={}".format(methodName, rid), payload):
+      future.set_result((404, None))
+      return
+    self._methods[rid] = (future, self._loop.call_later(timeout, self._expireCommand, rid))
+
+  def _expireCommand(self, rid):
+    pending = self._methods.pop(rid, None)
+    if pending != None and not pending[0].done():
+      pending[0].set_result((504, None))
+
+  def _updateDesired(self, deviceId, properties):
+    self._stats["desiredPatches"] = self._stats["desiredPatches"] + 1
+    desired = self._twin(deviceId)["desired"]
+    _mergePatch(desired, properties)
+    desired["$version"] = desired["$version"] + 1
+    patch = dict(properties)
+    patch["$version"] = desired["$version"]
+    session = self._sessions.get(deviceId)
+    if session != None:
+      session.publish("$iothub/twin/PATCH/properties/desired/?$version={}".format(desired["$version"]), json.dumps(patch))
+    return desired["$version"]
+
+  def _sendC2D(self, deviceId, payload, properties):
+    self._stats["c2d"] = self._stats["c2d"] + 1
+    session = self._sessions.get(deviceId)
+    if session == None:
+      return False
+    topic = "devices/{}/messages/devicebound/".format(deviceId)
+    if properties != None:
+      topic = topic + "&".join("{}={}".format(iotc._topicValue(key), iotc._topicValue(str(value))) for key, value in properties.items())
+    if not isinstance(payload, (str, bytes)):
+      payload = json.dumps(payload)
+    return session.publish(topic, payload)
@@ -0,0 +1,463 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+# Many `iotc.Device` connections served by a few selector based network
+# threads instead of one paho `loop_start()` thread per device.
+# Requires Python 3.4+ and `paho-mqtt`.
+
+import collections
+import heapq
+import itertools
+import queue
+import selectors
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import iotc
+from iotc import Device, IOTLogLevel, LOG_IOTC, _requestDetails
+
+class ProvisioningResult:
+  def __init__(self, device, hostName, error, elapsed, cached):
+    self._device = device
+    self._hostName = hostName
+    self._error = error
+    self._elapsed = elapsed
+    self._cached = cached
+
+  def getDevice(self):
+    return self._device
+
+  def getHostName(self):
+    return self._hostName
+
+  def getError(self):
+    return self._error
+
+  def getElapsed(self):
+    return self._elapsed
+
+  def isCached(self):
+    return self._cached
+
+class _RateLimiter:
+  # token bucket, `rate` tokens per second with a one second burst
+  def __init__(self, rate):
+    self._rate = float(rate)
+    self._capacity = max(1.0, self._rate)
+    self._tokens = self._capacity
+    self._updated = time.time()
+
+  def reserve(self):
+    # => 0 when a token is taken, otherwise seconds until the next token
+    now = time.time()
+    self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+    self._updated = now
+    if self._tokens >= 1:
+      self._tokens -= 1
+      return 0
+    return (1 - self._tokens) / self._rate
+
+class _ProvisioningJob:
+  def __init__(self, device):
+    self.device = device
+    self.started = time.time()
+    self.steps = device._provisionSteps()
+
+def provisionMany(devices, concurrency = 16, registrationsPerSecond = 3, pollsPerSecond = 80):
+  # Provisions `devices` (any iterable of Device) against DPS. At most `concurrency`
+  # HTTP requests are in flight; devices waiting for their next poll don't hold a
+  # thread. Yields a ProvisioningResult per device as soon as it is done.
+  if concurrency < 1 or registrationsPerSecond <= 0 or pollsPerSecond <= 0:
+    raise ValueError("provisionMany: concurrency and rates must be positive")
+  return _provisionMany(iter(devices), concurrency, registrationsPerSecond, pollsPerSecond)
+
+def _provisionMany(devices, concurrency, registrationsPerSecond, pollsPerSecond):
+  executor = ThreadPoolExecutor(max_workers=concurrency)
+  completions = queue.Queue()
+  registrations = _RateLimiter(registrationsPerSecond)
+  polls = _RateLimiter(pollsPerSecond)
+  ready = collections.deque() # (job, request step)
+  waiting = [] # (wake time, seq, job)
+  sequence = itertools.count()
+  finished = []
+  inflight = 0
+  exhausted = False
+
+  def run(job, step):
+    try:
+      reply = _requestDetails(job.device, step[2], step[1], step[3], step[4])
+    except Exception as e:
+      reply = e
+    completions.put((job, reply))
+
+  def advance(job, reply = None):
+    try:
+      step = next(job.steps) if reply == None else job.steps.send(reply)
+    except Exception as e: # i.e. an unreadable X.509 file, fails this device only
+      finished.append(ProvisioningResult(job.device, None, str(e), time.time() - job.started, False))
+      return
+    if step[0] == "wait":
+      heapq.heappush(waiting, (time.time() + step[1], next(sequence), job))
+    elif step[0] == "request":
+      ready.append((job, step))
+    else:
+      if step[1] != None:
+        job.device._assigned(step[1])
+      finished.append(ProvisioningResult(job.device, step[1], step[2], time.time() - job.started, False))
+
+  try:
+    while True:
+      now = time.time()
+      while len(waiting) > 0 and waiting[0][0] <= now:
+        job = heapq.heappop(waiting)[2]
+        advance(job)
+
+      nextToken = None
+      while inflight < concurrency:
+        if len(ready) == 0:
+          if exhausted:
+            break
+          try:
+            device = next(devices)
+          except StopIteration:
+            exhausted = True
+            break
+          hostName = device._cachedHostName()
+          if hostName != None:
+            finished.append(ProvisioningResult(device, hostName, None, 0, True))
+            continue
+          job = _ProvisioningJob(device)
+          advance(job)
+          continue
+
+        job, step = ready[0]
+        delay = (registrations if step[1] == "PUT" else polls).reserve()
+        if delay > 0:
+          nextToken = now + delay
+          break
+        ready.popleft()
+        inflight += 1
+        executor.submit(run, job, step)
+
+      while len(finished) > 0:
+        yield finished.pop(0)
+
+      if inflight == 0 and len(ready) == 0 and len(waiting) == 0 and exhausted:
+        return
+
+      wakeAt = [at for at in (nextToken, waiting[0][0] if len(waiting) > 0 else None) if at != None]
+      timeout = max(0, min(wakeAt) - time.time()) if len(wakeAt) > 0 else None
+      if inflight == 0 and timeout == None:
+        continue
+
+      try:
+        job, reply = completions.get(timeout=timeout)
+      except queue.Empty:
+        continue
+
+      while True:
+        inflight -= 1
+        if isinstance(reply, Exception):
+          finished.append(ProvisioningResult(job.device, None, str(reply), time.time() - job.started, False))
+        else:
+          advance(job, reply)
+        try:
+          job, reply = completions.get_nowait()
+        except queue.Empty:
+          break
+  finally:
+    executor.shutdown(wait=False)
+
+class _NetworkLoop:
+  def __init__(self, name, reconnect, connect):
+    # `connect(client, device)` / `reconnect(client)` run the blocking TCP + TLS
+    # handshake away from the caller's thread and the loop
+    self._name = name
+    self._reconnect = reconnect
+    self._connect = connect
+    self._selector = None
+    self._wakeR = None
+    self._wakeW = None
+    self._lock = threading.Lock()
+    self._pending = collections.deque()
+    self._clients = {} # client -> device (loop thread only)
+    self._closing = set()
+    self._sockets = {} # socket -> events (loop thread only)
+    self._thread = None
+    self._running = False
+
+  def start(self):
+    with self._lock:
+      if self._thread != None:
+        return
+      self._start()
+
+  def _start(self):
+    self._selector = selectors.DefaultSelector()
+    self._wakeR, self._wakeW = socket.socketpair()
+    self._wakeR.setblocking(False)
+    self._wakeW.setblocking(False)
+    self._selector.register(self._wakeR, selectors.EVENT_READ, None)
+    self._running = True
+    self._thread = threading.Thread(target=self._run, name=self._name)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self, timeout = 5):
+    if self._thread == None:
+      return
+    deadline = time.time() + timeout
+    while self._clients and time.time() < deadline: # let DISCONNECT packets drain
+      time.sleep(0.05)
+    self._running = False
+    self._wake()
+    if self._thread != None:
+      self._thread.join(timeout)
+      self._thread = None
+
+  def attach(self, client, device):
+    client.on_socket_open = self._onSocketOpen
+    client.on_socket_close = self._onSocketClose
+    client.on_socket_register_write = self._onSocketRegisterWrite
+    client.on_socket_unregister_write = self._onSocketUnregisterWrite
+    self.start()
+    self._call(self._addClient, client, device)
+    self._connect(client, device)
+
+  def detach(self, client):
+    self._call(self._removeClient, client)
+
+  def _call(self, fn, *args):
+    if threading.current_thread() is self._thread:
+      fn(*args)
+      return
+    with self._lock:
+      self._pending.append((fn, args))
+    self._wake()
+
+  def _wake(self):
+    try:
+      self._wakeW.send(b'\0')
+    except (BlockingIOError, OSError):
+      pass
+
+  def _onSocketOpen(self, client, userdata, sock):
+    self._call(self._setEvents, sock, client, selectors.EVENT_READ)
+
+  def _onSocketClose(self, client, userdata, sock):
+    self._call(self._closeSocket, sock, client)
+
+  def _onSocketRegisterWrite(self, client, userdata, sock):
+    self._call(self._setEvents, sock, client, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+  def _onSocketUnregisterWrite(self, client, userdata, sock):
+    self._call(self._setEvents, sock, client, selectors.EVENT_READ)
+
+  def _addClient(self, client, device):
+    self._clients[client] = device
+
+  def _removeClient(self, client):
+    if not client in self._clients:
+      return
+    if client.socket() == None:
+      del self._clients[client]
+    else: # wait for the socket to close after the DISCONNECT packet is written
+      self._closing.add(client)
+
+  def _setEvents(self, sock, client, events):
+    if sock.fileno() == -1:
+      return
+    if sock in self._sockets:
+      if self._sockets[sock] != events:
+        self._selector.modify(sock, events, client)
+    else:
+      self._selector.register(sock, events, client)
+    self._sockets[sock] = events
+
+  def _closeSocket(self, sock, client):
+    if sock in self._sockets:
+      del self._sockets[sock]
+      try:
+        self._selector.unregister(sock)
+      except (KeyError, ValueError):
+        pass
+
+    if not client in self._clients:
+      return
+    if client in self._closing:
+      self._closing.discard(client)
+      del self._clients[client]
+    elif self._clients[client].isConnected(): # unexpected disconnect, paho's own loop would reconnect here
+      self._reconnect(client)
+
+  def _runPending(self):
+    with self._lock:
+      pending = self._pending
+      self._pending = collections.deque()
+    for fn, args in pending:
+      try:
+        fn(*args)
+      except Exception as e:
+        LOG_IOTC("ERROR: (fleet) %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, e)
+
+  def _run(self):
+    nextMisc = time.time() + 1
+    while self._running:
+      self._runPending()
+      for key, events in self._selector.select(max(0, nextMisc - time.time())):
+        client = key.data
+        if client == None:
+          try:
+            while self._wakeR.recv(4096):
+              pass
+          except (BlockingIOError, OSError):
+            pass
+          continue
+
+        if events & selectors.EVENT_READ:
+          client.loop_read()
+        if events & selectors.EVENT_WRITE and client.socket() != None:
+          client.loop_write()
+
+      if time.time() >= nextMisc:
+        nextMisc = time.time() + 1
+        for client in list(self._clients):
+          client.loop_misc()
+
+    self._runPending()
+    self._selector.close()
+    self._wakeR.close()
+    self._wakeW.close()
+    self._sockets = {}
+
+class DeviceFleet:
+  def __init__(self, loopThreads = 1, connectConcurrency = 16):
+    self._devices = []
+    self._loops = [_NetworkLoop("iotc-fleet-{}".format(i), self._scheduleReconnect, self._connectClient) for i in range(max(1, loopThreads))]
+    self._connectConcurrency = max(1, connectConcurrency)
+    self._executor = None
+    self._connectExecutor = None # socket connects, never waits on the `connectAll` workers
+    self._registrationsPerSecond = 3
+    self._pollsPerSecond = 80
+    self._callbackExecutor = None
+
+  def setProvisioningRate(self, registrationsPerSecond, pollsPerSecond):
+    if registrationsPerSecond <= 0 or pollsPerSecond <= 0:
+      LOG_IOTC("ERROR: (setProvisioningRate) invalid argument.")
+      return 1
+    self._registrationsPerSecond = registrationsPerSecond
+    self._pollsPerSecond = pollsPerSecond
+    return 0
+
+  def setCallbackExecutor(self, executor):
+    # shared by every device of the fleet, i.e. `IOTCallbackExecutor(maxWorkers)`
+    self._callbackExecutor = executor
+    for device in self._devices:
+      device.setCallbackExecutor(executor)
+    return 0
+
+  def _getExecutor(self):
+    if self._executor == None:
+      self._executor = ThreadPoolExecutor(max_workers=self._connectConcurrency)
+    return self._executor
+
+  def _getConnectExecutor(self):
+    if self._connectExecutor == None:
+      self._connectExecutor = ThreadPoolExecutor(max_workers=self._connectConcurrency)
+    return self._connectExecutor
+
+  def _connectClient(self, client, device):
+    def connect():
+      try:
+        client.reconnect()
+      except Exception as e:
+        LOG_IOTC("ERROR: (fleet) connect has failed => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, e, device=device._deviceId)
+        device._onConnect(client, None, None, 3) # server unavailable, `connect` stops waiting for CONNACK
+    self._getConnectExecutor().submit(connect)
+
+  def _scheduleReconnect(self, client):
+    def reconnect():
+      time.sleep(1)
+      try:
+        client.reconnect()
+      except Exception as e:
+        LOG_IOTC("ERROR: (fleet) reconnect has failed => %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, e)
+        self._scheduleReconnect(client)
+    self._getConnectExecutor().submit(reconnect)
+
+  def add(self, device):
+    loop = self._loops[len(self._devices) % len(self._loops)]
+    loop.start()
+    device._networkLoop = loop
+    if self._callbackExecutor != None:
+      device.setCallbackExecutor(self._callbackExecutor)
+    self._devices.append(device)
+    return 0
+
+  def createDevice(self, scopeId, keyORCert, deviceId, credType):
+    device = Device(scopeId, keyORCert, deviceId, credType)
+    self.add(device)
+    return device
+
+  def getDevices(self):
+    return list(self._devices)
+
+  def getStats(self):
+    # => totals of the devices' `getStats()` plus `devices` / `connected`
+    devices = list(self._devices)
+    stats = iotc._mergeStats([device.getStats() for device in devices])
+    stats["devices"] = len(devices)
+    stats["connected"] = len([device for device in devices if device.isConnected()])
+    return stats
+
+  def connectAll(self, hostNames = None):
+    LOG_IOTC("- iotc :: connectAll :: %d", IOTLogLevel.IOTC_LOGGING_ALL, len(self._devices))
+    def connect(device, hostName):
+      try:
+        return device.connect(hostName)
+      except Exception as e:
+        LOG_IOTC("ERROR: (connectAll) %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, e, device=device._deviceId)
+        return 1
+
+    executor = self._getExecutor()
+    failed = 0
+    if hostNames != None:
+      pending = [executor.submit(connect, device, hostNames[index]) for index, device in enumerate(self._devices)]
+    else: # MQTT connects start while the rest of the fleet is still provisioning
+      pending = []
+      for result in provisionMany(self._devices, self._connectConcurrency, self._registrationsPerSecond, self._pollsPerSecond):
+        if result.getError() != None:
+          LOG_IOTC("ERROR: (connectAll) %s", IOTLogLevel.IOTC_LOGGING_API_ONLY, result.getError(), device=result.getDevice()._deviceId)
+          failed += 1
+        elif result.isCached(): # let connect() fall back to DPS if the cached hub rejects the device
+          pending.append(executor.submit(connect, result.getDevice(), None))
+        else:
+          pending.append(executor.submit(connect, result.getDevice(), result.getHostName()))
+
+    return failed + len([future for future in pending if future.result() != 0])
+
+  def sendAll(self, data, systemProperties = None):
+    failed = 0
+    for device in self._devices:
+      if not device.isConnected():
+        failed += 1
+        continue
+      payload = data(device) if callable(data) else data
+      if device.sendTelemetry(payload, systemProperties) != 0:
+        failed += 1
+    return failed
+
+  def disconnectAll(self):
+    for device in self._devices:
+      device.disconnect()
+    for loop in self._loops:
+      loop.stop()
+    if self._executor != None:
+      self._executor.shutdown(wait=True)
+      self._executor = None
+    if self._connectExecutor != None:
+      self._connectExecutor.shutdown(wait=False) # a pending reconnect may be sleeping
+      self._connectExecutor = None
+    return 0
@@ -0,0 +1,83 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import json
+import time
+import asyncio
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTConnectType
+from iotc.aio import AsyncDevice
+from helpers import AsyncStubClient, createAsyncDevice, receive, runAsync
+
+def test_sendTelemetry_inline_ack():
+  async def run():
+    device = createAsyncDevice(inline = True)
+    sent = []
+    device.on("MessageSent", lambda info: sent.append(info.getPayload()))
+    assert await device.sendTelemetry("{\"temp\":1}") == 0
+    assert sent == ["{\"temp\":1}"]
+
+  runAsync(run())
+
+def test_sendTelemetry_waits_for_puback():
+  async def run():
+    device = createAsyncDevice()
+    task = asyncio.ensure_future(device.sendTelemetry("{\"temp\":2}"))
+    await asyncio.sleep(0)
+    assert not task.done()
+    device._onPublish(None, None, 1)
+    assert await task == 0
+
+  runAsync(run())
+
+def test_getDeviceSettings_correlates_rid():
+  async def run():
+    device = createAsyncDevice(inline = True)
+    task = asyncio.ensure_future(device.getDeviceSettings())
+    await asyncio.sleep(0)
+    topic = device._mqtts.published[0][0]
+    rid = topic[topic.find("$rid=") + 5:]
+    other = json.dumps({"desired": {"$version": 1}}).encode("utf-8")
+    receive(device, "$iothub/twin/res/200/?$rid=999", other)
+    assert not task.done()
+
+    twin = {"desired": {"fanSpeed": {"value": 3}, "$version": 2}, "reported": {}}
+    receive(device, "$iothub/twin/res/200/?$rid=" + rid, twin)
+    assert await task == twin
+
+  runAsync(run())
+
+class SilentBrokerDevice(AsyncDevice):
+  # the TCP connect succeeds, the CONNACK never comes
+  def __init__(self):
+    AsyncDevice.__init__(self, "scope", "a2V5", "dev1", IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+    self.clients = []
+
+  def _startMQTTLoop(self):
+    self._mqtts = AsyncStubClient(self)
+    self._mqtts.reconnect = lambda: None
+    self.clients.append(self._mqtts)
+
+def test_connect_timeout():
+  async def run():
+    device = SilentBrokerDevice()
+    assert device.setConnectTimeout(0.1) == 0
+    started = time.time()
+    assert await device.connect("hub.azure-devices.net") == 1
+    assert time.time() - started < 5 # not the 30 s twin request timeout
+    assert device.clients[0].disconnected and not device.isConnected()
+
+  runAsync(run())
+
+if __name__ == "__main__":
+  test_sendTelemetry_inline_ack()
+  test_sendTelemetry_waits_for_puback()
+  test_getDeviceSettings_correlates_rid()
+  test_connect_timeout()
@@ -0,0 +1,94 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import json
+import time
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTConnectType
+from helpers import createDevice
+
+def test_batch_by_count():
+  device = createDevice()
+  sent = []
+  device.on("MessageSent", lambda info: sent.append(info.getPayload()))
+  assert device.enableBatching(3, 1024, 60000) == 0
+  for i in range(7):
+    assert device.sendTelemetry(json.dumps({"i": i})) == 0
+
+  assert len(device._mqtts.published) == 2
+  assert json.loads(device._mqtts.published[0][1]) == [{"i": 0}, {"i": 1}, {"i": 2}]
+
+  device._onPublish(None, None, 1)
+  assert sent == ['{"i": 0}', '{"i": 1}', '{"i": 2}']
+
+  assert device.flushBatch() == 0
+  assert json.loads(device._mqtts.published[2][1]) == [{"i": 6}]
+
+def test_batch_by_size_and_topic():
+  device = createDevice()
+  assert device.enableBatching(100, 20, 60000) == 0
+  device.sendTelemetry('{"a":1}')
+  device.sendTelemetry('{"a":2}')
+  device.sendTelemetry('{"a":3}') # 7 + 1 + 7 + 1 + 7 + 2 > 20
+  assert [p for _, p in device._mqtts.published] == ['[{"a":1},{"a":2}]']
+
+  device.sendTelemetry('{"a":4}', {"iothub-creation-time-utc": 1}) # different topic
+  assert device._mqtts.published[1][1] == '[{"a":3}]'
+
+  device.sendTelemetry('{"large":"' + 'x' * 32 + '"}') # larger than a batch
+  assert device._mqtts.published[2][1] == '[{"a":4}]'
+  assert device._mqtts.published[3][1].startswith('{"large"')
+
+def test_binary_payload_keeps_order():
+  device = createDevice()
+  assert device.enableBatching(100, 1024, 60000) == 0
+  device.sendTelemetry('{"a":1}')
+  device.sendTelemetry('{"a":2}')
+  assert device.sendTelemetry(b"\x01\x02") == 0 # not batched
+  assert [p for _, p in device._mqtts.published] == ['[{"a":1},{"a":2}]', b"\x01\x02"]
+
+def test_batch_with_orjson_encoder():
+  device = createDevice()
+  assert device.setEncoder(iotc.IOTEncoding.IOTC_ENCODING_ORJSON) == 0
+  assert device.enableBatching(100, 1024, 60000) == 0
+  for i in range(3):
+    assert device.sendTelemetry({"t": i}) == 0
+  assert device._mqtts.published == []
+  assert device.flushBatch() == 0
+  assert [p for _, p in device._mqtts.published] == ['[{"t":0},{"t":1},{"t":2}]']
+
+def test_batch_linger():
+  device = createDevice()
+  assert device.enableBatching(100, 1024, 20) == 0
+  device.sendTelemetry('{"a":1}')
+  assert len(device._mqtts.published) == 0
+  time.sleep(0.2)
+  assert [p for _, p in device._mqtts.published] == ['[{"a":1}]']
+
+def test_batch_limit():
+  device = createDevice()
+  assert device.enableBatching(0, 1024, 10) == 1
+  assert device.enableBatching(10, 1024 * 1024, 10) == 0
+  assert device._batch._maxBytes == iotc.IOTC_MAX_MESSAGE_SIZE
+
+def test_async_device_rejects_batching():
+  from iotc.aio import AsyncDevice
+  device = AsyncDevice("scope", "a2V5", "dev1", IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+  assert device.enableBatching(3, 1024, 60000) == 1
+  assert device._batch == None
+
+if __name__ == "__main__":
+  test_batch_by_count()
+  test_batch_by_size_and_topic()
+  test_binary_payload_keeps_order()
+  test_batch_with_orjson_encoder()
+  test_batch_linger()
+  test_batch_limit()
+  test_async_device_rejects_batching()
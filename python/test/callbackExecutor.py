@@ -0,0 +1,147 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import time
+import asyncio
+import threading
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTCallbackExecutor
+from iotc.aio import AsyncCallbackExecutor
+from helpers import createDevice, runAsync, sendCommand, waitForAsync
+
+def createDeviceOn(executor, deviceId = "dev1"):
+  device = createDevice(deviceId)
+  device.setCallbackExecutor(executor)
+  return device
+
+def test_slow_handler_does_not_block_network_thread():
+  executor = IOTCallbackExecutor(2)
+  device = createDeviceOn(executor)
+  order = []
+  def oncommand(info):
+    time.sleep(0.05)
+    order.append(info.getTag())
+  device.on("Command", oncommand)
+
+  started = time.time()
+  for i in range(5):
+    sendCommand(device, "cmd" + str(i), i)
+  assert time.time() - started < 0.05
+  assert executor.flush(5)
+  assert order == ["cmd0", "cmd1", "cmd2", "cmd3", "cmd4"] # per device FIFO
+  executor.shutdown()
+
+def test_devices_run_in_parallel():
+  executor = IOTCallbackExecutor(2)
+  barrier = threading.Barrier(2, timeout=5)
+  passed = []
+  def oncommand(info):
+    barrier.wait() # both devices' handlers have to be running at once
+    passed.append(info.getClient()._deviceId)
+
+  for deviceId in ("dev1", "dev2"):
+    device = createDeviceOn(executor, deviceId)
+    device.on("Command", oncommand)
+    sendCommand(device, "reboot", 1)
+  assert executor.flush(5)
+  assert sorted(passed) == ["dev1", "dev2"]
+  executor.shutdown()
+
+def test_command_response_follows_handler():
+  executor = IOTCallbackExecutor()
+  device = createDeviceOn(executor)
+  device.on("Command", lambda info: info.setResponse(201, "{\"done\":true}"))
+  sendCommand(device, "reboot", 7)
+  assert executor.flush(5)
+  assert device._mqtts.published == [("$iothub/methods/res/201/?$rid=7", "{\"done\":true}")]
+
+  device.on("Command", None) # still answered without a handler
+  sendCommand(device, "reboot", 8)
+  assert executor.flush(5)
+  assert device._mqtts.published[-1] == ("$iothub/methods/res/200/?$rid=8", "{}")
+  executor.shutdown()
+
+def test_answer_while_arming_leaves_no_timer():
+  executor = IOTCallbackExecutor()
+  device = createDeviceOn(executor)
+  device.on("Command", lambda info: None)
+  timers = []
+  answering = []
+  schedule = device._scheduleTimeout
+  def scheduleTimeout(delay, fn, *args):
+    # the executor thread answers while the network thread arms the deadline
+    thread = threading.Thread(target=lambda: device._commands[args[0]]._responder.respond(200))
+    thread.start()
+    answering.append(thread)
+    time.sleep(0.02)
+    timers.append(schedule(delay, fn, *args))
+    return timers[-1]
+  device._scheduleTimeout = scheduleTimeout
+
+  sendCommand(device, "reboot", 1)
+  answering[0].join(5)
+  assert executor.flush(5)
+  assert device._mqtts.published == [("$iothub/methods/res/200/?$rid=1", "{}")]
+  assert timers[0][2] == None # cancelled, not left to fire a 504 later
+  executor.shutdown()
+
+def test_queue_depth_metrics():
+  executor = IOTCallbackExecutor(1)
+  device = createDeviceOn(executor)
+  other = createDeviceOn(executor, "dev2")
+  release = threading.Event()
+  device.on("MessageSent", lambda info: release.wait(5))
+  other.on("MessageSent", lambda info: None)
+
+  for i in range(3):
+    device._messageSent(str(i), None, i + 1)
+  other._messageSent("x", None, 1)
+  time.sleep(0.05)
+  assert executor.getQueueDepth() == 3 # first one is running
+  assert executor.getQueueDepth(device) == 2
+  assert executor.getQueueDepth(other) == 1
+  assert executor.getPeakQueueDepth() >= 3
+  assert executor.getLag() >= 0.04
+
+  release.set()
+  assert executor.flush(5)
+  assert executor.getQueueDepth() == 0
+  assert executor.getCompletedCount() == 4
+  assert executor.getLag() == 0
+  executor.shutdown()
+
+def test_async_executor_awaits_handlers():
+  async def run():
+    executor = AsyncCallbackExecutor(asyncio.get_running_loop())
+    device = createDeviceOn(executor)
+    order = []
+    async def oncommand(info):
+      await asyncio.sleep(0.01)
+      order.append(info.getTag())
+      info.setResponse(202, "{}")
+    device.on("Command", oncommand)
+
+    for i in range(3):
+      sendCommand(device, "cmd" + str(i), i)
+    assert executor.getQueueDepth(device) == 3
+    assert await executor.flush(5)
+    assert await waitForAsync(lambda: device.getCommandsInFlight() == 0) # coroutines answer when they finish
+    assert order == ["cmd0", "cmd1", "cmd2"]
+    assert [topic for topic, _ in device._mqtts.published] == ["$iothub/methods/res/202/?$rid={}".format(i) for i in range(3)]
+
+  runAsync(run())
+
+if __name__ == "__main__":
+  test_slow_handler_does_not_block_network_thread()
+  test_devices_run_in_parallel()
+  test_command_response_follows_handler()
+  test_answer_while_arming_leaves_no_timer()
+  test_queue_depth_metrics()
+  test_async_executor_awaits_handlers()
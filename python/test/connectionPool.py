@@ -0,0 +1,56 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import time
+import zlib
+import gzip
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+
+class FakeConnection:
+  def __init__(self):
+    self.closed = False
+
+  def close(self):
+    self.closed = True
+
+def test_pool_reuse_and_limit():
+  pool = iotc._HTTPSConnectionPool(1, 60)
+  first, reused = pool.acquire("dps", FakeConnection)
+  assert reused == False
+  second, _ = pool.acquire("dps", FakeConnection)
+  pool.release("dps", first)
+  pool.release("dps", second) # pool is full
+  assert second.closed
+
+  conn, reused = pool.acquire("dps", FakeConnection)
+  assert conn is first and reused
+  other, reused = pool.acquire("other-dps", FakeConnection)
+  assert not reused
+
+def test_pool_idle_eviction():
+  pool = iotc._HTTPSConnectionPool(4, 0.05)
+  conn, _ = pool.acquire("dps", FakeConnection)
+  pool.release("dps", conn)
+  time.sleep(0.1)
+  fresh, reused = pool.acquire("dps", FakeConnection)
+  assert conn.closed and fresh is not conn and not reused
+
+def test_decode_body():
+  body = b'{"status":"assigned"}'
+  assert iotc._decodeBody(body, None) == body
+  assert iotc._decodeBody(gzip.compress(body), "gzip") == body
+  assert iotc._decodeBody(zlib.compress(body), "deflate") == body
+  raw = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+  assert iotc._decodeBody(raw.compress(body) + raw.flush(), "Deflate") == body
+
+if __name__ == "__main__":
+  test_pool_reuse_and_limit()
+  test_pool_idle_eviction()
+  test_decode_body()
@@ -0,0 +1,135 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import json
+import asyncio
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTCallbackExecutor
+from iotc.aio import AsyncCallbackExecutor
+from helpers import answerTwin, createAsyncDevice, createDevice, receive, runAsync, waitForAsync
+
+def desiredPatch(count):
+  patch = {"$version": 7}
+  for i in range(count):
+    patch["prop" + str(i)] = {"value": i}
+  return patch
+
+def test_one_reported_patch_per_desired_patch():
+  device = createDevice()
+  settings = []
+  def onsettings(info):
+    settings.append((info.getTag(), json.loads(info.getPayload())))
+    if info.getTag() == "prop1":
+      info.setResponse(400, "out of range")
+  device.on("SettingsUpdated", onsettings)
+
+  receive(device, "$iothub/twin/PATCH/properties/desired/?$version=7", desiredPatch(200))
+  assert len(settings) == 200
+  assert settings[1] == ("prop1", {"value": 1, "$version": 7})
+
+  assert len(device._mqtts.published) == 1
+  topic, payload = device._mqtts.published[0]
+  assert topic.startswith("$iothub/twin/PATCH/properties/reported/?$rid=")
+  reported = json.loads(payload)
+  assert len(reported) == 200
+  assert reported["prop0"] == {"value": 0, "statusCode": 200, "status": "completed", "desiredVersion": 7}
+  assert reported["prop1"] == {"value": 1, "statusCode": 400, "status": "out of range", "desiredVersion": 7}
+
+def test_twin_response_and_plain_values_are_not_acknowledged():
+  device = createDevice()
+  tags = []
+  device.on("SettingsUpdated", lambda info: tags.append(info.getTag()))
+
+  assert device.getDeviceSettings() == 0
+  answerTwin(device, {"desired": desiredPatch(3), "reported": {"$version": 1}})
+  assert tags == ["prop0", "prop1", "prop2"]
+  assert len(device._mqtts.published) == 1 # just the GET
+
+  receive(device, "$iothub/twin/PATCH/properties/desired/?$version=8", {"$version": 8, "plain": 3})
+  assert len(device._mqtts.published) == 1
+
+def test_unknown_twin_response_is_ignored():
+  device = createDevice()
+  tags = []
+  device.on("SettingsUpdated", lambda info: tags.append(info.getTag()))
+  device.setRequestTimeout(0.01)
+  request = device.getTwin()
+  assert request.wait(5) and request.getError() == "timeout"
+  answerTwin(device, {"desired": desiredPatch(3), "reported": {}}) # late
+  receive(device, "$iothub/twin/res/200/?$rid=999", {"desired": desiredPatch(3), "reported": {}}) # not ours
+  assert tags == [] and device._mqtts.published[1:] == []
+  assert device.getLocalTwin()["desired"] == {"$version": None}
+
+def test_ack_waits_for_every_handler():
+  executor = IOTCallbackExecutor(2)
+  device = createDevice()
+  device.setCallbackExecutor(executor)
+  device.on("SettingsUpdated", lambda info: info.setResponse(201, "applied"))
+
+  receive(device, "$iothub/twin/PATCH/properties/desired/?$version=7", desiredPatch(5))
+  assert executor.flush(5)
+  assert len(device._mqtts.published) == 1
+  reported = json.loads(device._mqtts.published[0][1])
+  assert sorted(reported.keys()) == ["prop0", "prop1", "prop2", "prop3", "prop4"]
+  assert all(value["statusCode"] == 201 for value in reported.values())
+  executor.shutdown()
+
+def test_failing_handler_is_acknowledged():
+  def onsettings(info):
+    if info.getTag() == "prop1":
+      raise ValueError("no such fan")
+    info.setResponse(200, "applied")
+
+  for executor in (None, IOTCallbackExecutor(2)):
+    device = createDevice()
+    device.setCallbackExecutor(executor)
+    device.on("SettingsUpdated", onsettings)
+    receive(device, "$iothub/twin/PATCH/properties/desired/?$version=7", desiredPatch(3))
+    if executor != None:
+      assert executor.flush(5)
+      executor.shutdown()
+    assert len(device._mqtts.published) == 1
+    reported = json.loads(device._mqtts.published[0][1])
+    assert reported["prop1"] == {"value": 1, "statusCode": 500, "status": "no such fan", "desiredVersion": 7}
+    assert reported["prop2"]["statusCode"] == 200
+
+def test_coroutine_handler_is_acknowledged_after_it_runs():
+  async def run():
+    executor = AsyncCallbackExecutor(asyncio.get_running_loop())
+    device = createAsyncDevice()
+    device.setCallbackExecutor(executor)
+    applied = []
+    async def onsettings(info):
+      await asyncio.sleep(0.02)
+      if info.getTag() == "prop1":
+        raise ValueError("no such fan")
+      applied.append(info.getTag())
+      info.setResponse(201, "applied")
+    device.on("SettingsUpdated", onsettings)
+
+    receive(device, "$iothub/twin/PATCH/properties/desired/?$version=7", desiredPatch(2))
+    await asyncio.sleep(0.01)
+    assert device._mqtts.published == [] # still running
+    assert await executor.flush(5)
+    assert await waitForAsync(lambda: len(device._mqtts.published) == 1)
+    assert applied == ["prop0"]
+    reported = json.loads(device._mqtts.published[0][1])
+    assert reported["prop0"] == {"value": 0, "statusCode": 201, "status": "applied", "desiredVersion": 7}
+    assert reported["prop1"] == {"value": 1, "statusCode": 500, "status": "no such fan", "desiredVersion": 7}
+
+  runAsync(run())
+
+if __name__ == "__main__":
+  test_one_reported_patch_per_desired_patch()
+  test_twin_response_and_plain_values_are_not_acknowledged()
+  test_unknown_twin_response_is_ignored()
+  test_ack_waits_for_every_handler()
+  test_failing_handler_is_acknowledged()
+  test_coroutine_handler_is_acknowledged_after_it_runs()
@@ -0,0 +1,177 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import json
+import asyncio
+import threading
+from concurrent.futures import Future
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from helpers import createDevice, createAsyncDevice, runAsync, sendCommand, waitFor, waitForAsync
+
+def test_deferred_response_does_not_block():
+  device = createDevice()
+  responders = {}
+  def oncommand(info):
+    if info.getTag() == "diagnostics":
+      responders[info.getTag()] = info.defer()
+    else:
+      info.setResponse(200, "{\"pong\": true}")
+  device.on("Command", oncommand)
+
+  sendCommand(device, "diagnostics", 1)
+  sendCommand(device, "ping", 2)
+  assert device._mqtts.published == [("$iothub/methods/res/200/?$rid=2", "{\"pong\": true}")]
+  assert device.getCommandsInFlight() == 1
+
+  responder = responders["diagnostics"]
+  assert responder.getMethodName() == "diagnostics" and responder.getRequestId() == "1"
+  worker = threading.Thread(target=responder.respond, args=(201, {"disk": "ok"}))
+  worker.start()
+  worker.join()
+  assert device._mqtts.published[-1] == ("$iothub/methods/res/201/?$rid=1", "{\"disk\": \"ok\"}")
+  assert responder.respond(200) == 1 # answered once
+  assert device.getCommandsInFlight() == 0
+
+def test_future_results():
+  device = createDevice()
+  futures = []
+  def oncommand(info):
+    futures.append(Future())
+    return futures[-1]
+  device.on("Command", oncommand)
+
+  sendCommand(device, "update", 1)
+  sendCommand(device, "check", 2)
+  sendCommand(device, "plain", 3)
+  assert device._mqtts.published == []
+  futures[1].set_result((202, "{\"queued\": true}"))
+  futures[0].set_exception(ValueError("no image"))
+  futures[2].set_result(None) # falls back to setResponse / 200
+  assert device._mqtts.published[0] == ("$iothub/methods/res/202/?$rid=2", "{\"queued\": true}")
+  topic, payload = device._mqtts.published[1]
+  assert topic == "$iothub/methods/res/500/?$rid=1" and json.loads(payload) == {"error": "no image"}
+  assert device._mqtts.published[2] == ("$iothub/methods/res/200/?$rid=3", "{}")
+
+  device.on("Command", lambda info: 1 / 0)
+  sendCommand(device, "broken", 4)
+  assert device._mqtts.published[-1][0] == "$iothub/methods/res/500/?$rid=4"
+
+def test_plain_return_value_is_not_an_error():
+  records = []
+  device = createDevice()
+  device.setLogLevel(iotc.IOTLogLevel.IOTC_LOGGING_API_ONLY)
+  device.setLogSink(records.append)
+  try:
+    def oncommand(info): # the handlers in basics.py answer like this
+      info.setResponse(200, "{\"ok\": true}")
+      return 0
+    device.on("Command", oncommand)
+    sendCommand(device, "reboot", 1)
+  finally:
+    device.setLogLevel(iotc.IOTLogLevel.IOTC_LOGGING_DISABLED)
+    device.setLogSink(None)
+  assert device._mqtts.published == [("$iothub/methods/res/200/?$rid=1", "{\"ok\": true}")]
+  assert [record.getMessage() for record in records if "ERROR" in record.getMessage()] == []
+
+def test_concurrency_limit():
+  device = createDevice()
+  assert device.setMaxConcurrentCommands(0) == 1
+  assert device.setMaxConcurrentCommands(2) == 0
+  started = []
+  device.on("Command", lambda info: started.append(info.defer()))
+
+  for rid in range(4):
+    sendCommand(device, "job", rid)
+  assert [responder.getRequestId() for responder in started] == ["0", "1"]
+  assert device.getCommandsInFlight() == 4
+
+  started[1].respond()
+  assert [responder.getRequestId() for responder in started] == ["0", "1", "2"]
+  started[0].respond()
+  started[2].respond()
+  assert len(started) == 4
+  started[3].respond()
+  assert device.getCommandsInFlight() == 0
+  assert len(device._mqtts.published) == 4
+
+def test_concurrency_limit_without_deque():
+  deque = iotc.deque
+  iotc.deque = None # MicroPython without `collections.deque`
+  try:
+    device = createDevice()
+  finally:
+    iotc.deque = deque
+  assert isinstance(device._commandQueue, list)
+  device.setMaxConcurrentCommands(1)
+  started = []
+  device.on("Command", lambda info: started.append(info.defer()))
+  sendCommand(device, "job", 1)
+  sendCommand(device, "job", 2)
+  started[0].respond()
+  assert [responder.getRequestId() for responder in started] == ["1", "2"]
+  started[1].respond()
+  assert device.getCommandsInFlight() == 0
+
+def test_timeout_response():
+  device = createDevice()
+  assert device.setCommandTimeout(0) == 1
+  assert device.setCommandTimeout(0.05, "firmwareCheck") == 0
+  held = []
+  device.on("Command", lambda info: held.append(info.defer()))
+
+  sendCommand(device, "firmwareCheck", 1)
+  sendCommand(device, "reboot", 2) # default timeout is longer
+  assert waitFor(lambda: len(device._mqtts.published) == 1)
+  assert device._mqtts.published[0] == ("$iothub/methods/res/504/?$rid=1", "{\"error\": \"timeout\"}")
+  assert held[0].respond(200) == 1 # too late
+  assert held[1].respond(200) == 0
+
+  device.setMaxConcurrentCommands(1)
+  sendCommand(device, "reboot", 3)
+  sendCommand(device, "firmwareCheck", 4) # times out while waiting for the slot
+  assert waitFor(lambda: len(device._mqtts.published) == 3)
+  assert device._mqtts.published[-1][0] == "$iothub/methods/res/504/?$rid=4"
+  held[2].respond(200)
+  assert len(held) == 3 # the expired one never ran
+  assert device.getCommandsInFlight() == 0
+
+def test_coroutine_handlers_run_concurrently():
+  async def run():
+    device = createAsyncDevice()
+    release = asyncio.Event()
+    running = []
+    async def oncommand(info):
+      running.append(info.getTag())
+      await release.wait()
+      return {"done": info.getTag()}
+    device.on("Command", oncommand)
+
+    sendCommand(device, "first", 1)
+    sendCommand(device, "second", 2)
+    await asyncio.sleep(0.01)
+    assert running == ["first", "second"] # the first one didn't block the second
+    assert device._mqtts.published == []
+
+    release.set()
+    assert await waitForAsync(lambda: device.getCommandsInFlight() == 0)
+    assert sorted(device._mqtts.published) == [
+      ("$iothub/methods/res/200/?$rid=1", "{\"done\": \"first\"}"),
+      ("$iothub/methods/res/200/?$rid=2", "{\"done\": \"second\"}")]
+
+  runAsync(run())
+
+if __name__ == "__main__":
+  test_deferred_response_does_not_block()
+  test_future_results()
+  test_plain_return_value_is_not_an_error()
+  test_concurrency_limit()
+  test_concurrency_limit_without_deque()
+  test_timeout_response()
+  test_coroutine_handlers_run_concurrently()
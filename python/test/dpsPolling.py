@@ -0,0 +1,94 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import json
+import time
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTConnectType
+
+def drive(device, responses):
+  # runs the DPS steps against canned (status, body, retry-after) responses
+  steps = device._provisionSteps()
+  step = next(steps)
+  log = []
+  while step[0] != "done":
+    if step[0] == "wait":
+      log.append(("wait", step[1]))
+      step = next(steps)
+    else:
+      log.append((step[1], step[2]))
+      status, body, retryAfter = responses.pop(0)
+      step = steps.send((json.dumps(body).encode("utf-8"), status, retryAfter))
+  return step[1], step[2], log
+
+def createDevice():
+  return iotc.Device("scope", "a2V5", "dev1", IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+
+ASSIGNING = {"operationId": "op1", "status": "assigning"}
+ASSIGNED = {"operationId": "op1", "status": "assigned", "registrationState": {"assignedHub": "hub.azure-devices.net"}}
+
+def test_backoff_grows_and_honors_deadline():
+  backoff = iotc._ProvisioningBackoff(60)
+  delays = [backoff.next() for _ in range(6)]
+  assert delays[0] < 0.5
+  assert delays[5] <= iotc._ProvisioningBackoff.MAXIMUM * 1.2
+  assert delays[3] > delays[0]
+
+  backoff = iotc._ProvisioningBackoff(0)
+  assert backoff.next() == None
+
+def test_backoff_retry_after():
+  backoff = iotc._ProvisioningBackoff(60)
+  assert backoff.next("3") == 3 # the service's polling interval is honored
+  assert backoff.next("0") < 1 # but never makes us poll faster than the backoff
+  assert backoff.next("Wed, 21 Oct 2015 07:28:00 GMT") <= 1.2 # unparsed hint, plain backoff (1s + 20% jitter)
+
+def test_poll_until_assigned():
+  device = createDevice()
+  host, err, log = drive(device, [(202, ASSIGNING, "3"), (202, ASSIGNING, "3"), (200, ASSIGNED, None)])
+  assert (host, err) == ("hub.azure-devices.net", None)
+  assert [entry[0] for entry in log] == ["PUT", "wait", "GET", "wait", "GET"]
+  assert sum(entry[1] for entry in log if entry[0] == "wait") == 6 # Retry-After: 3 twice
+
+def test_throttled_register_is_retried():
+  device = createDevice()
+  host, err, log = drive(device, [(429, {"errorCode": 429001}, "0.01"), (200, ASSIGNED, None)])
+  assert host == "hub.azure-devices.net"
+  assert [entry[0] for entry in log] == ["PUT", "wait", "PUT"]
+
+def test_provisioning_deadline():
+  device = createDevice()
+  device.setProvisioningTimeout(0.3)
+  start = time.time()
+  responses = [(202, ASSIGNING, None)] * 100
+  steps = device._provisionSteps()
+  step = next(steps)
+  while step[0] != "done":
+    if step[0] == "wait":
+      time.sleep(step[1])
+      step = next(steps)
+    else:
+      status, body, retryAfter = responses.pop(0)
+      step = steps.send((json.dumps(body), status, retryAfter))
+  assert step[1] == None and step[2] == "Unable to provision the device."
+  assert time.time() - start < 1
+
+def test_registration_error():
+  device = createDevice()
+  host, err, log = drive(device, [(401, {"errorCode": 401002, "message": "unauthorized"}, None)])
+  assert host == None and err.startswith("DPS => ")
+
+if __name__ == "__main__":
+  test_backoff_grows_and_honors_deadline()
+  test_backoff_retry_after()
+  test_poll_until_assigned()
+  test_throttled_register_is_retried()
+  test_provisioning_deadline()
+  test_registration_error()
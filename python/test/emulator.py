@@ -0,0 +1,111 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+# end-to-end against the local DPS + IoT Hub emulator, no cloud scope needed
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTConnectType
+from iotc.aio import AsyncDevice
+from iotc.emulator import IOTEmulator, createCertificates
+from helpers import runAsync, waitFor
+
+class Emulator:
+  def __enter__(self):
+    self.folder = tempfile.mkdtemp()
+    self.cafile, certfile, keyfile = createCertificates(self.folder)
+    self.emulator = IOTEmulator(certfile, keyfile)
+    assert self.emulator.start() == 0
+    return self
+
+  def __exit__(self, *args):
+    self.emulator.stop()
+    shutil.rmtree(self.folder)
+
+  def createDevice(self, deviceId, cls = iotc.Device):
+    device = cls("scope", "a2V5", deviceId, IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+    assert device.setDPSEndpoint(self.emulator.getDPSEndpoint()) == 0
+    assert device.setCACertificate(self.cafile) == 0
+    return device
+
+def test_provision_and_send_telemetry():
+  with Emulator() as context:
+    emulator = context.emulator
+    received = []
+    emulator.setTelemetryCallback(lambda deviceId, topic, payload: received.append((deviceId, json.loads(payload))))
+    device = context.createDevice("dev1")
+    assert device.connect() == 0
+    assert waitFor(lambda: device.isConnected() and emulator.isConnected("dev1"))
+    assert device._hostname == emulator.getHubHostName()
+
+    for i in range(20):
+      assert device.sendTelemetry({"i": i}) == 0
+    assert waitFor(lambda: len(received) == 20)
+    assert received[0] == ("dev1", {"i": 0}) and received[-1] == ("dev1", {"i": 19})
+    stats = emulator.getStats()
+    assert stats["registrations"] == 1 and stats["connections"] == 1 and stats["telemetry"] == 20
+    device.disconnect()
+    assert waitFor(lambda: not emulator.isConnected("dev1"))
+
+def test_commands_and_desired_patches():
+  with Emulator() as context:
+    emulator = context.emulator
+    device = context.createDevice("dev2")
+    settings = []
+    device.on("Command", lambda info: info.setResponse(200, json.dumps({"echo": json.loads(info.getPayload())})))
+    device.on("SettingsUpdated", lambda info: settings.append((info.getTag(), info.getPayload())))
+    assert device.connect() == 0
+    assert waitFor(lambda: emulator.isConnected("dev2"))
+    time.sleep(0.1) # subscriptions
+
+    status, payload = emulator.sendCommand("dev2", "reboot", {"delay": 5}).result(5)
+    assert status == 200 and json.loads(payload) == {"echo": {"delay": 5}}
+    assert emulator.sendCommand("nobody", "reboot").result(5) == (404, None)
+
+    assert emulator.updateDesired("dev2", {"fan": {"value": 3}}).result(5) == 2
+    assert waitFor(lambda: len(settings) == 1)
+    assert settings[0][0] == "fan"
+    assert waitFor(lambda: emulator.getTwin("dev2")["reported"].get("fan", {}).get("value") == 3) # echoed back
+
+    request = device.patchReported({"interval": 45})
+    assert request.wait(5) and request.isSuccess()
+    assert emulator.getTwin("dev2")["reported"]["interval"] == 45
+    assert request.getVersion() == emulator.getTwin("dev2")["reported"]["$version"]
+    device.disconnect()
+
+def test_async_device():
+  with Emulator() as context:
+    emulator = context.emulator
+    async def run():
+      device = context.createDevice("dev3", AsyncDevice)
+      device.on("Command", lambda info: info.setResponse(201, "{}"))
+      assert await device.connect() == 0
+      for i in range(10):
+        assert await device.sendTelemetry({"i": i}) == 0
+      await asyncio.sleep(0.1)
+      future = asyncio.wrap_future(emulator.sendCommand("dev3", "ping"))
+      assert await future == (201, "{}")
+      twin = await device.getTwin()
+      assert twin.getStatusCode() == 200
+      device.disconnect()
+      for task in [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]:
+        task.cancel() # the idle loop_misc task
+
+    runAsync(run())
+    assert emulator.getStats()["telemetry"] == 10
+
+if __name__ == "__main__":
+  test_provision_and_send_telemetry()
+  test_commands_and_desired_patches()
+  test_async_device()
@@ -0,0 +1,125 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTEncoding, IOTEncoder, IOTDependencyError
+from helpers import createDevice
+
+class CSVEncoder(IOTEncoder):
+  def __init__(self):
+    IOTEncoder.__init__(self, "text/csv", "utf-8")
+
+  def encode(self, value):
+    return ",".join("{}={}".format(key, value[key]) for key in sorted(value))
+
+def test_dict_is_encoded_with_content_type():
+  device = createDevice()
+  assert device.sendTelemetry({"temp": 21.5}) == 0
+  topic, payload = device._mqtts.published[-1]
+  assert json.loads(payload) == {"temp": 21.5}
+  assert topic == "devices/dev1/messages/events/$.ct=application%2Fjson&$.ce=utf-8"
+
+  device.sendTelemetry({"temp": 22}, {"iothub-creation-time-utc": "2020"})
+  assert device._mqtts.published[-1][0] == "devices/dev1/messages/events/iothub-creation-time-utc=2020&$.ct=application%2Fjson&$.ce=utf-8"
+
+  device.sendTelemetry({"temp": 23}, {"$.ct": "application%2Fvnd.custom%2Bjson"}) # caller's content type wins
+  assert device._mqtts.published[-1][0] == "devices/dev1/messages/events/$.ct=application%2Fvnd.custom%2Bjson"
+
+  device.sendTelemetry("{\"temp\": 24}") # text is sent as before
+  assert device._mqtts.published[-1] == ("devices/dev1/messages/events/", "{\"temp\": 24}")
+
+def test_bytes_are_not_copied():
+  device = createDevice()
+  data = b"\x01\x02\x03\x04"
+  device.sendTelemetry(data)
+  assert device._mqtts.published[-1][1] is data
+
+  buffer = bytearray(b"abcdef")
+  device.sendTelemetry(memoryview(buffer))
+  assert device._mqtts.published[-1][1] is buffer
+  device.sendTelemetry(memoryview(buffer)[2:4]) # a slice has to be copied once
+  assert device._mqtts.published[-1][1] == b"cd"
+
+def test_pluggable_encoders():
+  device = createDevice()
+  assert device.setEncoder(IOTEncoding.IOTC_ENCODING_ORJSON) == 0
+  device.sendTelemetry({"temp": 1})
+  topic, payload = device._mqtts.published[-1]
+  assert payload == b'{"temp":1}'
+  assert topic.endswith("$.ct=application%2Fjson&$.ce=utf-8")
+
+  try:
+    import msgpack
+    assert device.setEncoder(IOTEncoding.IOTC_ENCODING_MSGPACK) == 0
+    device.sendTelemetry({"temp": 2})
+    assert msgpack.unpackb(device._mqtts.published[-1][1]) == {"temp": 2}
+  except ImportError:
+    try:
+      device.setEncoder(IOTEncoding.IOTC_ENCODING_MSGPACK)
+      assert False
+    except IOTDependencyError as e:
+      assert e.package == "msgpack"
+
+  assert device.setEncoder(CSVEncoder()) == 0
+  device.sendTelemetry({"b": 2, "a": 1})
+  assert device._mqtts.published[-1] == ("devices/dev1/messages/events/$.ct=text%2Fcsv&$.ce=utf-8", "a=1,b=2")
+  assert device.setEncoder(99) == 1
+
+def test_property_dicts_stay_json():
+  device = createDevice()
+  device.setEncoder(CSVEncoder())
+  assert device.sendProperty({"interval": 30}) == 0
+  topic, payload = device._mqtts.published[-1]
+  assert topic.startswith("$iothub/twin/PATCH/properties/reported/?$rid=")
+  assert json.loads(payload) == {"interval": 30}
+
+  device.sendProperty(b"{\"mode\": \"eco\"}")
+  rid = device._mqtts.published[-1][0].split("$rid=")[1]
+  device._routeMessage("$iothub/twin/res/204/?$rid={}&$version=3".format(rid), b"")
+  assert device.getLocalTwin()["reported"]["mode"] == "eco"
+
+def test_batching_and_file_queue_with_binary_payloads():
+  device = createDevice()
+  device.enableBatching(10, 4096, 60000)
+  device.sendTelemetry({"a": 1})
+  device.sendTelemetry({"a": 2})
+  device.sendTelemetry(b"\x00\x01") # binary payloads are not batched, the batch goes first
+  assert len(device._mqtts.published) == 2
+  assert json.loads(device._mqtts.published[0][1]) == [{"a": 1}, {"a": 2}]
+  assert device._mqtts.published[1] == ("devices/dev1/messages/events/", b"\x00\x01")
+  device.disableBatching()
+
+  folder = tempfile.mkdtemp()
+  try:
+    path = os.path.join(folder, "queue.bin")
+    device._mqtts.online = False
+    device.enableOutboundQueue(path = path)
+    device.sendTelemetry(b"\xff\x00")
+    device.sendTelemetry({"a": 3})
+    assert device.getQueueLength() == 2
+
+    restored = iotc._FileQueueStore(path)
+    assert restored.peek() == ["devices/dev1/messages/events/", b"\xff\x00"]
+    restored.pop()
+    assert json.loads(restored.peek()[1]) == {"a": 3}
+    restored._file.close()
+    device._queue._store._file.close()
+  finally:
+    shutil.rmtree(folder)
+
+if __name__ == "__main__":
+  test_dict_is_encoded_with_content_type()
+  test_bytes_are_not_copied()
+  test_pluggable_encoders()
+  test_property_dicts_stay_json()
+  test_batching_and_file_queue_with_binary_payloads()
@@ -0,0 +1,154 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import time
+import socket
+import threading
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTConnectType
+from iotc.fleet import DeviceFleet, _NetworkLoop
+from helpers import waitFor
+
+class StubClient:
+  # the parts of the paho client `_NetworkLoop` drives, over a socketpair
+  def __init__(self, connectDelay = 0):
+    self.connectDelay = connectDelay
+    self.connectThread = None
+    self.peer = None
+    self.sock = None
+    self.outgoing = b""
+    self.received = b""
+    self.misc = 0
+
+  def reconnect(self):
+    self.connectThread = threading.current_thread()
+    time.sleep(self.connectDelay) # TCP + TLS handshake
+    self.sock, self.peer = socket.socketpair()
+    self.sock.setblocking(False)
+    self.on_socket_open(self, None, self.sock)
+
+  def socket(self):
+    return self.sock
+
+  def publish(self, payload):
+    self.outgoing += payload
+    self.on_socket_register_write(self, None, self.sock)
+
+  def loop_write(self):
+    sent = self.sock.send(self.outgoing)
+    self.outgoing = self.outgoing[sent:]
+    if len(self.outgoing) == 0:
+      self.on_socket_unregister_write(self, None, self.sock)
+
+  def loop_read(self):
+    data = self.sock.recv(4096)
+    if len(data) == 0: # peer has closed
+      self.disconnect()
+    self.received += data
+
+  def loop_misc(self):
+    self.misc = self.misc + 1
+    return 0
+
+  def disconnect(self):
+    sock = self.sock
+    self.sock = None
+    self.on_socket_close(self, None, sock)
+    sock.close()
+
+class StubDevice:
+  def __init__(self):
+    self.connected = True
+
+  def isConnected(self):
+    return self.connected
+
+def connectInThread(client, device):
+  thread = threading.Thread(target=client.reconnect)
+  thread.daemon = True
+  thread.start()
+
+def test_loop_serves_many_clients():
+  loop = _NetworkLoop("test-loop", lambda client: None, connectInThread)
+  clients = [StubClient(connectDelay = 0.2) for i in range(5)]
+  started = time.time()
+  for client in clients:
+    loop.attach(client, StubDevice())
+  assert time.time() - started < 0.2 # the handshakes don't run on the caller's thread
+  assert waitFor(lambda: all(client.sock != None for client in clients))
+  assert all(client.connectThread is not threading.current_thread() for client in clients)
+  assert waitFor(lambda: len(loop._sockets) == 5)
+
+  for index, client in enumerate(clients): # written by the loop thread
+    client.publish(b"telemetry " + str(index).encode("utf-8"))
+  for index, client in enumerate(clients):
+    client.peer.settimeout(2)
+    assert client.peer.recv(100) == b"telemetry " + str(index).encode("utf-8")
+  clients[2].peer.send(b"\x30\x00") # read by the loop thread
+  assert waitFor(lambda: clients[2].received == b"\x30\x00")
+  assert waitFor(lambda: all(client.misc > 0 for client in clients), 3)
+
+  for client in clients:
+    loop.detach(client)
+    client.disconnect()
+  assert waitFor(lambda: len(loop._clients) == 0 and len(loop._sockets) == 0)
+  loop.stop()
+  assert loop._thread == None
+  for client in clients:
+    client.peer.close()
+
+def test_unexpected_close_reconnects():
+  reconnects = []
+  loop = _NetworkLoop("test-loop", reconnects.append, lambda client, device: client.reconnect())
+  client = StubClient()
+  device = StubDevice()
+  loop.attach(client, device)
+  assert waitFor(lambda: len(loop._sockets) == 1)
+  client.peer.close() # the hub dropped the connection
+  assert waitFor(lambda: reconnects == [client])
+  device.connected = False
+  loop.detach(client)
+  assert waitFor(lambda: len(loop._clients) == 0)
+  loop.stop()
+
+def test_failed_connect_does_not_wait_for_connack():
+  listener = socket.socket()
+  listener.bind(("127.0.0.1", 0))
+  port = listener.getsockname()[1]
+  listener.close() # nothing listens on `port`
+
+  fleet = DeviceFleet()
+  device = fleet.createDevice("scope", "a2V5", "dev1", IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+  started = time.time()
+  assert device.connect("127.0.0.1:{}".format(port)) == 1
+  assert time.time() - started < 5
+  fleet.disconnectAll()
+
+def test_connect_timeout():
+  listener = socket.socket() # accepts TCP, never answers the TLS handshake
+  listener.bind(("127.0.0.1", 0))
+  listener.listen(1)
+  fleet = DeviceFleet()
+  device = fleet.createDevice("scope", "a2V5", "dev1", IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+  assert device.setConnectTimeout(0) == 1
+  assert device.setConnectTimeout(0.3) == 0
+  started = time.time()
+  try:
+    assert device.connect("127.0.0.1:{}".format(listener.getsockname()[1])) == 1
+    assert time.time() - started < 3
+  finally:
+    listener.close()
+    fleet.disconnectAll()
+
+if __name__ == "__main__":
+  test_loop_serves_many_clients()
+  test_unexpected_close_reconnects()
+  test_failed_connect_does_not_wait_for_connack()
+  test_connect_timeout()
@@ -0,0 +1,138 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+# fixtures shared by the unit tests: a paho stand-in recording what a device
+# publishes, and devices wired to it without a network
+
+import os
+import sys
+import json
+import time
+import asyncio
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTConnectType
+
+class Message:
+  # paho `MQTTMessage`
+  def __init__(self, topic, payload):
+    self.topic = topic
+    self.payload = payload
+
+class MessageInfo:
+  # paho `MQTTMessageInfo`, what AsyncDevice gets back from `publish`
+  def __init__(self, rc, mid, published):
+    self.rc = rc
+    self.mid = mid
+    self._published = published
+
+  def is_published(self):
+    return self._published
+
+  def __iter__(self): # `rc, mid = publish(...)` as on paho's
+    return iter((self.rc, self.mid))
+
+  def __getitem__(self, index):
+    return (self.rc, self.mid)[index]
+
+class StubClient:
+  # records (topic, payload) of every publish. while `online` is False publishes
+  # fail with MQTT_ERR_NO_CONN; `inline` acknowledges before `publish` returns,
+  # like paho does for a message written right away
+  def __init__(self, device = None, inline = False, wrapAt = 65535):
+    self.device = device
+    self.inline = inline
+    self.wrapAt = wrapAt
+    self.online = True
+    self.disconnected = False
+    self.published = []
+    self.subscribed = []
+
+  def is_connected(self):
+    return self.online
+
+  def socket(self):
+    return None
+
+  def publish(self, topic, payload, qos=0):
+    if not self.online:
+      return (4, 0) # MQTT_ERR_NO_CONN
+    self.published.append((topic, payload))
+    mid = (len(self.published) - 1) % self.wrapAt + 1
+    if self.inline:
+      self.device._onPublish(self, None, mid)
+    return (0, mid)
+
+  def subscribe(self, topic, qos=0):
+    self.subscribed.append(topic)
+    return (0, len(self.subscribed))
+
+  def disconnect(self):
+    self.disconnected = True
+    if self.device != None:
+      self.device._onDisconnect(self, None, 0)
+
+  def loop_stop(self):
+    pass
+
+class AsyncStubClient(StubClient):
+  def publish(self, topic, payload, qos=0):
+    rc, mid = StubClient.publish(self, topic, payload, qos)
+    return MessageInfo(rc, mid, self.inline)
+
+def createDevice(deviceId = "dev1", deviceClass = iotc.Device, **kwargs):
+  # a connected device publishing to a StubClient(device, **kwargs)
+  device = deviceClass("scope", "a2V5", deviceId, IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+  device._mqtts = StubClient(device, **kwargs)
+  device._mqttConnected = True
+  return device
+
+def createAsyncDevice(deviceId = "dev1", inline = False):
+  # call from a coroutine, the device runs on its loop
+  from iotc.aio import AsyncDevice
+  device = AsyncDevice("scope", "a2V5", deviceId, IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+  device._loop = asyncio.get_running_loop()
+  device._mqtts = AsyncStubClient(device, inline)
+  device._mqttConnected = True
+  return device
+
+def receive(device, topic, payload = None):
+  # delivers a message as paho's network thread does. dicts and lists are sent as JSON
+  if payload == None:
+    payload = b""
+  elif isinstance(payload, (dict, list)):
+    payload = json.dumps(payload).encode("utf-8")
+  elif not isinstance(payload, bytes):
+    payload = payload.encode("utf-8")
+  device._onMessage(None, None, Message(topic.encode("utf-8"), payload))
+
+def answerTwin(device, twin, status = 200):
+  # answers the last twin GET the device has published
+  topic = [topic for topic, _ in device._mqtts.published if topic.startswith("$iothub/twin/GET/")][-1]
+  receive(device, topic.replace("GET", "res/" + str(status)), twin)
+
+def sendCommand(device, name, rid, payload = "{}"):
+  receive(device, "$iothub/methods/POST/{}/?$rid={}".format(name, rid), payload)
+
+def waitFor(condition, timeout = 5):
+  deadline = time.time() + timeout
+  while not condition() and time.time() < deadline:
+    time.sleep(0.005)
+  return condition()
+
+async def waitForAsync(condition, timeout = 5):
+  deadline = time.time() + timeout
+  while not condition() and time.time() < deadline:
+    await asyncio.sleep(0.005)
+  return condition()
+
+def runAsync(coro):
+  loop = asyncio.new_event_loop()
+  try:
+    return loop.run_until_complete(coro)
+  finally:
+    loop.close()
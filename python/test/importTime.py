@@ -0,0 +1,89 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+# `import iotc` must not pull the transport / crypto stack
+
+import os
+import sys
+import tempfile
+import subprocess
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+src_path = os.path.join(file_path, "..", "src")
+sys.dont_write_bytecode = True
+
+DEFERRED = ["ssl", "http.client", "paho.mqtt.client", "hashlib", "hmac", "base64", "json", "urllib.parse", "socket"]
+
+cache_path = tempfile.mkdtemp(prefix="iotc-importtime-")
+
+def run(code, *flags):
+  env = dict(os.environ)
+  env["PYTHONPATH"] = src_path
+  env["PYTHONPYCACHEPREFIX"] = cache_path # measure with bytecode cached, outside the source tree
+  env.pop("PYTHONDONTWRITEBYTECODE", None)
+  return subprocess.run([sys.executable] + list(flags) + ["-c", code], env=env, capture_output=True, text=True)
+
+def importTimes():
+  # => { module: cumulative microseconds } for `import iotc` and the modules it
+  # imports, from `python -X importtime`. interpreter startup is left out
+  run("import iotc") # warm the bytecode cache
+  result = run("import iotc", "-X", "importtime")
+  assert result.returncode == 0, result.stderr
+  trace = []
+  for line in result.stderr.splitlines():
+    if not line.startswith("import time:") or "cumulative" in line:
+      continue
+    _, cumulative, name = line[len("import time:"):].split("|")
+    trace.append((name[1:], int(cumulative))) # indented by two spaces per level
+  times = {}
+  for name, cumulative in reversed(trace): # a module is listed after the ones it imports
+    if name == "iotc":
+      times[name] = cumulative
+    elif len(times) > 0:
+      if not name.startswith("  "): # back at the top level
+        break
+      times[name.strip()] = cumulative
+  return times
+
+def test_import_defers_transport_and_crypto():
+  result = run("import sys, iotc; print(' '.join(name for name in %r if name in sys.modules))" % (DEFERRED,))
+  assert result.returncode == 0, result.stderr
+  assert result.stdout.strip() == "", "imported eagerly: " + result.stdout.strip()
+
+def test_import_trace_has_no_deferred_modules():
+  times = importTimes()
+  assert "iotc" in times
+  assert [name for name in DEFERRED if name in times] == []
+
+def test_missing_dependency_raises_typed_error():
+  code = "\n".join([
+    "import sys",
+    "sys.modules['paho'] = None",
+    "import iotc", # no exit at import
+    "device = iotc.Device('scope', 'a2V5', 'dev1', iotc.IOTConnectType.IOTC_CONNECT_SYMM_KEY)",
+    "try:",
+    "  iotc._requireMQTT()",
+    "  assert False",
+    "except iotc.IOTDependencyError:",
+    "  pass",
+    "try:",
+    "  iotc._createMQTTClient(device, 'user', 'pass')",
+    "except iotc.IOTDependencyError as e:",
+    "  assert isinstance(e, ImportError)",
+    "  print(e.package)"
+  ])
+  result = run(code)
+  assert result.returncode == 0, result.stderr
+  assert result.stdout.strip() == "paho-mqtt"
+
+def test_preload_dependencies():
+  result = run("import sys, iotc; assert iotc.preloadDependencies() == 0; print('ssl' in sys.modules, 'paho.mqtt.client' in sys.modules)")
+  assert result.returncode == 0, result.stderr
+  assert result.stdout.strip() == "True True"
+
+if __name__ == "__main__":
+  test_import_defers_transport_and_crypto()
+  test_import_trace_has_no_deferred_modules()
+  test_missing_dependency_raises_typed_error()
+  test_preload_dependencies()
+  print(importTimes()["iotc"], "us")
@@ -0,0 +1,108 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import time
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTMessageStatus
+from helpers import createDevice
+
+def createTrackedDevice(**kwargs):
+  device = createDevice(**kwargs)
+  events = []
+  device.on("MessageSent", lambda info: events.append(("sent", info.getPayload(), info.getMessageId())))
+  device.on("MessageTimeout", lambda info: events.append(("timeout", info.getPayload(), info.getStatusCode())))
+  return device, events
+
+def test_ack_releases_record():
+  device, events = createTrackedDevice()
+  assert device.sendTelemetry("{\"a\":1}") == 0
+  assert device.getInFlightCount() == 1
+  device._onPublish(None, None, 1)
+  device._onPublish(None, None, 1) # duplicate ack is ignored
+  assert events == [("sent", "{\"a\":1}", 1)]
+  assert device.getInFlightCount() == 0
+
+def test_ack_before_publish_returns():
+  device, events = createTrackedDevice(inline=True)
+  for i in range(3):
+    assert device.sendTelemetry(str(i)) == 0
+  assert [event[1] for event in events] == ["0", "1", "2"]
+  assert device.getInFlightCount() == 0
+  assert len(device._inFlight._early) == 0
+
+def test_timeout_raises_event():
+  device, events = createTrackedDevice()
+  device.setMessageTimeout(10)
+  device.sendTelemetry("{\"a\":1}")
+  device._sendCommon("$iothub/twin/GET/?$rid=1", " ", True) # internal, no events
+  assert device._inFlight.expire(time.time() + 5) == []
+  for record in device._inFlight.expire(time.time() + 11):
+    device._messageEvent("MessageTimeout", record.payload, record.tag, IOTMessageStatus.IOTC_MESSAGE_ABANDONED, record.msgid)
+  assert events == [("timeout", "{\"a\":1}", IOTMessageStatus.IOTC_MESSAGE_ABANDONED)]
+  assert device.getInFlightCount() == 0
+
+  device._onPublish(None, None, 1) # late ack after the timeout
+  assert len(events) == 1
+
+def test_scheduled_expiry():
+  device, events = createTrackedDevice()
+  device.setMessageTimeout(0.05)
+  device.enableBatching(10, 1024, 60000)
+  device.sendTelemetry("a")
+  device.sendTelemetry("b")
+  device.flushBatch()
+  deadline = time.time() + 5
+  while len(events) < 2 and time.time() < deadline:
+    time.sleep(0.01)
+  assert events == [("timeout", "a", IOTMessageStatus.IOTC_MESSAGE_ABANDONED), ("timeout", "b", IOTMessageStatus.IOTC_MESSAGE_ABANDONED)]
+
+def test_max_in_flight():
+  device, events = createTrackedDevice()
+  device.setMaxInFlight(2)
+  assert device.sendTelemetry("a") == 0
+  assert device.sendTelemetry("b") == 0
+  assert device.sendTelemetry("c") == 1
+  assert device._sendCommon("$iothub/twin/GET/?$rid=1", " ", True) == 0 # internal publishes aren't limited
+  device._onPublish(None, None, 1)
+  assert device.sendTelemetry("c") == 0
+
+def test_msgid_wrap_around():
+  device, events = createTrackedDevice(wrapAt=2)
+  device.sendTelemetry("a") # mid 1
+  device.sendTelemetry("b") # mid 2
+  device.sendTelemetry("c") # mid 1 again, "a" can no longer be matched
+  assert events == [("timeout", "a", IOTMessageStatus.IOTC_MESSAGE_ABANDONED)]
+  device._onPublish(None, None, 1)
+  assert events[-1] == ("sent", "c", 1)
+  assert device.getInFlightCount() == 1
+
+def test_tracker_without_ordered_dict():
+  OrderedDict = iotc.OrderedDict
+  iotc.OrderedDict = None # MicroPython without `collections.OrderedDict`
+  try:
+    device, events = createTrackedDevice()
+  finally:
+    iotc.OrderedDict = OrderedDict
+  assert isinstance(device._inFlight._records, iotc._InsertionOrderedDict)
+  device.setMessageTimeout(10)
+  for payload in ("a", "b", "c"):
+    device.sendTelemetry(payload)
+  device._onPublish(None, None, 2)
+  assert [record.payload for record in device._inFlight.expire(time.time() + 11)] == ["a", "c"] # oldest first
+  assert events == [("sent", "b", 2)] and device.getInFlightCount() == 0
+
+if __name__ == "__main__":
+  test_ack_releases_record()
+  test_ack_before_publish_returns()
+  test_timeout_raises_event()
+  test_scheduled_expiry()
+  test_max_in_flight()
+  test_msgid_wrap_around()
+  test_tracker_without_ordered_dict()
@@ -0,0 +1,106 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import time
+import threading
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTConnectType, IOTLogLevel, LOG_IOTC
+
+class Counted:
+  def __init__(self):
+    self.formatted = 0
+
+  def __str__(self):
+    self.formatted += 1
+    return "counted"
+
+def withLogging(level, sink, fn):
+  device = iotc.Device("scope", "a2V5", "dev1", IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+  device.setLogLevel(level)
+  device.setLogSink(sink)
+  try:
+    return fn()
+  finally:
+    device.setLogLevel(IOTLogLevel.IOTC_LOGGING_DISABLED)
+    device.setLogSink(None)
+
+def test_disabled_logging_does_not_format():
+  records = []
+  value = Counted()
+  withLogging(IOTLogLevel.IOTC_LOGGING_DISABLED, records.append, lambda: LOG_IOTC("value %s", IOTLogLevel.IOTC_LOGGING_ALL, value, device="dev1"))
+  withLogging(IOTLogLevel.IOTC_LOGGING_API_ONLY, records.append, lambda: LOG_IOTC("value %s", IOTLogLevel.IOTC_LOGGING_ALL, value))
+  assert records == [] and value.formatted == 0
+
+def test_structured_record():
+  records = []
+  withLogging(IOTLogLevel.IOTC_LOGGING_ALL, records.append, lambda: LOG_IOTC("sent %s", IOTLogLevel.IOTC_LOGGING_ALL, "{}", device="dev1", msgid=3))
+  record = records[0]
+  assert record.getLevel() == IOTLogLevel.IOTC_LOGGING_ALL
+  assert record.getMessage() == "sent {}"
+  assert record.getFields() == {"device": "dev1", "msgid": 3}
+  assert str(record) == "sent {} [device=dev1 msgid=3]"
+  assert str(iotc.IOTLogRecord(0, 2, "plain %d", ("x",), {})) == "plain %d x" # bad format doesn't raise
+
+def test_queue_sink_does_not_block():
+  written = []
+  def slowSink(record):
+    time.sleep(0.01)
+    written.append(record.getMessage())
+
+  sink = iotc.IOTQueueLogSink(slowSink)
+  def run():
+    start = time.time()
+    for i in range(20):
+      LOG_IOTC("message %d", IOTLogLevel.IOTC_LOGGING_API_ONLY, i)
+    elapsed = time.time() - start
+    assert sink.flush(5)
+    return elapsed
+
+  assert withLogging(IOTLogLevel.IOTC_LOGGING_API_ONLY, sink, run) < 0.1
+  assert written == ["message " + str(i) for i in range(20)]
+
+def test_queue_sink_drops_oldest():
+  written = []
+  sink = iotc.IOTQueueLogSink(lambda record: written.append(record.getMessage()), 5)
+  sink._thread = "paused" # records stay queued until the writer starts
+  for i in range(12):
+    sink(iotc.IOTLogRecord(0, 2, "message %d", (i,), {}))
+  assert sink.getDropped() == 7
+  assert [record.getMessage() for record in sink._records] == ["message " + str(i) for i in range(7, 12)]
+
+  sink._thread = None
+  sink._start()
+  sink._event.set()
+  assert sink.flush(5)
+  deadline = time.time() + 5
+  while len(written) < 6 and time.time() < deadline:
+    time.sleep(0.01)
+  assert written == ["message " + str(i) for i in range(7, 12)] + ["WARNING: 7 log records dropped"]
+
+def test_queue_sink_flush_with_many_producers():
+  sink = iotc.IOTQueueLogSink(lambda record: None, 50)
+  def produce():
+    for i in range(2000):
+      sink(iotc.IOTLogRecord(0, 2, "message %d", (i,), {}))
+
+  threads = [threading.Thread(target=produce) for i in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert sink.flush(5) # every accepted record is written or counted as dropped
+  assert sink._written == sink._accepted == 8000
+
+if __name__ == "__main__":
+  test_disabled_logging_does_not_format()
+  test_structured_record()
+  test_queue_sink_does_not_block()
+  test_queue_sink_drops_oldest()
+  test_queue_sink_flush_with_many_producers()
@@ -0,0 +1,152 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTConnectType
+from iotc.fleet import DeviceFleet
+from helpers import createDevice
+
+def test_publish_counters_and_latency():
+  device = createDevice()
+  assert device.sendTelemetry("{\"a\": 1}") == 0
+  assert device.sendTelemetry(b"\x01\x02\x03") == 0
+  stats = device.getStats()
+  assert stats["messagesSent"] == 2 and stats["bytesOut"] == 11
+  assert stats["inFlight"] == 2 and stats["messagesAcked"] == 0
+
+  time.sleep(0.03)
+  device._onPublish(None, None, 1)
+  device._onPublish(None, None, 2)
+  stats = device.getStats()
+  assert stats["messagesAcked"] == 2 and stats["inFlight"] == 0
+  latency = stats["publishLatency"]
+  assert latency["count"] == 2 and 0.03 <= latency["sum"] < 1
+  assert sum(latency["counts"]) == 2 and len(latency["counts"]) == len(latency["bounds"]) + 1
+  assert latency["counts"][latency["bounds"].index(0.025)] == 0 # fixed buckets, no samples kept
+
+  device._onPublish(None, None, 3) # acknowledged before `publish` returned
+  device.sendTelemetry("{}")
+  assert device.getStats()["publishLatency"]["counts"][0] == 1
+
+  device.sendTelemetry(u"\"\u00e9\"") # counted in UTF-8 bytes
+  device._onPublish(None, None, 4)
+  assert device.getStats()["bytesOut"] == 11 + 2 + 4
+
+  device._mqtts.online = False # MQTT_ERR_NO_CONN
+  assert device.sendTelemetry("{}") == 1
+  device._mqtts.online = True
+  device.setMessageTimeout(0.01)
+  device.sendTelemetry("{}")
+  time.sleep(0.02)
+  device._expireInFlight()
+  stats = device.getStats()
+  assert stats["messagesFailed"] == 2 and stats["messagesSent"] == 5
+
+def test_inbound_connections_and_commands():
+  device = createDevice()
+  device.on("Command", lambda info: info.setResponse(200, "{}"))
+  device._routeMessage("$iothub/methods/POST/reboot/?$rid=1", b"{\"delay\": 1}")
+  device._routeMessage("$iothub/twin/PATCH/properties/desired/?$version=2", b"{\"$version\": 2}")
+  device._onConnect(None, None, None, 0)
+  device._onDisconnect(None, None, 1)
+  device._onConnect(None, None, None, 0)
+  stats = device.getStats()
+  assert stats["messagesReceived"] == 2 and stats["bytesIn"] == 27
+  assert stats["commandsHandled"] == 1 and stats["commandsTimedOut"] == 0
+  assert stats["messagesSent"] == 1 and stats["bytesOut"] == 2 # the command response
+  assert stats["connects"] == 2 and stats["reconnects"] == 1 and stats["disconnects"] == 1
+
+  device.setCommandTimeout(0.01)
+  device.on("Command", lambda info: info.defer())
+  device._routeMessage("$iothub/methods/POST/slow/?$rid=2", b"{}")
+  time.sleep(0.02)
+  device._expireCommands()
+  assert device.getStats()["commandsTimedOut"] == 1
+  assert device._mqtts.published[-1][0] == "$iothub/methods/res/504/?$rid=2"
+
+def test_provisioning_time():
+  device = createDevice()
+  steps = device._provisionSteps()
+  assert next(steps)[0] == "request"
+  step = steps.send((b"{\"operationId\": \"op1\", \"status\": \"assigning\"}", 202, 0))
+  assert step[0] == "wait"
+  next(steps)
+  step = steps.send((json.dumps({"status": "assigned", "registrationState": {"assignedHub": "hub"}}).encode("utf-8"), 200, None))
+  assert step == ("done", "hub", None)
+  stats = device.getStats()
+  assert stats["provisioned"] == 1 and stats["provisioningTime"]["count"] == 1
+
+  steps = device._provisionSteps()
+  next(steps)
+  assert steps.send((b"{\"errorCode\": 401002}", 401, None))[0] == "done"
+  assert device.getStats()["provisioningFailed"] == 1
+
+def test_prometheus_exposition():
+  device = createDevice()
+  device.sendTelemetry("{}")
+  device._onPublish(None, None, 1)
+  text = iotc.formatPrometheus(device.getStats(), {"device": "dev\"1"})
+  lines = text.splitlines()
+  assert "# TYPE iotc_messages_sent_total counter" in lines
+  assert 'iotc_messages_sent_total{device="dev\\"1"} 1' in lines
+  assert 'iotc_in_flight{device="dev\\"1"} 0' in lines
+  assert 'iotc_publish_latency_bucket{device="dev\\"1",le="0.005"} 1' in lines
+  assert 'iotc_publish_latency_bucket{device="dev\\"1",le="+Inf"} 1' in lines
+  assert 'iotc_publish_latency_count{device="dev\\"1"} 1' in lines
+  assert 'iotc_provisioning_time_bucket{device="dev\\"1",le="120.0"} 0' in lines
+
+  other = createDevice()
+  text = iotc.formatPrometheus([({"device": "a"}, device.getStats()), ({"device": "b"}, other.getStats())])
+  assert text.count("# TYPE iotc_messages_sent_total counter") == 1 # one family, a sample per device
+  assert 'iotc_messages_sent_total{device="b"} 0' in text
+  assert iotc.formatPrometheus({"messagesSent": 3}) == \
+    "# HELP iotc_messages_sent_total MQTT messages published\n# TYPE iotc_messages_sent_total counter\niotc_messages_sent_total 3\n"
+
+def test_fleet_totals_against_the_emulator():
+  from iotc.emulator import IOTEmulator, createCertificates
+  folder = tempfile.mkdtemp()
+  cafile, certfile, keyfile = createCertificates(folder)
+  emulator = IOTEmulator(certfile, keyfile)
+  assert emulator.start() == 0
+  fleet = DeviceFleet()
+  try:
+    for deviceId in ("m1", "m2"):
+      device = fleet.createDevice("scope", "a2V5", deviceId, IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+      device.setDPSEndpoint(emulator.getDPSEndpoint())
+      device.setCACertificate(cafile)
+    assert fleet.connectAll() == 0
+    for i in range(5):
+      assert fleet.sendAll("{\"i\": %d}" % i) == 0
+    deadline = time.time() + 5
+    while (fleet.getStats()["inFlight"] > 0 or emulator.getStats()["telemetry"] < 10) and time.time() < deadline:
+      time.sleep(0.01)
+
+    stats = fleet.getStats()
+    assert stats["devices"] == 2 and stats["connected"] == 2
+    assert stats["provisioned"] == 2 and stats["provisioningTime"]["count"] == 2
+    assert stats["connects"] == 2 and stats["messagesAcked"] >= 10
+    assert stats["publishLatency"]["count"] == stats["messagesAcked"]
+    assert emulator.getStats()["telemetry"] == 10
+    assert "iotc_devices 2" in iotc.formatPrometheus(stats)
+  finally:
+    fleet.disconnectAll()
+    emulator.stop()
+    shutil.rmtree(folder)
+
+if __name__ == "__main__":
+  test_publish_counters_and_latency()
+  test_inbound_connections_and_commands()
+  test_provisioning_time()
+  test_prometheus_exposition()
+  test_fleet_totals_against_the_emulator()
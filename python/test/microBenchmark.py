@@ -0,0 +1,188 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+# offline micro-benchmarks of the client hot paths against a stub MQTT client
+#   python microBenchmark.py [--save] [--check ratio] [name ...]
+# results (best us per call) are compared with microBenchmark.json; `--save`
+# stores this run as the new baseline, `--check` exits with 1 when a case is
+# more than `ratio` (default 1.5) times slower than the baseline
+
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTConnectType
+from helpers import Message
+
+BASELINE = os.path.join(file_path, "microBenchmark.json")
+KEY = "a2V5LWZvci10aGUtb2ZmbGluZS1iZW5jaG1hcmtzLTEyMzQ1Njc4OTA="
+
+class StubClient:
+  # acknowledges inline like paho does for a message written right away.
+  # unlike `helpers.StubClient` nothing is recorded, runs are millions of calls
+  def __init__(self, device):
+    self._device = device
+    self._mid = 0
+
+  def publish(self, topic, payload, qos=0):
+    self._mid = self._mid + 1
+    self._device._onPublish(None, None, self._mid)
+    return (0, self._mid)
+
+  def subscribe(self, topic, qos=0):
+    return (0, 0)
+
+  def is_connected(self):
+    return True
+
+def createDevice():
+  device = iotc.Device("scope", KEY, "bench-device", IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+  device._mqtts = StubClient(device)
+  device._mqttConnected = True
+  return device
+
+def desiredPatch(count):
+  patch = {"$version": 1}
+  for i in range(count):
+    patch["prop" + str(i)] = {"value": i}
+  return json.dumps(patch).encode("utf-8")
+
+def createCases():
+  # name => fn, a single call of the hot path
+  device = createDevice()
+  device.on("Command", lambda info: info.setResponse(200, "{}"))
+  device.on("EnqueuedCommand", lambda info: None)
+  device.on("SettingsUpdated", lambda info: None)
+  device.addRoute("devices/bench-device/modules/{module}/inputs/#", lambda message: None, False)
+  host = "bench-hub.azure-devices.net"
+  signature = device._computeDrivedSymmetricKey(KEY, "bench-device")
+  properties = {"iothub-creation-time-utc": "2020-01-01T00:00:00Z", "$.mid": "1234"}
+  telemetry = {"temperature": 21.5, "humidity": 40, "pressure": 1013}
+
+  cases = {
+    "_gen_sas_token": lambda: device._gen_sas_token(host, "bench-device", KEY),
+    "_computeDrivedSymmetricKey": lambda: device._computeDrivedSymmetricKey(KEY, "bench-device"),
+    "_quote": lambda: iotc._quote(signature, '~()*!.\''),
+    "_telemetryTopic": lambda: device._telemetryTopic(properties),
+    "sendTelemetry(str)": lambda: device.sendTelemetry("{\"temperature\": 21.5}"),
+    "sendTelemetry(dict, properties)": lambda: device.sendTelemetry(telemetry, properties),
+    "MAKE_CALLBACK": lambda: iotc.MAKE_CALLBACK(device, "SettingsUpdated", "{}", "fan", 0)
+  }
+
+  messages = {
+    "method": Message(b"$iothub/methods/POST/reboot/?$rid=42", b"{\"delay\": 5}"),
+    "desired": Message(b"$iothub/twin/PATCH/properties/desired/?$version=2", b"{\"$version\": 2}"),
+    "twin response": Message(b"$iothub/twin/res/204/?$rid=7&$version=3", b""),
+    "c2d": Message(b"devices/bench-device/messages/devicebound/%24.mid=8d1a&%24.to=%2Fdevices%2Fbench-device%2Fmessages%2FdeviceBound",
+      b"{\"methodName\": \"blink\"}"),
+    "route": Message(b"devices/bench-device/modules/filter/inputs/input1", b"\x01\x02")
+  }
+  for name, message in messages.items():
+    cases["_onMessage(" + name + ")"] = (lambda message: lambda: device._onMessage(None, None, message))(message)
+
+  for count in (10, 100, 1000):
+    payload = desiredPatch(count)
+    def echo(payload = payload):
+      device._twin.desiredVersion = None # every run is a new patch
+      device._twin.clearPending() # the acknowledgements are never answered
+      device._echoDesired(payload, "$iothub/twin/PATCH/properties/desired/?$version=1")
+    cases["_echoDesired(" + str(count) + ")"] = echo
+  return cases
+
+def measure(fn, repeat = 7, minTime = 0.05):
+  # => best seconds per call
+  number = 1
+  while True:
+    elapsed = timeit.timeit(fn, number=number)
+    if elapsed >= minTime or number >= 1000000:
+      break
+    number = number * 10
+  best = min([elapsed] + timeit.repeat(fn, number=number, repeat=repeat - 1))
+  return best / number
+
+def run(names = None, repeat = 7, minTime = 0.05):
+  # => {case: us per call}
+  results = {}
+  for name, fn in createCases().items():
+    if names and not any(part in name for part in names):
+      continue
+    results[name] = measure(fn, repeat, minTime) * 1e6
+  return results
+
+def loadBaseline():
+  if not os.path.exists(BASELINE):
+    return None
+  with open(BASELINE, "r") as baseline:
+    return json.load(baseline)
+
+def saveBaseline(results, baseline):
+  measured = dict(baseline["us"]) if baseline != None else {}
+  measured.update(results) # a filtered run keeps the other cases
+  document = {
+    "python": platform.python_implementation() + " " + platform.python_version(),
+    "machine": platform.machine(),
+    "date": time.strftime("%Y-%m-%d"),
+    "us": dict((name, round(value, 3)) for name, value in measured.items())
+  }
+  with open(BASELINE, "w") as baseline:
+    json.dump(document, baseline, indent=2, sort_keys=True)
+    baseline.write("\n")
+
+def compare(results, baseline, ratio):
+  # => names of the cases slower than `ratio` x baseline
+  regressions = []
+  previous = baseline["us"] if baseline != None else {}
+  for name in sorted(results):
+    line = "%-34s %10.2f us" % (name, results[name])
+    if name in previous:
+      change = results[name] / previous[name]
+      line += "   baseline %10.2f us  x%.2f" % (previous[name], change)
+      if change > ratio:
+        line += "  REGRESSION"
+        regressions.append(name)
+    print(line)
+  return regressions
+
+def test_hot_paths_run_offline():
+  results = run(repeat=1, minTime=0)
+  assert sorted(results) == sorted(createCases())
+  assert all(value > 0 for value in results.values())
+
+def test_baseline_covers_every_case():
+  baseline = loadBaseline()
+  assert baseline != None
+  assert sorted(baseline["us"]) == sorted(createCases())
+
+if __name__ == "__main__":
+  args = sys.argv[1:]
+  save = "--save" in args
+  ratio = None
+  if "--check" in args:
+    index = args.index("--check")
+    ratio = 1.5
+    if index + 1 < len(args):
+      try:
+        ratio = float(args[index + 1])
+        del args[index + 1]
+      except ValueError:
+        pass
+  names = [arg for arg in args if not arg.startswith("--")]
+
+  baseline = loadBaseline()
+  if baseline != None:
+    print("baseline: %s on %s (%s)" % (baseline["python"], baseline["machine"], baseline["date"]))
+  results = run(names)
+  regressions = compare(results, baseline, ratio if ratio != None else 1.5)
+  if save:
+    saveBaseline(results, baseline)
+    print("saved " + BASELINE)
+  if ratio != None and len(regressions) > 0:
+    sys.exit(1)
@@ -57,22 +57,11 @@ assert config["scopeId"] != None and config["masterKey"] != None and config["hos
 testCounter = 0
 devices = []
 
-def compute_key(secret, regId):
-  global gIsMicroPython
-  try:
-    secret = base64.b64decode(secret)
-  except:
-    print("ERROR: broken base64 secret => `" + secret + "`")
-    sys.exit()
-
-  if gIsMicroPython == False:
-    return base64.b64encode(hmac.new(secret, msg=regId.encode('utf8'), digestmod=hashlib.sha256).digest())
-  else:
-    return base64.b64encode(hmac.new(secret, msg=regId.encode('utf8'), digestmod=hashlib._sha256.sha256).digest())
+masterKey = iotc.SymmetricKey(config["masterKey"])
 
 def test_lifetime(id):
   deviceId = "dev" + str(id + 1)
-  devices.append(iotc.Device(config["scopeId"], compute_key(config["masterKey"], deviceId), deviceId, config["TEST_ID"])) # 1 / 2 (symm / x509)
+  devices.append(iotc.Device(config["scopeId"], masterKey.derive(deviceId), deviceId, config["TEST_ID"])) # 1 / 2 (symm / x509)
   if "modelData" in config:
     assert devices[id].setModelData(config["modelData"]) == 0
 
@@ -0,0 +1,107 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import time
+import tempfile
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTConnectType, IOTOverflowPolicy
+from helpers import createDevice, waitFor
+
+def createOfflineDevice():
+  device = createDevice()
+  device._mqtts.online = False
+  return device
+
+def published(device):
+  return [payload for _, payload in device._mqtts.published]
+
+def goOnline(device):
+  device._mqtts.online = True
+  device._onConnect(None, None, None, 0)
+
+def test_queue_drop_oldest():
+  device = createOfflineDevice()
+  assert device.enableOutboundQueue(3, IOTOverflowPolicy.IOTC_OVERFLOW_DROP_OLDEST) == 0
+  for i in range(5):
+    assert device.sendTelemetry(str(i)) == 0
+  assert device.getQueueLength() == 3
+
+  goOnline(device)
+  waitFor(lambda: device.getQueueLength() == 0)
+  assert published(device) == ["2", "3", "4"]
+
+  assert device.sendTelemetry("5") == 0 # online and empty queue, sent directly
+  assert published(device)[-1] == "5"
+
+def test_queue_drop_newest():
+  device = createOfflineDevice()
+  assert device.enableOutboundQueue(2, IOTOverflowPolicy.IOTC_OVERFLOW_DROP_NEWEST) == 0
+  assert device.sendTelemetry("0") == 0
+  assert device.sendTelemetry("1") == 0
+  assert device.sendTelemetry("2") == 1
+  goOnline(device)
+  waitFor(lambda: device.getQueueLength() == 0)
+  assert published(device) == ["0", "1"]
+
+def test_queue_block_timeout():
+  device = createOfflineDevice()
+  assert device.enableOutboundQueue(1, IOTOverflowPolicy.IOTC_OVERFLOW_BLOCK, blockTimeout=0.05) == 0
+  assert device.sendTelemetry("0") == 0
+  start = time.time()
+  assert device.sendTelemetry("1") == 1
+  assert time.time() - start >= 0.05
+
+def test_queue_replay_rate():
+  device = createOfflineDevice()
+  assert device.enableOutboundQueue(100, replayRate=50) == 0
+  for i in range(20):
+    device.sendTelemetry(str(i))
+  goOnline(device)
+  time.sleep(0.15)
+  assert 5 <= len(published(device)) < 20 # 5 messages per 100ms
+  waitFor(lambda: device.getQueueLength() == 0)
+  assert published(device) == [str(i) for i in range(20)]
+
+def test_queue_file_survives_restart():
+  path = os.path.join(tempfile.mkdtemp(), "outbound.log")
+  device = createOfflineDevice()
+  assert device.enableOutboundQueue(3, path=path) == 0
+  assert device.enableBatching(2, 1024, 60000) == 0
+  for i in range(6):
+    device.sendTelemetry('{"i":%d}' % i)
+  device.sendTelemetry('{"i":6}') # pending in the batch
+
+  device = createOfflineDevice() # restart
+  assert device.enableOutboundQueue(2, path=path) == 0
+  assert device.getQueueLength() == 3
+  sent = []
+  device.on("MessageSent", lambda info: sent.append(info.getPayload()))
+  device.sendTelemetry("x") # drops the oldest batch
+  goOnline(device)
+  waitFor(lambda: device.getQueueLength() == 0)
+  assert published(device) == ['[{"i":2},{"i":3}]', '[{"i":4},{"i":5}]', 'x']
+
+  device._onPublish(None, None, 1)
+  assert sent == ['{"i":2}', '{"i":3}']
+  assert os.path.getsize(path) == 0
+
+def test_async_device_rejects_queue():
+  from iotc.aio import AsyncDevice
+  device = AsyncDevice("scope", "a2V5", "dev1", IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+  assert device.enableOutboundQueue(10) == 1
+  assert device._queue == None
+
+if __name__ == "__main__":
+  test_queue_drop_oldest()
+  test_queue_drop_newest()
+  test_queue_block_timeout()
+  test_queue_replay_rate()
+  test_queue_file_survives_restart()
+  test_async_device_rejects_queue()
@@ -0,0 +1,104 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import json
+import time
+import asyncio
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from helpers import createDevice, createAsyncDevice, receive, runAsync
+
+def createCoalescingDevice(windowMs):
+  device = createDevice()
+  assert device.enablePropertyCoalescing(windowMs) == 0
+  sent = []
+  device.on("MessageSent", lambda info: sent.append(info.getPayload()))
+  return device, sent
+
+def rid(topic):
+  return int(topic[topic.find("$rid=") + 5:])
+
+def test_burst_becomes_one_patch():
+  device, sent = createCoalescingDevice(10000)
+  writes = [
+    "{\"interval\": 10}",
+    "{\"location\": {\"lat\": 1}}",
+    "{\"interval\": 20}",
+    "{\"location\": {\"lon\": 2}, \"mode\": \"eco\"}",
+    "{\"mode\": null}"
+  ]
+  for data in writes:
+    assert device.sendProperty(data) == 0
+  device.doNext(0) # window is still open
+  assert device._mqtts.published == []
+
+  assert device.flushProperties() == 0
+  assert len(device._mqtts.published) == 1
+  topic, payload = device._mqtts.published[0]
+  assert json.loads(payload) == {"interval": 20, "location": {"lat": 1, "lon": 2}, "mode": None}
+
+  device._onPublish(None, None, 1) # one completion per original write
+  assert sent == writes
+
+  receive(device, "$iothub/twin/res/204/?$rid={}&$version=5".format(rid(topic)))
+  assert device.getLocalTwin()["reported"] == {"interval": 20, "location": {"lat": 1, "lon": 2}, "$version": 5}
+
+def test_window_flushes_on_its_own():
+  device, sent = createCoalescingDevice(20)
+  device.reportProperties({"a": 1})
+  device.sendProperty("{\"b\": 2}")
+  deadline = time.time() + 2
+  while len(device._mqtts.published) == 0 and time.time() < deadline:
+    time.sleep(0.01)
+  assert len(device._mqtts.published) == 1
+  assert json.loads(device._mqtts.published[0][1]) == {"a": 1, "b": 2}
+
+  device.sendProperty("{\"c\": 3}")
+  device.disablePropertyCoalescing() # flushes
+  assert len(device._mqtts.published) == 2
+
+  device.sendProperty("{\"d\": 4}") # no longer coalesced
+  assert len(device._mqtts.published) == 3
+  rids = [rid(topic) for topic, _ in device._mqtts.published]
+  assert rids == sorted(rids) and len(set(rids)) == 3
+
+def test_non_json_payload_is_sent_as_is():
+  device, sent = createCoalescingDevice(10000)
+  device.sendProperty("not json")
+  assert device._mqtts.published[0][1] == "not json"
+
+def test_async_window_resolves_on_ack():
+  async def run():
+    device = createAsyncDevice()
+    assert device.enablePropertyCoalescing(20) == 0
+    sent = []
+    device.on("MessageSent", lambda info: sent.append(info.getPayload()))
+
+    writes = [asyncio.ensure_future(device.sendProperty("{\"a\": 1}")), asyncio.ensure_future(device.reportProperties({"b": 2}))]
+    await asyncio.sleep(0.1) # the window flushes on the loop
+    assert len(device._mqtts.published) == 1
+    assert json.loads(device._mqtts.published[0][1]) == {"a": 1, "b": 2}
+    assert not any(write.done() for write in writes) # waiting for the PUBACK
+    device._onPublish(None, None, 1)
+    assert await asyncio.gather(*writes) == [0, 0]
+    assert sent == ["{\"a\": 1}", "{\"b\": 2}"]
+
+    device.setRequestTimeout(0.05)
+    write = asyncio.ensure_future(device.sendProperty("{\"c\": 3}"))
+    await asyncio.sleep(0)
+    assert await device.flushProperties() == 1 # never acknowledged, times out
+    assert await write == 1
+
+  runAsync(run())
+
+if __name__ == "__main__":
+  test_burst_becomes_one_patch()
+  test_window_flushes_on_its_own()
+  test_non_json_payload_is_sent_as_is()
+  test_async_window_resolves_on_ack()
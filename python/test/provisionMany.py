@@ -0,0 +1,114 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import json
+import time
+import threading
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+import iotc.fleet
+from iotc import IOTConnectType
+from iotc.fleet import provisionMany
+
+class FakeDPS:
+  # assigns a device after `polls` operation status requests
+  def __init__(self, polls):
+    self.polls = polls
+    self.lock = threading.Lock()
+    self.calls = {}
+    self.inflight = 0
+    self.maxInflight = 0
+
+  def __call__(self, device, url, method, body, headers):
+    with self.lock:
+      self.inflight += 1
+      self.maxInflight = max(self.maxInflight, self.inflight)
+      count = self.calls.get(device._deviceId, 0)
+      self.calls[device._deviceId] = count + 1
+    time.sleep(0.01)
+    with self.lock:
+      self.inflight -= 1
+
+    if device._deviceId == "bad":
+      return json.dumps({"errorCode": 401002}), 401, None
+    if count < self.polls:
+      return json.dumps({"operationId": "op", "status": "assigning"}), 202, "1"
+    return json.dumps({"status": "assigned", "registrationState": {"assignedHub": "hub-" + device._deviceId}}), 200, None
+
+def createDevices(count):
+  return [iotc.Device("scope", "a2V5", "dev" + str(i), IOTConnectType.IOTC_CONNECT_SYMM_KEY) for i in range(count)]
+
+def withFakeDPS(dps, fn):
+  original = iotc.fleet._requestDetails
+  iotc.fleet._requestDetails = dps
+  try:
+    return fn()
+  finally:
+    iotc.fleet._requestDetails = original
+
+def test_provision_many_streams_results():
+  dps = FakeDPS(2)
+  devices = createDevices(40) + [iotc.Device("scope", "a2V5", "bad", IOTConnectType.IOTC_CONNECT_SYMM_KEY)]
+  results = withFakeDPS(dps, lambda: list(provisionMany(devices, concurrency=4, registrationsPerSecond=1000, pollsPerSecond=1000)))
+
+  assert len(results) == 41
+  assert dps.maxInflight <= 4
+  failed = [result for result in results if result.getError() != None]
+  assert len(failed) == 1 and failed[0].getDevice()._deviceId == "bad"
+  for result in results:
+    if result.getError() == None:
+      assert result.getHostName() == "hub-" + result.getDevice()._deviceId
+      assert result.getDevice().getHostName() == result.getHostName()
+      assert result.getElapsed() > 0
+
+def test_provision_many_rate_limit():
+  dps = FakeDPS(0)
+  start = time.time()
+  results = withFakeDPS(dps, lambda: list(provisionMany(createDevices(15), concurrency=8, registrationsPerSecond=10)))
+  assert len(results) == 15
+  assert time.time() - start >= 0.4 # 10 burst + 5 more at 10/s
+
+def test_provision_many_uses_cache():
+  devices = createDevices(2)
+  for device in devices:
+    device.enableProvisioningCache(60)
+  devices[0]._assigned("cached-hub")
+  dps = FakeDPS(0)
+  results = withFakeDPS(dps, lambda: list(provisionMany(devices)))
+  cached = [result for result in results if result.isCached()]
+  assert len(cached) == 1 and cached[0].getHostName() == "cached-hub"
+  assert list(dps.calls.keys()) == ["dev1"]
+
+class BrokenDevice(iotc.Device):
+  def _dpsRegistrationRequest(self):
+    raise IOError("cert.pem: No such file or directory")
+
+def test_provision_many_isolates_failures():
+  devices = createDevices(3)
+  devices.insert(1, BrokenDevice("scope", "a2V5", "broken", IOTConnectType.IOTC_CONNECT_SYMM_KEY))
+  results = withFakeDPS(FakeDPS(1), lambda: list(provisionMany(devices, registrationsPerSecond=1000, pollsPerSecond=1000)))
+  assert len(results) == 4 # the rest of the wave still provisions
+  failed = [result for result in results if result.getError() != None]
+  assert len(failed) == 1 and failed[0].getDevice()._deviceId == "broken"
+  assert "cert.pem" in failed[0].getError()
+
+def test_provision_many_validates_arguments():
+  for args in ({"concurrency": 0}, {"concurrency": -1}, {"registrationsPerSecond": 0}, {"pollsPerSecond": 0}):
+    try:
+      provisionMany(createDevices(1), **args)
+      assert False, args
+    except ValueError:
+      pass
+
+if __name__ == "__main__":
+  test_provision_many_streams_results()
+  test_provision_many_rate_limit()
+  test_provision_many_uses_cache()
+  test_provision_many_isolates_failures()
+  test_provision_many_validates_arguments()
@@ -0,0 +1,112 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import time
+import tempfile
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTConnectType
+
+class ProvisionCalled(Exception):
+  pass
+
+class CacheDevice(iotc.Device):
+  def __init__(self, deviceId, acceptedHost, failure = 5):
+    # `failure`: CONNACK code of other hosts, None for no CONNACK, an exception to raise
+    iotc.Device.__init__(self, "scope", "a2V5", deviceId, IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+    self.acceptedHost = acceptedHost
+    self.failure = failure
+    self.attempts = []
+
+  def _mqttConnect(self, err, hostname, timeout = None):
+    self.attempts.append(hostname)
+    if hostname == self.acceptedHost:
+      self._connectResult = 0
+      return 0
+    if isinstance(self.failure, Exception):
+      raise self.failure
+    self._connectResult = self.failure
+    return 1
+
+  def _closeMQTTClient(self):
+    pass
+
+  def _dpsRegistrationRequest(self):
+    raise ProvisionCalled()
+
+def test_cache_ttl():
+  cache = iotc._ProvisioningCache(None)
+  cache.put("a", "hub-a.azure-devices.net", 60)
+  cache.put("b", "hub-b.azure-devices.net", -1)
+  assert cache.get("a") == "hub-a.azure-devices.net"
+  assert cache.get("b") == None
+  cache.remove("a")
+  assert cache.get("a") == None
+
+def test_cache_file():
+  path = os.path.join(tempfile.mkdtemp(), "dps.json")
+  cache = iotc._ProvisioningCache(path)
+  cache.put("a", "hub-a.azure-devices.net", 60)
+  cache.save()
+  assert iotc._ProvisioningCache(path).get("a") == "hub-a.azure-devices.net"
+
+def test_connect_uses_cache():
+  device = CacheDevice("cached1", "hub-a.azure-devices.net")
+  assert device.enableProvisioningCache(60) == 0
+  device._assigned("hub-a.azure-devices.net")
+
+  device = CacheDevice("cached1", "hub-a.azure-devices.net")
+  assert device.enableProvisioningCache(60) == 0
+  assert device.connect() == 0
+  assert device.attempts == ["hub-a.azure-devices.net"]
+  assert device.getHostName() == "hub-a.azure-devices.net"
+
+def test_connect_falls_back_to_dps():
+  device = CacheDevice("cached2", "hub-b.azure-devices.net")
+  assert device.enableProvisioningCache(60) == 0
+  device._assigned("hub-a.azure-devices.net")
+
+  try:
+    device.connect()
+    assert False, "DPS was not called"
+  except ProvisionCalled:
+    pass
+
+  assert device.attempts == ["hub-a.azure-devices.net"]
+  assert device._cachedHostName() == None
+
+def test_cache_is_kept_without_connack():
+  for failure in (None, 3, IOError("Name or service not known")):
+    device = CacheDevice("cached4", "hub-b.azure-devices.net", failure)
+    assert device.enableProvisioningCache(60) == 0
+    device._assigned("hub-a.azure-devices.net")
+    try:
+      device.connect() # falls back to DPS, exceptions included
+      assert False, "DPS was not called"
+    except ProvisionCalled:
+      pass
+    if failure == None: # no CONNACK in time, the assignment is kept
+      assert device._cachedHostName() == "hub-a.azure-devices.net"
+    else: # the hub isn't reachable
+      assert device._cachedHostName() == None
+
+def test_cache_key_includes_model():
+  device = CacheDevice("cached3", None)
+  device.enableProvisioningCache(60)
+  key = device._provisioningCacheKey()
+  device.setModelData({"iotcModelId": "urn:model:1"})
+  assert device._provisioningCacheKey() != key
+
+if __name__ == "__main__":
+  test_cache_ttl()
+  test_cache_file()
+  test_connect_uses_cache()
+  test_connect_falls_back_to_dps()
+  test_cache_is_kept_without_connack()
+  test_cache_key_includes_model()
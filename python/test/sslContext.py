@@ -0,0 +1,63 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import ssl
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTConnectType
+
+class FakeTLSSocket:
+  def __init__(self, context, session):
+    self.context = context
+    self.session = session
+
+def test_context_is_shared_per_settings():
+  iotc.gSSLContexts.clear()
+  first = iotc._getSSLContext(None, None)
+  assert iotc._getSSLContext(None, None) is first
+  assert first.verify_mode == ssl.CERT_REQUIRED and first.check_hostname
+
+def test_verification_stays_on():
+  iotc.gSSLContexts.clear()
+  contexts = []
+  class Device(iotc.Device):
+    def _startMQTTLoop(self):
+      contexts.append(self._mqtts._ssl_context)
+
+  device = Device("scope", "a2V5", "dev1", IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+  assert device.setSSLVerification(False) == 0 # never applied to the hub or DPS
+  iotc._createMQTTClient(device, "user", "pass")
+  assert contexts[0].verify_mode == ssl.CERT_REQUIRED and contexts[0].check_hostname
+
+def test_devices_share_mqtt_context():
+  iotc.gSSLContexts.clear()
+  contexts = []
+  class Device(iotc.Device):
+    def _startMQTTLoop(self):
+      contexts.append(self._mqtts._ssl_context)
+
+  for deviceId in ["dev1", "dev2", "dev3"]:
+    device = Device("scope", "a2V5", deviceId, IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+    iotc._createMQTTClient(device, "user", "pass")
+  assert len(iotc.gSSLContexts) == 1
+  assert contexts[0] is contexts[1] is contexts[2]
+
+def test_session_is_saved_per_host():
+  iotc.gSSLContexts.clear()
+  context = iotc._getSSLContext(None, None)
+  iotc._saveTLSSession(FakeTLSSocket(context, "session-a"), "hub-a")
+  iotc._saveTLSSession(FakeTLSSocket(context, None), "hub-b")
+  iotc._saveTLSSession(None, "hub-c")
+  assert context._sessions == {"hub-a": "session-a"}
+
+if __name__ == "__main__":
+  test_context_is_shared_per_settings()
+  test_verification_stays_on()
+  test_devices_share_mqtt_context()
+  test_session_is_saved_per_host()
@@ -0,0 +1,71 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+# per-connect TLS setup CPU, new SSLContext per connect (0.3.x) vs the shared context cache
+#   python sslContextBenchmark.py [connects] [host:port]
+# with host:port (e.g. your hub:8883) full vs resumed TLS handshakes are measured as well
+
+import os
+import sys
+import ssl
+import time
+import socket
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+
+def newContext():
+  # what every connect did before the cache
+  context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+  context.load_default_certs()
+  context.verify_mode = ssl.CERT_REQUIRED
+  context.check_hostname = True
+  return context
+
+def cpuPerCall(fn, count):
+  start = time.process_time()
+  for i in range(count):
+    fn()
+  return (time.process_time() - start) / count
+
+def benchContexts(count):
+  iotc.gSSLContexts.clear()
+  before = cpuPerCall(newContext, count)
+  after = cpuPerCall(lambda: iotc._getSSLContext(None, None), count)
+  return before, after
+
+def handshake(context, host, port):
+  sock = socket.create_connection((host, port))
+  tls = context.wrap_socket(sock, server_hostname=host)
+  iotc._saveTLSSession(tls, host)
+  reused = tls.session_reused
+  tls.close()
+  return reused
+
+def benchHandshakes(host, port, count):
+  iotc.gSSLContexts.clear()
+  full = cpuPerCall(lambda: handshake(newContext(), host, port), count)
+  context = iotc._getSSLContext(None, None)
+  handshake(context, host, port)
+  resumed = cpuPerCall(lambda: handshake(context, host, port), count)
+  return full, resumed, handshake(context, host, port)
+
+def test_cached_context_is_reused():
+  iotc.gSSLContexts.clear()
+  context = iotc._getSSLContext(None, None)
+  assert all(iotc._getSSLContext(None, None) is context for i in range(20)) # CA bundle loaded once
+
+if __name__ == "__main__":
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+  before, after = benchContexts(count)
+  print("context per connect  : %8.1f us CPU" % (before * 1e6))
+  print("shared context       : %8.1f us CPU" % (after * 1e6))
+
+  if len(sys.argv) > 2:
+    host, port = sys.argv[2].rsplit(":", 1)
+    full, resumed, reused = benchHandshakes(host, int(port), max(1, count // 10))
+    print("context + handshake  : %8.1f us CPU" % (full * 1e6))
+    print("resumed handshake    : %8.1f us CPU (session reused: %s)" % (resumed * 1e6, reused))
@@ -0,0 +1,64 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import hmac
+import base64
+import hashlib
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTConnectType
+
+MASTER_KEY = base64.b64encode(b"group-enrollment-master-key-0123").decode("utf8")
+
+def compute_key(secret, regId):
+  return base64.b64encode(hmac.new(base64.b64decode(secret), msg=regId.encode('utf8'), digestmod=hashlib.sha256).digest())
+
+def test_sign_matches_hmac_sha256():
+  key = iotc.SymmetricKey(MASTER_KEY)
+  message = "scope%2Fregistrations%2Fdev1\n1600000000"
+  assert key.sign(message) == compute_key(MASTER_KEY, message)
+  assert key.sign(message) == compute_key(MASTER_KEY, message) # memoized
+  assert str(key) == MASTER_KEY
+
+def test_derive_matches_device_key():
+  master = iotc.SymmetricKey(MASTER_KEY)
+  keys = master.deriveMany(["dev" + str(i) for i in range(50)])
+  assert len(keys) == 50
+  for regId in keys:
+    deviceKey = compute_key(MASTER_KEY, regId)
+    assert str(keys[regId]) == deviceKey.decode("utf8")
+    assert keys[regId].sign("uri\n1") == compute_key(deviceKey, "uri\n1")
+
+def test_signature_cache_is_bounded():
+  key = iotc.SymmetricKey(MASTER_KEY, 4)
+  for i in range(10):
+    key.sign("uri\n" + str(i))
+  assert len(key._signatures) == 4
+  assert list(key._signatures.keys()) == ["uri\n6", "uri\n7", "uri\n8", "uri\n9"]
+  key.sign("uri\n6") # most recently used moves to the end
+  key.sign("uri\n10")
+  assert list(key._signatures.keys()) == ["uri\n8", "uri\n9", "uri\n6", "uri\n10"]
+
+def test_device_accepts_string_or_derived_key():
+  deviceKey = iotc.SymmetricKey(MASTER_KEY).derive("dev1")
+  fromString = iotc.Device("scope", str(deviceKey), "dev1", IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+  fromKey = iotc.Device("scope", deviceKey, "dev1", IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+
+  message = "hub%2Fdevices%2Fdev1\n1600000000"
+  expected = compute_key(str(deviceKey), message)
+  assert fromString._computeDrivedSymmetricKey(fromString._keyORCert, message) == expected
+  assert fromKey._computeDrivedSymmetricKey(fromKey._keyORCert, message) == expected
+  assert fromString._symmetricKey[0] == str(deviceKey) # decoded once, reused
+  assert fromKey._gen_sas_token("hub", "dev1", fromKey._keyORCert).startswith("SharedAccessSignature sr=hub%2Fdevices%2Fdev1&sig=")
+
+if __name__ == "__main__":
+  test_sign_matches_hmac_sha256()
+  test_derive_matches_device_key()
+  test_signature_cache_is_bounded()
+  test_device_accepts_string_or_derived_key()
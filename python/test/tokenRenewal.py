@@ -0,0 +1,124 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import time
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTConnectType
+from helpers import StubClient
+
+class RenewingDevice(iotc.Device):
+  def __init__(self, connectResult):
+    iotc.Device.__init__(self, "scope", "a2V5", "dev1", IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+    self.connectResult = connectResult
+    self.mqttConnects = []
+    self.provisioned = 0
+    self._hostName = "hub1.azure-devices.net"
+    self._mqttConnected = True
+    self._mqtts = StubClient(self)
+
+  def _mqttConnect(self, err, hostname, timeout = None):
+    self.mqttConnects.append(hostname)
+    self._mqttCredentials(hostname)
+    self._mqttConnected = self.connectResult == 0
+    return self.connectResult
+
+  def _provision(self):
+    self.provisioned += 1
+    return "hub2.azure-devices.net", None
+
+class BrokerDevice(iotc.Device):
+  # runs the real `_mqttConnect` / `_onConnect` path without a network
+  def __init__(self):
+    iotc.Device.__init__(self, "scope", "a2V5", "dev1", IOTConnectType.IOTC_CONNECT_SYMM_KEY)
+    self._hostName = "hub1.azure-devices.net"
+    self.clients = []
+
+  def _startMQTTLoop(self):
+    self._mqtts = StubClient(self)
+    self.clients.append(self._mqtts)
+    self._onConnect(self._mqtts, None, None, 0) # CONNACK
+
+def test_renewal_keeps_the_session_quiet():
+  device = BrokerDevice()
+  status = []
+  device.on("ConnectionStatus", lambda info: status.append(info.getStatusCode()))
+  assert device.connect(device._hostName) == 0
+  assert [topic for topic, _ in device.clients[0].published if topic.startswith("$iothub/twin/GET/")] != []
+  reported = len(status)
+
+  settings = []
+  device.on("SettingsUpdated", lambda info: settings.append(info.getTag()))
+  assert device._renewToken() == 0
+  assert len(device.clients) == 2 and device.clients[0].disconnected
+  assert device.clients[1].published == [] # no twin GET, so no SettingsUpdated storm
+  assert settings == [] and len(status) == reported # nor a ConnectionStatus
+  assert device.isConnected() and device._renewalEntry != None
+  device._cancelTokenRenewal()
+
+def test_renewal_delay_has_margin_and_jitter():
+  device = RenewingDevice(0)
+  device.setTokenExpiration(1000)
+  device._mqttCredentials(device._hostName)
+  delays = []
+  for i in range(200):
+    delays.append(device._tokenRenewalDelay())
+  assert min(delays) >= 795 and max(delays) <= 900
+  assert max(delays) - min(delays) > 50 # spread across the fleet
+
+  device.setTokenRenewal(True, 100, 0)
+  assert 895 <= device._tokenRenewalDelay() <= 900
+
+def test_renewal_reconnects_cached_host_without_dps():
+  device = RenewingDevice(0)
+  status = []
+  device.on("ConnectionStatus", lambda info: status.append(info.getStatusCode()))
+  oldClient = device._mqtts
+  assert device._renewToken() == 0
+  assert oldClient.disconnected
+  assert device.mqttConnects == ["hub1.azure-devices.net"]
+  assert device.provisioned == 0
+  assert status == [] # intentional disconnect is not reported
+  assert device._tokenExpiresAt > time.time()
+
+def test_renewal_falls_back_to_provisioning():
+  device = RenewingDevice(1)
+  assert device._renewToken() == 1
+  assert device.provisioned == 1
+  assert device.mqttConnects == ["hub1.azure-devices.net", "hub2.azure-devices.net"]
+
+def test_stale_client_disconnect_is_ignored():
+  device = RenewingDevice(0)
+  status = []
+  device.on("ConnectionStatus", lambda info: status.append(info.getStatusCode()))
+  device._auth_response_received = None
+  device._onDisconnect(StubClient(device), None, 1)
+  assert device._auth_response_received == None and device.isConnected() and status == []
+
+def test_disabled_renewal_is_not_scheduled():
+  device = RenewingDevice(0)
+  device._mqttCredentials(device._hostName)
+  device.setTokenRenewal(False)
+  device._scheduleTokenRenewal()
+  assert device._renewalEntry == None and device._tokenRenewAt == None
+
+  device.setTokenRenewal(True)
+  device._scheduleTokenRenewal()
+  assert device._renewalEntry != None
+  device._mqttConnected = False
+  device._cancelTokenRenewal()
+  assert device._renewalEntry == None
+
+if __name__ == "__main__":
+  test_renewal_delay_has_margin_and_jitter()
+  test_renewal_reconnects_cached_host_without_dps()
+  test_renewal_falls_back_to_provisioning()
+  test_renewal_keeps_the_session_quiet()
+  test_stale_client_disconnect_is_ignored()
+  test_disabled_renewal_is_not_scheduled()
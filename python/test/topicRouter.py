@@ -0,0 +1,84 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from iotc import IOTCallbackExecutor
+from helpers import createDevice, receive
+
+def test_router_precedence_and_captures():
+  router = iotc._TopicRouter()
+  router.add("a/{x}/c", "capture")
+  router.add("a/b/c", "literal")
+  router.add("a/#", "rest")
+  router.add("a/{x}/d/{y}", "two")
+
+  assert router.match("a/b/c") == ("literal", {})
+  assert router.match("a/q/c") == ("capture", {"x": "q"})
+  assert router.match("a/q/c") == ("capture", {"x": "q"}) # cached
+  assert router.match("a/b/d/e") == ("two", {"x": "b", "y": "e"}) # backtracks from the literal `b`
+  assert router.match("a/b/e/f") == ("rest", {"#": "b/e/f"})
+  assert router.match("b/c") == (None, None)
+  assert iotc._routeFilter("devices/{deviceId}/modules/{module}/#") == "devices/+/modules/+/#"
+
+def test_commands_and_c2d():
+  device = createDevice()
+  commands = []
+  device.on("Command", lambda info: commands.append((info.getTag(), info.getPayload())))
+  enqueued = []
+  device.on("EnqueuedCommand", lambda info: enqueued.append(info.getTag()))
+
+  receive(device, "$iothub/methods/POST/reboot/?$rid=42", b"{\"delay\": 5}")
+  assert commands == [("reboot", "{\"delay\": 5}")]
+  assert device._mqtts.published[-1][0] == "$iothub/methods/res/200/?$rid=42"
+
+  receive(device, "devices/dev1/messages/devicebound/%24.to=%2Fdevices%2Fdev1", b"{\"methodName\": \"blink\"}")
+  receive(device, "devices/dev1/messages/devicebound/", b"not json") # logged, not raised
+  receive(device, "devices/dev2/messages/devicebound/", b"{\"methodName\": \"other\"}")
+  assert enqueued == ["blink"]
+
+def test_user_routes():
+  device = createDevice()
+  messages = []
+  assert device.addRoute("devices/dev1/modules/{module}/inputs/#", messages.append) == 0
+  assert device._mqtts.subscribed == ["devices/dev1/modules/+/inputs/#"]
+
+  payload = b"\xff\x00"
+  receive(device, "devices/dev1/modules/filter/inputs/input1?$.ct=application%2Fjson", payload)
+  message = messages[0]
+  assert message.getEventName() == "Message"
+  assert message.getPayload() is payload # bytes are passed through
+  assert message.getCapture("module") == "filter"
+  assert message.getCapture("#") == "input1"
+  assert message.getCapture("$.ct") == "application%2Fjson"
+  assert message.getCaptures() == {"module": "filter", "#": "input1", "$.ct": "application%2Fjson"}
+
+  device._subscribe() # routes are subscribed again on reconnect
+  assert device._mqtts.subscribed.count("devices/dev1/modules/+/inputs/#") == 2
+
+  routed = iotc.IOTMessage(device, "t", b"{\"a\": 1}", {})
+  assert routed.getText() == "{\"a\": 1}" and routed.getJSON() == {"a": 1}
+
+def test_routes_use_the_callback_executor():
+  executor = IOTCallbackExecutor(1)
+  device = createDevice()
+  device.setCallbackExecutor(executor)
+  topics = []
+  device.addRoute("custom/{name}", lambda message: topics.append(message.getTopic()), False)
+  assert device._mqtts.subscribed == []
+  device._mqttcb(b"custom/x", b"") # umqtt callback is routed too
+  assert executor.flush(5)
+  assert topics == ["custom/x"]
+  executor.shutdown()
+
+if __name__ == "__main__":
+  test_router_precedence_and_captures()
+  test_commands_and_c2d()
+  test_user_routes()
+  test_routes_use_the_callback_executor()
@@ -0,0 +1,96 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import json
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from helpers import answerTwin, createDevice, receive
+
+def lastPatch(device):
+  topic, payload = device._mqtts.published[-1]
+  assert topic.startswith("$iothub/twin/PATCH/properties/reported/?$rid=")
+  return topic[topic.find("$rid=") + 5:], json.loads(payload)
+
+def test_reports_only_changed_properties():
+  device = createDevice()
+  properties = {"firmware": "1.0", "interval": 60, "location": {"lat": 47.6, "lon": -122.1}}
+  assert device.reportProperties(properties) == 0
+  rid, patch = lastPatch(device)
+  assert patch == properties
+  receive(device, "$iothub/twin/res/204/?$rid={}&$version=2".format(rid))
+
+  properties["location"]["lat"] = 47.7 # the cache holds its own copy
+  assert device.reportProperties(properties) == 0
+  rid, patch = lastPatch(device)
+  assert patch == {"location": {"lat": 47.7, "lon": -122.1}}
+  receive(device, "$iothub/twin/res/204/?$rid={}&$version=3".format(rid))
+
+  count = len(device._mqtts.published)
+  assert device.reportProperties(properties) == 0
+  assert len(device._mqtts.published) == count # nothing changed, nothing sent
+  assert device.getLocalTwin()["reported"]["$version"] == 3
+
+def test_rejected_patch_is_not_applied():
+  device = createDevice()
+  device.reportProperties({"interval": 30})
+  rid, _ = lastPatch(device)
+  receive(device, "$iothub/twin/res/400/?$rid={}".format(rid))
+  assert device.getLocalTwin()["reported"] == {"$version": None}
+
+  device.reportProperties({"interval": 30})
+  assert lastPatch(device)[1] == {"interval": 30}
+
+def test_twin_document_and_sendProperty_update_the_cache():
+  device = createDevice()
+  twin = {"desired": {"fan": {"value": 2}, "$version": 4}, "reported": {"interval": 30, "$version": 9}}
+  device.getTwin()
+  answerTwin(device, twin)
+  assert device.getLocalTwin() == twin
+
+  count = len(device._mqtts.published)
+  assert device.reportProperties({"interval": 30}) == 0
+  assert len(device._mqtts.published) == count
+
+  device.sendProperty("{\"interval\": 45}")
+  rid, _ = lastPatch(device)
+  receive(device, "$iothub/twin/res/204/?$rid={}&$version=10".format(rid))
+  assert device.getLocalTwin()["reported"] == {"interval": 45, "$version": 10}
+
+def test_desired_patches_follow_version():
+  device = createDevice()
+  tags = []
+  device.on("SettingsUpdated", lambda info: tags.append(info.getTag()))
+  device.getDeviceSettings()
+  answerTwin(device, {"desired": {"fan": {"value": 2}, "light": {"value": 1}, "$version": 4}, "reported": {}})
+  tags = tags[:0]
+
+  receive(device, "$iothub/twin/PATCH/properties/desired/?$version=5", {"fan": {"value": 3}, "light": None, "$version": 5})
+  receive(device, "$iothub/twin/PATCH/properties/desired/?$version=5", {"fan": {"value": 3}, "light": None, "$version": 5}) # redelivered
+  assert tags == ["fan"]
+  assert device.getLocalTwin()["desired"] == {"fan": {"value": 3}, "$version": 5}
+
+  # the acknowledgement is a reported write too
+  rid, patch = lastPatch(device)
+  assert patch["fan"]["statusCode"] == 200
+  receive(device, "$iothub/twin/res/204/?$rid={}&$version=11".format(rid))
+  assert device.getLocalTwin()["reported"]["fan"]["desiredVersion"] == 5
+
+def test_request_ids_are_unique():
+  device = createDevice()
+  for i in range(5):
+    device.sendProperty("{\"counter\": " + str(i) + "}")
+  rids = [topic[topic.find("$rid=") + 5:] for topic, _ in device._mqtts.published]
+  assert len(set(rids)) == 5
+
+if __name__ == "__main__":
+  test_reports_only_changed_properties()
+  test_rejected_patch_is_not_applied()
+  test_twin_document_and_sendProperty_update_the_cache()
+  test_desired_patches_follow_version()
+  test_request_ids_are_unique()
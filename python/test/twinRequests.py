@@ -0,0 +1,126 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+
+file_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(file_path, "..", "src"))
+sys.dont_write_bytecode = True
+
+import iotc
+from helpers import createDevice, createAsyncDevice, receive, runAsync
+
+def respond(device, request, status, body = None, version = None):
+  topic = "$iothub/twin/res/{}/?$rid={}".format(status, request.getRequestId())
+  if version != None:
+    topic = topic + "&$version=" + str(version)
+  receive(device, topic, body)
+
+TWIN = {"desired": {"fan": {"value": 2}, "$version": 3}, "reported": {"interval": 30, "$version": 8}}
+
+def test_getTwin_resolves_with_the_matching_response():
+  device = createDevice()
+  settings = []
+  device.on("SettingsUpdated", lambda info: settings.append(info.getTag()))
+  first = device.getTwin()
+  second = device.getTwin()
+  assert first.getRequestId() != second.getRequestId()
+  assert device._mqtts.published[0][0] == "$iothub/twin/GET/?$rid=" + first.getRequestId()
+
+  respond(device, second, 200, TWIN)
+  assert second.done() and not first.done()
+  assert second.isSuccess() and second.getStatusCode() == 200
+  assert second.getBody() == TWIN
+  assert settings == [] # only getDeviceSettings notifies
+  assert device.getLocalTwin() == TWIN
+
+def test_getDeviceSettings_does_not_wait():
+  device = createDevice()
+  settings = []
+  device.on("SettingsUpdated", lambda info: settings.append(info.getTag()))
+  started = time.time()
+  assert device.getDeviceSettings() == 0
+  assert time.time() - started < 0.5
+  topic = device._mqtts.published[0][0]
+  receive(device, topic.replace("GET", "res/200"), TWIN)
+  assert settings == ["fan"]
+  assert len(device._twinRequests) == 0
+
+def test_patchReported_completes_on_response():
+  device = createDevice()
+  completed = []
+  request = device.patchReported({"interval": 45})
+  request.addDoneCallback(lambda request: completed.append(request.getStatusCode()))
+  topic, payload = device._mqtts.published[0]
+  assert topic == "$iothub/twin/PATCH/properties/reported/?$rid=" + request.getRequestId()
+  assert json.loads(payload) == {"interval": 45}
+
+  respond(device, request, 204, version=9)
+  assert request.wait(0) and request.isSuccess()
+  assert request.getVersion() == 9
+  assert completed == [204]
+  assert device.getLocalTwin()["reported"] == {"interval": 45, "$version": 9}
+
+  rejected = device.patchReported({"interval": -1})
+  respond(device, rejected, 400)
+  assert rejected.done() and not rejected.isSuccess()
+  assert device.getLocalTwin()["reported"]["interval"] == 45
+
+def test_request_fails_on_deadline():
+  device = createDevice()
+  assert device.setRequestTimeout(0.05) == 0
+  request = device.getTwin()
+  assert request.wait(5)
+  assert request.getError() == "timeout" and request.getStatusCode() == None
+  respond(device, request, 200, TWIN) # late response is ignored
+  assert request.getBody() == None
+
+  request = device.patchReported({"a": 1}, timeout = 10)
+  device._onConnect(None, None, None, 0) # new connection, the response won't come
+  assert request.done() and request.getError() != None
+
+def test_done_callbacks_run_once():
+  device = createDevice()
+  for attempt in range(20):
+    request = iotc.IOTTwinRequest(device, "1", False)
+    calls = []
+    def add():
+      for i in range(100):
+        request.addDoneCallback(calls.append)
+    threads = [threading.Thread(target=add) for i in range(4)]
+    for thread in threads:
+      thread.start()
+    request._complete(200, None, None, None) # while callbacks are being added
+    for thread in threads:
+      thread.join()
+    assert len(calls) == 400 # none lost between the `_done` check and the append
+
+def test_async_requests():
+  async def run():
+    device = createAsyncDevice()
+    task = asyncio.ensure_future(device.patchReported({"mode": "eco"}))
+    await asyncio.sleep(0)
+    assert not task.done()
+    rid = device._mqtts.published[0][0].split("$rid=")[1]
+    receive(device, "$iothub/twin/res/204/?$rid={}&$version=2".format(rid))
+    request = await task
+    assert request.isSuccess() and request.getVersion() == 2
+
+    device.setRequestTimeout(0.01)
+    request = await device.getTwin()
+    assert request.getError() == "timeout"
+
+  runAsync(run())
+
+if __name__ == "__main__":
+  test_getTwin_resolves_with_the_matching_response()
+  test_getDeviceSettings_does_not_wait()
+  test_patchReported_completes_on_response()
+  test_request_fails_on_deadline()
+  test_done_callbacks_run_once()
+  test_async_requests()